@@ -0,0 +1,164 @@
+## Local stand-in for the Bedrock services used by the EDA assistant
+# Patches botocore so bedrock-runtime, bedrock-agent-runtime and bedrock-agent
+# calls return canned responses after a configurable latency, optionally
+# failing with ThrottlingException. Nothing leaves the machine, so benchmark
+# numbers measure this project's code rather than network and model variance.
+import io
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+import botocore.client
+from botocore.exceptions import ClientError
+
+# Configuration, overridable from the environment so CLI subprocesses match the parent
+config = {
+    "latency_ms": 50.0,          # Per request latency of invoke_model and retrieve
+    "jitter_ms": 10.0,           # Uniform jitter added to latency_ms
+    "token_latency_ms": 5.0,     # Delay between streamed output chunks
+    "throttle_rate": 0.0,        # Fraction of requests failing with ThrottlingException
+    "output_tokens": 200,        # Words in a generated answer
+    "embedding_dimension": 1536,
+    "num_passages": 5,           # Upper bound of passages returned by retrieve
+    "seed": 0,
+}
+original_make_api_call = botocore.client.BaseClient._make_api_call
+stats = {"calls": 0, "throttled": 0}
+stats_lock = threading.Lock()
+rng = random.Random(0)
+rng_lock = threading.Lock()
+
+
+def load_config_from_env():
+    """Read FAKE_BEDROCK_CONFIG (a JSON object) into config."""
+    if os.environ.get("FAKE_BEDROCK_CONFIG"):
+        config.update(json.loads(os.environ["FAKE_BEDROCK_CONFIG"]))
+
+
+def _sleep(latency_ms):
+    with rng_lock:
+        jitter = rng.uniform(0, config["jitter_ms"])
+    time.sleep((latency_ms + jitter) / 1000)
+
+
+def _maybe_throttle(operation):
+    with stats_lock:
+        stats["calls"] += 1
+    with rng_lock:
+        throttled = rng.random() < config["throttle_rate"]
+    if throttled:
+        with stats_lock:
+            stats["throttled"] += 1
+        raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"},
+                           "ResponseMetadata": {"HTTPStatusCode": 429}}, operation)
+
+
+def get_embedding(text):
+    """A deterministic unit vector derived from the text."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    text_rng = random.Random(seed)
+    vector = [text_rng.gauss(0, 1) for _ in range(config["embedding_dimension"])]
+    norm = sum(v * v for v in vector) ** 0.5
+    return [v / norm for v in vector]
+
+
+def get_answer_words(prompt):
+    words = ["The", "answer", "to", "your", "question", "about", f"{len(prompt)}", "characters", "is"]
+    return [words[i % len(words)] for i in range(config["output_tokens"])]
+
+
+def _get_headers(prompt, answer_words):
+    return {"ResponseMetadata": {"HTTPHeaders": {
+        "x-amzn-bedrock-input-token-count": str(len(prompt.split())),
+        "x-amzn-bedrock-output-token-count": str(len(answer_words)),
+    }}}
+
+
+def _get_prompt(body):
+    if "messages" in body:
+        return str(body["messages"][-1]["content"])
+    return str(body.get("prompt") or body.get("inputText") or "")
+
+
+def invoke_model(params):
+    body = json.loads(params["body"])
+    _maybe_throttle("InvokeModel")
+    _sleep(config["latency_ms"])
+
+    # Embedding models
+    if "texts" in body:
+        return {"body": io.BytesIO(json.dumps({"embeddings": [get_embedding(t) for t in body["texts"]]}).encode())}
+    if "inputText" in body and "textGenerationConfig" not in body:
+        return {"body": io.BytesIO(json.dumps({"embedding": get_embedding(body["inputText"])}).encode())}
+
+    prompt = _get_prompt(body)
+    answer_words = get_answer_words(prompt)
+    answer = " ".join(answer_words)
+    if "anthropic_version" in body:
+        response_body = {"content": [{"type": "text", "text": answer}]}
+    elif "prompt" in body:
+        response_body = {"outputs": [{"text": answer}]}
+    else:
+        response_body = {"results": [{"outputText": answer}]}
+    return {"body": io.BytesIO(json.dumps(response_body).encode()), **_get_headers(prompt, answer_words)}
+
+
+def invoke_model_with_response_stream(params):
+    body = json.loads(params["body"])
+    _maybe_throttle("InvokeModelWithResponseStream")
+    _sleep(config["latency_ms"])
+    answer_words = get_answer_words(_get_prompt(body))
+
+    def events():
+        for word in answer_words:
+            time.sleep(config["token_latency_ms"] / 1000)
+            if "anthropic_version" in body:
+                chunk = {"type": "content_block_delta", "delta": {"type": "text_delta", "text": word + " "}}
+            elif "prompt" in body:
+                chunk = {"outputs": [{"text": word + " "}]}
+            else:
+                chunk = {"outputText": word + " "}
+            yield {"chunk": {"bytes": json.dumps(chunk).encode()}}
+    return {"body": events()}
+
+
+def retrieve(params):
+    _maybe_throttle("Retrieve")
+    _sleep(config["latency_ms"])
+    query = params["retrievalQuery"]["text"]
+    number_of_results = min(params["retrievalConfiguration"]["vectorSearchConfiguration"].get("numberOfResults", 5), config["num_passages"])
+    return {"retrievalResults": [{
+        "content": {"text": f"Passage {i} for '{query}': " + "always_ff @(posedge clk) q <= d; " * 20},
+        "location": {"type": "S3", "s3Location": {"uri": f"s3://fake-kb-bucket/docs/manual_{i % 3}.pdf"}},
+        "score": 1.0 - i / 10,
+    } for i in range(number_of_results)]}
+
+
+def _make_api_call(self, operation_name, params):
+    service = self.meta.service_model.service_name
+    if operation_name == "InvokeModel":
+        return invoke_model(params)
+    if operation_name == "InvokeModelWithResponseStream":
+        return invoke_model_with_response_stream(params)
+    if operation_name == "Retrieve":
+        return retrieve(params)
+    if service == "bedrock-agent" and operation_name == "ListDataSources":
+        return {"dataSourceSummaries": []}
+    return original_make_api_call(self, operation_name, params)
+
+
+def install(**overrides):
+    """Patch botocore and give boto3 a region and dummy credentials if none are set."""
+    load_config_from_env()
+    config.update(overrides)
+    rng.seed(config["seed"])
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "AKIAFAKEBENCHMARK")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake-benchmark-secret")
+    botocore.client.BaseClient._make_api_call = _make_api_call
+
+
+def uninstall():
+    botocore.client.BaseClient._make_api_call = original_make_api_call
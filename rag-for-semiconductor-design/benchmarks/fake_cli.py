@@ -0,0 +1,18 @@
+## Run eda_assistant_chat.py against the local Bedrock stand-in
+# Usage: python benchmarks/fake_cli.py <eda_assistant_chat.py options>
+# The stand-in is configured from the FAKE_BEDROCK_CONFIG environment variable.
+import os
+import sys
+import runpy
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.join(os.path.dirname(benchmarks_dir), "src")
+sys.path.insert(0, benchmarks_dir)
+sys.path.insert(0, src_dir)
+
+import fake_bedrock
+fake_bedrock.install()
+
+chat_script = os.path.join(src_dir, "eda_assistant_chat.py")
+sys.argv = [chat_script] + sys.argv[1:]
+runpy.run_path(chat_script, run_name="__main__")
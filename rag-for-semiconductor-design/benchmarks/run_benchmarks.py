@@ -0,0 +1,287 @@
+## Benchmark suite for the EDA assistant RAG pipeline
+# Times each pipeline stage on its own and the CLI end to end against the
+# local Bedrock stand-in in fake_bedrock.py, and writes the results as JSON so
+# runs can be compared across commits.
+#
+# Usage: python benchmarks/run_benchmarks.py [--iterations 5] [--output results.json]
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.join(os.path.dirname(benchmarks_dir), "src")
+sys.path.insert(0, benchmarks_dir)
+sys.path.insert(0, src_dir)
+
+import fake_bedrock
+
+all_stages = ["load", "split", "embed", "faiss_build", "faiss_query", "kb_retrieve", "prompt_build",
+              "generate", "generate_stream", "sign_citations", "cli_norag", "cli_rag", "cli_docchain"]
+queries = [
+    "How do I constrain a generated clock in SDC?",
+    "Write a verilog code to swap contents of two registers with and without a temporary register",
+    "What does the always_ff block in fifo_ctrl do?",
+    "How do I run UltraSim in 64-bit mode?",
+]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the EDA assistant RAG pipeline against a local Bedrock stand-in')
+    parser.add_argument('--iterations', type=int, default=5, help='Timed iterations per stage')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed iterations per stage')
+    parser.add_argument('--files', type=int, default=40, help='Files in the generated corpus')
+    parser.add_argument('--corpus', type=str, help='Benchmark this document directory instead of a generated corpus')
+    parser.add_argument('--stages', type=str, default=",".join(all_stages), help='Comma separated stages to run')
+    parser.add_argument('--latency_ms', type=float, default=50.0, help='Latency of each fake Bedrock request')
+    parser.add_argument('--jitter_ms', type=float, default=10.0, help='Uniform jitter added to each fake request')
+    parser.add_argument('--token_latency_ms', type=float, default=5.0, help='Delay between streamed output chunks')
+    parser.add_argument('--throttle_rate', type=float, default=0.0, help='Fraction of fake requests failing with ThrottlingException')
+    parser.add_argument('--output_tokens', type=int, default=200, help='Words in each generated answer')
+    parser.add_argument('--embedding_concurrency', type=int, default=8, help='Concurrent embedding requests')
+    parser.add_argument('--chunksize', type=int, default=1000, help='Chunk size used to split documents')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='JSON file for the results')
+    return parser.parse_args()
+
+
+## Generate a corpus of HDL, SDC and text files
+def generate_corpus(corpus_dir, num_files):
+    for i in range(num_files):
+        kind = i % 3
+        if kind == 0:
+            body = "".join(f"""// Control block {i}.{j}
+module fifo_ctrl_{i}_{j} #(parameter DEPTH = 16) (
+  input  logic clk, rst_n, push, pop,
+  output logic full, empty
+);
+  logic [$clog2(DEPTH):0] count;
+  always_ff @(posedge clk or negedge rst_n) begin : count_update
+    if (!rst_n) count <= '0;
+    else if (push && !full) count <= count + 1;
+    else if (pop && !empty) count <= count - 1;
+  end
+  assign full  = (count == DEPTH);
+  assign empty = (count == 0);
+endmodule
+
+""" for j in range(20))
+            file_name = f"rtl/fifo_ctrl_{i}.sv"
+        elif kind == 1:
+            body = "".join(f"""# Clock group {j}
+create_clock -name clk_{j} -period {2 + j % 5} [get_ports clk_{j}]
+create_generated_clock -name clk_{j}_div2 -source [get_ports clk_{j}] -divide_by 2 [get_pins div_{j}/q]
+set_input_delay 0.5 -clock clk_{j} [get_ports in_{j}*]
+set_output_delay 0.5 -clock clk_{j} [get_ports out_{j}*]
+""" for j in range(60))
+            file_name = f"constraints/top_{i}.sdc"
+        else:
+            body = "".join(f"""Section {j}. To run Virtuoso UltraSim in 64-bit mode, set CDS_AUTO_64BIT to ultrasim
+and launch the executables through the wrapper in your_install_dir/tools/bin. The simulator
+reads netlists in SPICE and Spectre formats and supports fast-SPICE accuracy modes.
+
+""" for j in range(40))
+            file_name = f"docs/manual_{i}.txt"
+        file_path = os.path.join(corpus_dir, file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(body)
+
+
+## Time a function
+def measure(fn, iterations, warmup):
+    """Run fn warmup + iterations times.
+
+    Returns:
+    A tuple of timing statistics in seconds and the result of the last call.
+    """
+    result = None
+    for _ in range(warmup):
+        result = fn()
+    timings = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start_time)
+    if not timings:
+        return None, result
+    timings.sort()
+    return {
+        "n": len(timings),
+        "mean_s": statistics.fmean(timings),
+        "p50_s": statistics.median(timings),
+        "p95_s": timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))],
+        "min_s": timings[0],
+        "max_s": timings[-1],
+    }, result
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=benchmarks_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+## Pipeline stages
+def run_pipeline_stages(args, stages, corpus_dir, work_dir, results):
+    import eda_assistant_doc_loader
+    import eda_assistant_langchain_api
+    import eda_assistant_embeddings
+    import eda_assistant_bedrock_api
+    import eda_assistant_query_engine
+    import eda_assistant_presigned_url
+
+    modelID = 'anthropic.claude-3-haiku-20240307-v1:0'
+    embeddings_modelid = 'amazon.titan-embed-text-v1'
+    embeddings = eda_assistant_embeddings.CachedBedrockEmbeddings(
+        client=eda_assistant_bedrock_api.get_bedrock_client(), model_id=embeddings_modelid,
+        cache_path=None, max_concurrency=args.embedding_concurrency)
+
+    def load():
+        return [doc for relpath, docs in eda_assistant_doc_loader.iter_documents(corpus_dir) if docs for doc in docs]
+    timing, docs = measure(load, args.iterations if "load" in stages else 0, 1)
+    if "load" in stages:
+        results["load"] = {**timing, "files": len(eda_assistant_doc_loader.list_files(corpus_dir)), "documents": len(docs)}
+
+    timing, chunks = measure(lambda: eda_assistant_langchain_api.get_langchain_split_chunks(docs, args.chunksize), args.iterations if "split" in stages else 0, 1)
+    if "split" in stages:
+        results["split"] = {**timing, "chunks": len(chunks)}
+    texts = [chunk.page_content for chunk in chunks]
+
+    timing, vectors = measure(lambda: embeddings.embed_documents(texts), args.iterations if "embed" in stages else 0, 1)
+    if "embed" in stages:
+        results["embed"] = {**timing, "chunks": len(texts), "chunks_per_s": len(texts) / timing["mean_s"]}
+
+    if "faiss_build" in stages or "faiss_query" in stages:
+        from langchain_community.vectorstores import FAISS
+        timing, db = measure(lambda: FAISS.from_embeddings(list(zip(texts, vectors)), embeddings, metadatas=[chunk.metadata for chunk in chunks]),
+                             args.iterations if "faiss_build" in stages else 0, 1)
+        if "faiss_build" in stages:
+            results["faiss_build"] = {**timing, "vectors": len(vectors)}
+        query_vectors = [fake_bedrock.get_embedding(query) for query in queries]
+        if "faiss_query" in stages:
+            timing, _ = measure(lambda: [db.similarity_search_by_vector(vector, k=4) for vector in query_vectors], args.iterations, args.warmup)
+            results["faiss_query"] = {**timing, "queries_per_iteration": len(queries)}
+
+    timing, retrieve_response = measure(lambda: eda_assistant_bedrock_api.retrieve(queries[0], "FAKEKB0000", 5),
+                                        args.iterations if "kb_retrieve" in stages else 0, 1)
+    if "kb_retrieve" in stages:
+        results["kb_retrieve"] = timing
+    retrievalResults = retrieve_response['retrievalResults']
+    contexts = eda_assistant_bedrock_api.get_contexts(retrievalResults)
+
+    timing, rag_prompt = measure(lambda: eda_assistant_query_engine.get_rag_prompt(contexts, queries[0]),
+                                 args.iterations if "prompt_build" in stages else 0, 1)
+    if "prompt_build" in stages:
+        results["prompt_build"] = timing
+
+    if "generate" in stages:
+        timing, _ = measure(lambda: eda_assistant_bedrock_api.get_bedrock_response_and_usage(rag_prompt, modelID, 0.1, 0.5, 50, 1000), args.iterations, args.warmup)
+        results["generate"] = timing
+
+    if "generate_stream" in stages:
+        first_token_times = []
+        def generate_stream():
+            start_time = time.perf_counter()
+            for i, text in enumerate(eda_assistant_bedrock_api.get_bedrock_response_stream(rag_prompt, modelID, 0.1, 0.5, 50, 1000)):
+                if i == 0:
+                    first_token_times.append(time.perf_counter() - start_time)
+        timing, _ = measure(generate_stream, args.iterations, args.warmup)
+        results["generate_stream"] = {**timing, "ttft_mean_s": statistics.fmean(first_token_times[args.warmup:])}
+
+    if "sign_citations" in stages:
+        citations = eda_assistant_bedrock_api.get_citation_uris(retrievalResults)
+        def sign_cold():
+            eda_assistant_presigned_url.presigned_url_cache.clear()
+            return eda_assistant_presigned_url.create_presigned_urls(citations)
+        timing, _ = measure(sign_cold, args.iterations, args.warmup)
+        results["sign_citations"] = {**timing, "citations": len(citations)}
+        timing, _ = measure(lambda: eda_assistant_presigned_url.create_presigned_urls(citations), args.iterations, args.warmup)
+        results["sign_citations_cached"] = timing
+
+
+## End to end CLI runs in a subprocess, including interpreter start and imports
+def run_cli_stages(args, stages, corpus_dir, work_dir, results):
+    env = {**os.environ, "FAKE_BEDROCK_CONFIG": json.dumps(fake_bedrock.config)}
+    cli = [sys.executable, os.path.join(benchmarks_dir, "fake_cli.py"), "--no_response_cache",
+           "--embedding_cache", os.path.join(work_dir, "embeddings.sqlite"), "--parse_cache", os.path.join(work_dir, "parsed.sqlite")]
+
+    def run_cli(cli_args):
+        def run():
+            completed = subprocess.run(cli + cli_args, env=env, capture_output=True, text=True)
+            if completed.returncode != 0:
+                raise RuntimeError(f"CLI failed: {completed.stdout[-2000:]}{completed.stderr[-2000:]}")
+        return run
+
+    if "cli_norag" in stages:
+        results["cli_norag"], _ = measure(run_cli(["--norag", "--prompt", queries[1]]), args.iterations, args.warmup)
+    if "cli_rag" in stages:
+        results["cli_rag"], _ = measure(run_cli(["--kbid", "FAKEKB0000", "--prompt", queries[1]]), args.iterations, args.warmup)
+    if "cli_docchain" in stages:
+        index_dir = os.path.join(work_dir, "faiss_index")
+        docchain_args = ["--docchain", "--filepath", corpus_dir, "--index_dir", index_dir, "--prompt", queries[2]]
+
+        def run_cold():
+            shutil.rmtree(index_dir, ignore_errors=True)
+            for cache_file in ("embeddings.sqlite", "parsed.sqlite"):
+                if os.path.exists(os.path.join(work_dir, cache_file)):
+                    os.remove(os.path.join(work_dir, cache_file))
+            run_cli(docchain_args)()
+        results["cli_docchain_cold"], _ = measure(run_cold, args.iterations, 0)
+        results["cli_docchain_warm"], _ = measure(run_cli(docchain_args), args.iterations, args.warmup)
+
+
+def print_results(results):
+    print(f"\n{'stage':<24}{'n':>4}{'mean ms':>12}{'p50 ms':>12}{'p95 ms':>12}")
+    for stage, timing in results.items():
+        print(f"{stage:<24}{timing['n']:>4}{timing['mean_s'] * 1000:>12.1f}{timing['p50_s'] * 1000:>12.1f}{timing['p95_s'] * 1000:>12.1f}")
+
+
+def main():
+    args = get_args()
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown_stages = [stage for stage in stages if stage not in all_stages]
+    if unknown_stages:
+        print("-E- Unknown stages: ", ", ".join(unknown_stages))
+        sys.exit(1)
+
+    fake_bedrock.install(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, token_latency_ms=args.token_latency_ms,
+                         throttle_rate=args.throttle_rate, output_tokens=args.output_tokens)
+
+    work_dir = tempfile.mkdtemp(prefix="eda_assistant_bench_")
+    try:
+        corpus_dir = args.corpus
+        if corpus_dir is None:
+            corpus_dir = os.path.join(work_dir, "corpus")
+            generate_corpus(corpus_dir, args.files)
+
+        results = {}
+        run_pipeline_stages(args, stages, corpus_dir, work_dir, results)
+        run_cli_stages(args, stages, corpus_dir, work_dir, results)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {**{k: v for k, v in vars(args).items() if k != "output"}, "fake_bedrock": fake_bedrock.config},
+        "fake_bedrock_stats": fake_bedrock.stats,
+        "stages": results,
+    }
+    print_results(results)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    print("\n-I- Results written to ", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,64 @@
 #All arguments
 
 import argparse
+import os
 
 parser = argparse.ArgumentParser(description='Semiconductor Design and Electronic Design Automation (EDA) Engineering Assistant')
 parser.add_argument('--modelid', required=False, choices=['anthropic.claude-v2', 'anthropic.claude-instant-v1', 'anthropic.claude-3-sonnet-20240229-v1:0', 'anthropic.claude-3-haiku-20240307-v1:0'],  help='Provide foundation model ID')
-parser.add_argument('--tokens', required=False, default=10000, help='Provide # of tokens')
+parser.add_argument('--tokens', type=int, required=False, default=10000, help='Provide # of tokens')
 parser.add_argument('--prompt', required=False, help='Provide prompt')
 parser.add_argument('--kbid', required=False, help='Provide knowledge base id for RAG')
-parser.add_argument('--temperature', required=False, default=0.1, help='Provide temperature for the model')
-parser.add_argument('--top_p', required=False, default=0.5, help='Provide top_p for the model')
-parser.add_argument('--top_k', required=False, default=50, help='Provide top_k for the model')
+parser.add_argument('--temperature', type=float, required=False, default=0.1, help='Provide temperature for the model')
+parser.add_argument('--top_p', type=float, required=False, default=0.5, help='Provide top_p for the model')
+parser.add_argument('--top_k', type=int, required=False, default=50, help='Provide top_k for the model')
 parser.add_argument('--norag', action="store_true", required=False, help='Use model as is')
 parser.add_argument('--docchain', action="store_true", required=False, help='Provide a file path for RAG')
 parser.add_argument('--filepath', type=str, required=False, help='Use model as is')
+parser.add_argument('--index_dir', type=str, required=False, default='faiss_index', help='Directory to save and reload FAISS indexes for --docchain')
+parser.add_argument('--embedding_cache', type=str, required=False, default=os.path.join(os.path.expanduser('~'), '.cache', 'eda_assistant', 'embeddings.sqlite'), help='SQLite file caching chunk embeddings for --docchain')
+parser.add_argument('--embedding_concurrency', type=int, required=False, default=8, help='Maximum concurrent embedding requests for --docchain')
+parser.add_argument('--parse_cache', type=str, required=False, default=os.path.join(os.path.expanduser('~'), '.cache', 'eda_assistant', 'parsed.sqlite'), help='SQLite file caching text parsed from --docchain files')
+parser.add_argument('--parse_workers', type=int, required=False, help='Number of processes parsing --docchain files (default: number of CPUs)')
+parser.add_argument('--include_glob', action="append", required=False, help='Only index --docchain files matching this glob, may be repeated (default: all files)')
+parser.add_argument('--exclude_glob', action="append", required=False, help='Skip --docchain files matching this glob, may be repeated (default: GDS, OASIS, waveform dumps and other binaries)')
+parser.add_argument('--reindex', action="store_true", required=False, help='Rebuild the FAISS index for --docchain from scratch instead of updating the saved one')
+parser.add_argument('--faiss_index', type=str, required=False, default='flat', choices=['flat', 'hnsw', 'ivf_flat', 'ivf_pq'], help='FAISS index type for --docchain: exact flat, HNSW graph, IVF inverted lists or IVF with product quantization')
+parser.add_argument('--faiss_encoding', type=str, required=False, default='float32', choices=['float32', 'float16', 'int8'], help='Vector encoding in flat, HNSW and IVF-Flat FAISS indexes')
+parser.add_argument('--faiss_nlist', type=int, required=False, help='Inverted lists of an IVF index (default: about 4 * sqrt(vectors))')
+parser.add_argument('--faiss_pq_m', type=int, required=False, help='Bytes per vector of an IVF-PQ index (default: dimension / 16)')
+parser.add_argument('--faiss_nprobe', type=int, required=False, help='Inverted lists searched per IVF query (default: 16)')
+parser.add_argument('--faiss_ef_search', type=int, required=False, help='Candidate list size of an HNSW query (default: 64)')
+parser.add_argument('--faiss_rescore', type=int, required=False, help='Re-score this many approximate candidates per result with the exact vectors, 0 disables (default: 4)')
+parser.add_argument('--opensearch_index', type=str, required=False, help='Retrieve from this OpenSearch k-NN index instead of a knowledge base, built from --filepath in --docchain mode')
+parser.add_argument('--opensearch_url', type=str, required=False, help='OpenSearch endpoint URL, e.g. http://localhost:9200 for a local container')
+parser.add_argument('--opensearch_domain', type=str, required=False, help='Amazon OpenSearch Service domain name, used if --opensearch_url is not given')
+parser.add_argument('--opensearch_user', type=str, required=False, help='OpenSearch user, the password is read from the OPENSEARCH_PASSWORD environment variable')
+parser.add_argument('--opensearch_hybrid', action="store_true", required=False, help='Combine OpenSearch k-NN with a BM25 text match')
+parser.add_argument('--opensearch_filter', type=str, required=False, help='JSON object of metadata field to value(s) that OpenSearch results must match')
+parser.add_argument('--batch', type=str, required=False, help='Answer every prompt of a JSON or text file, RAG unless --norag is given')
+parser.add_argument('--batch_output', type=str, required=False, help='JSONL file for --batch results (default: <batch file>_results.jsonl)')
+parser.add_argument('--batch_workers', type=int, required=False, default=4, help='Number of prompts answered concurrently in --batch mode')
 parser.add_argument('--webui', action="store_true", required=False, help='Use langchain implementation')
+parser.add_argument('--serve', action="store_true", required=False, help='Serve queries over a local HTTP/JSON API, RAG if --kbid or --opensearch_index is given')
+parser.add_argument('--serve_host', type=str, required=False, default='127.0.0.1', help='Address the --serve API listens on')
+parser.add_argument('--serve_port', type=int, required=False, default=8765, help='Port the --serve API listens on')
+parser.add_argument('--query_workers', type=int, required=False, default=32, help='Threads making blocking Bedrock and S3 calls for the query engine of the web UI, batch and --serve modes')
+parser.add_argument('--max_queries', type=int, required=False, default=128, help='Queries the query engine answers at once, later queries wait')
 parser.add_argument('--show_all_models', required=False, action="store_true", help='display all models available to use')
+parser.add_argument('--stream', action="store_true", required=False, help='Print the response as it is generated')
+parser.add_argument('--conversation', type=str, required=False, help='JSON file holding the conversation, the prompt is answered as a follow-up and added to it (CLI and --docchain modes)')
+parser.add_argument('--history_budget', type=int, required=False, help='Maximum tokens of conversation history sent with a question (default: per model, see eda_assistant_model_options.history_budgets)')
+parser.add_argument('--response_cache', type=str, required=False, default=os.path.join(os.path.expanduser('~'), '.cache', 'eda_assistant', 'responses.sqlite'), help='SQLite file caching model responses')
+parser.add_argument('--no_response_cache', action="store_true", required=False, help='Always call the model, do not use the response cache')
+parser.add_argument('--cache_ttl', type=int, required=False, default=86400, help='Seconds a cached response stays valid')
+parser.add_argument('--cache_max_entries', type=int, required=False, default=1000, help='Cached responses kept before the least recently used are evicted')
+parser.add_argument('--semantic_cache', action="store_true", required=False, help='Also reuse responses of similar prompts, compared by embedding similarity')
+parser.add_argument('--semantic_cache_threshold', type=float, required=False, default=0.95, help='Minimum cosine similarity for --semantic_cache')
+parser.add_argument('--num_results', type=int, required=False, default=3, help='Retrieved passages that reach the prompt in RAG mode')
+parser.add_argument('--rerank_candidates', type=int, required=False, default=30, help='Passages retrieved and reranked locally before keeping the best --num_results, 0 disables reranking')
+parser.add_argument('--context_budget', type=int, required=False, help='Maximum tokens of retrieved passages in a RAG prompt (default: per model, see eda_assistant_model_options.context_budgets)')
+parser.add_argument('--trace_file', type=str, required=False, help='Append the timed phases of each query to this file as JSON lines (OpenTelemetry span fields)')
+parser.add_argument('--trace_summary', action="store_true", required=False, help='Print a table of the timed phases of the query')
+parser.add_argument('--profile_startup', '--profile-startup', action="store_true", required=False, help='Report time spent importing modules')
 parser.add_argument('--noref', action="store_true", required=False, help='Do not show references')
 args = parser.parse_args()
@@ -0,0 +1,260 @@
+## Asynchronous query engine shared by the web UI, batch mode and the query server
+# Queries are coroutines on one event loop running in a background thread.
+# The blocking Bedrock, S3 and SQLite calls run in a bounded thread pool, so
+# the number of threads does not grow with the number of users: queries past
+# max_queries wait for a slot and calls past max_workers wait for a thread.
+# Phases that do not depend on each other run concurrently, citations of the
+# packed passages are signed while the model generates the answer.
+# Async callers (the query server) await engine.query() on engine.loop, other
+# threads (Streamlit sessions, batch mode) use engine.run() and engine.iter_sync().
+import time
+import asyncio
+import functools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import eda_assistant_bedrock_api
+import eda_assistant_presigned_url
+import eda_assistant_query_engine
+import eda_assistant_tracing
+
+default_max_workers = 32
+default_max_queries = 128
+
+shared_engine = None
+shared_engine_lock = threading.Lock()
+
+
+class AsyncQueryEngine:
+    """Answers queries concurrently on a background event loop.
+
+    Args:
+    max_workers: Threads running blocking calls, shared by all queries.
+    max_queries: Queries answered at once, later queries wait for a slot.
+    response_cache: Optional eda_assistant_response_cache.ResponseCache.
+    """
+
+    def __init__(self, max_workers=default_max_workers, max_queries=default_max_queries, response_cache=None):
+        self.max_workers = max_workers
+        self.max_queries = max_queries
+        self.response_cache = response_cache
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="eda-query")
+        self.loop = asyncio.new_event_loop()
+        self.query_slots = asyncio.Semaphore(max_queries)
+        self.active_queries = 0
+        self.num_queries = 0
+        self.thread = threading.Thread(target=self.loop.run_forever, name="eda-query-loop", daemon=True)
+        self.thread.start()
+
+    ## Run a blocking function in the pool, inside the query's trace
+    async def _call(self, trace_context, fn, *args, **kwargs):
+        # Each call gets its own copy of the trace context, a context cannot be entered by two threads at once
+        return await self.loop.run_in_executor(self.executor, functools.partial(trace_context.copy().run, fn, *args, **kwargs))
+
+    def _begin_trace(self, trace_file, **attributes):
+        trace_context = contextvars.copy_context()
+        trace = trace_context.run(eda_assistant_tracing.begin_trace, "query", trace_file, **attributes)
+        return trace_context, trace
+
+    def _sign_citations(self, citations):
+        with eda_assistant_tracing.span("sign_citations", citations=len(citations)):
+            return eda_assistant_presigned_url.create_presigned_urls(citations)
+
+    def _cache_get(self, use_cache, query, modelID, kbId, generation_params):
+        if not use_cache or self.response_cache is None:
+            return None
+        with eda_assistant_tracing.span("cache_lookup"):
+            cached_response = self.response_cache.get(query, modelID, kbId, generation_params)
+            eda_assistant_tracing.set_attributes(hit=cached_response['match'] if cached_response else False)
+        return cached_response
+
+    def _cache_put(self, query, modelID, result, citations, kbId, generation_params):
+        with eda_assistant_tracing.span("cache_store"):
+            self.response_cache.put(query, modelID, result, citations, kbId, generation_params)
+
+    async def _get_history(self, trace_context, conversation, query):
+        if conversation is None:
+            return "", query
+        # The previous answer may still be being added and summarized
+        if conversation.pending_update is not None:
+            await asyncio.wait([conversation.pending_update])
+        return await self._call(trace_context, lambda: (conversation.get_history_text(), conversation.get_retrieval_query(query)))
+
+    def _add_turn(self, conversation, query, result):
+        # In the background and outside the trace, summarizing older turns should not delay the answer
+        conversation.pending_update = self.loop.run_in_executor(self.executor, conversation.add_turn, query, result)
+
+    ## Answer a query
+    async def query(self, query, modelID, kbId=None, temperature=0.1, topp=0.5, topk=50, maxtokens=10000, numberOfResults=5,
+                    retrieve_fn=None, sign_citations=True, use_cache=True, trace_file=None, conversation=None, **trace_attributes):
+        """Answer a query with RAG if kbId is given, otherwise with the base FM.
+
+        Args:
+        query: Original User Query
+        modelID: LLM specific Model identifier
+        kbId: Knowledge Base ID, or None for the base FM
+        temperature, topp, topk, maxtokens: Model parameters
+        numberOfResults: Number of passages to retrieve
+        retrieve_fn: Optional function used instead of the knowledge base,
+            see eda_assistant_query_engine.get_rag_response()
+        sign_citations: Create presigned 'reference_urls' for the citations
+        use_cache: Look up and store the answer in the response cache
+        trace_file: Append the query trace to this file
+        conversation: Optional eda_assistant_conversation.Conversation, its
+            history is sent with the question and the answer is added to it.
+            Answers with history are not cached.
+        trace_attributes: Extra attributes of the trace, e.g. mode="webui"
+
+        Returns:
+        A dictionary with the generated 'result', the token 'usage', the
+        'citations' and their 'reference_urls', whether the answer was
+        'cached', 'latency_s', 'phases_ms' and the 'trace'.
+        """
+        async with self.query_slots:
+            self.active_queries += 1
+            self.num_queries += 1
+            start_time = time.perf_counter()
+            generation_params = {"temperature": temperature, "top_p": topp, "top_k": topk, "max_tokens": maxtokens}
+            trace_context, trace = self._begin_trace(trace_file, model=modelID, rag=kbId is not None, **trace_attributes)
+            try:
+                history, retrieval_query = await self._get_history(trace_context, conversation, query)
+                # Answers to follow-up questions depend on the history
+                use_cache = use_cache and not history
+                cached_response = await self._call(trace_context, self._cache_get, use_cache, query, modelID, kbId, generation_params)
+                usage = None
+                if cached_response:
+                    result, citations = cached_response['result'], cached_response['citations']
+                    reference_urls = await self._call(trace_context, self._sign_citations, citations) if sign_citations else []
+                else:
+                    prompt, citations = history + query, []
+                    if kbId is not None:
+                        retrievalResults = await self._call(trace_context, eda_assistant_query_engine.retrieve_results, retrieval_query, kbId, numberOfResults, retrieve_fn)
+                        prompt, retrievalResults = await self._call(trace_context, eda_assistant_query_engine.build_rag_prompt, query, retrievalResults, modelID, maxtokens, history)
+                        citations = eda_assistant_bedrock_api.get_citation_uris(retrievalResults)
+                    generation = self._call(trace_context, eda_assistant_query_engine.generate_response, prompt, modelID, temperature, topp, topk, maxtokens)
+                    if sign_citations and citations:
+                        (result, usage), reference_urls = await asyncio.gather(generation, self._call(trace_context, self._sign_citations, citations))
+                    else:
+                        (result, usage), reference_urls = await generation, []
+                    if use_cache and self.response_cache:
+                        await self._call(trace_context, self._cache_put, query, modelID, result, citations, kbId, generation_params)
+            except Exception as e:
+                trace.root.status = "ERROR"
+                trace.root.set_attributes(error=str(e))
+                raise
+            finally:
+                trace.end()
+                self.active_queries -= 1
+        if conversation:
+            self._add_turn(conversation, query, result)
+
+        return {
+            'result': result,
+            'usage': usage,
+            'citations': citations,
+            'reference_urls': reference_urls,
+            'cached': cached_response['match'] if cached_response else None,
+            'latency_s': round(time.perf_counter() - start_time, 3),
+            'phases_ms': {phase: round(seconds * 1000, 1) for phase, seconds in trace.get_phase_timings().items()},
+            'trace': trace,
+        }
+
+    ## Answer a query, streaming the response
+    async def query_stream(self, query, modelID, kbId=None, temperature=0.1, topp=0.5, topk=50, maxtokens=10000, numberOfResults=5,
+                           retrieve_fn=None, sign_citations=True, use_cache=True, trace_file=None, conversation=None, **trace_attributes):
+        """Like query(), as an async generator of events: {'text': fragment}
+        for each fragment of the response, then the dictionary query() returns
+        with the full 'result'. Cached answers are sent as a single fragment."""
+        async with self.query_slots:
+            self.active_queries += 1
+            self.num_queries += 1
+            start_time = time.perf_counter()
+            generation_params = {"temperature": temperature, "top_p": topp, "top_k": topk, "max_tokens": maxtokens}
+            trace_context, trace = self._begin_trace(trace_file, model=modelID, rag=kbId is not None, stream=True, **trace_attributes)
+            try:
+                history, retrieval_query = await self._get_history(trace_context, conversation, query)
+                # Answers to follow-up questions depend on the history
+                use_cache = use_cache and not history
+                cached_response = await self._call(trace_context, self._cache_get, use_cache, query, modelID, kbId, generation_params)
+                signing = None
+                if cached_response:
+                    result, citations = cached_response['result'], cached_response['citations']
+                    yield {'text': result}
+                else:
+                    prompt, citations = history + query, []
+                    if kbId is not None:
+                        retrievalResults = await self._call(trace_context, eda_assistant_query_engine.retrieve_results, retrieval_query, kbId, numberOfResults, retrieve_fn)
+                        prompt, retrievalResults = await self._call(trace_context, eda_assistant_query_engine.build_rag_prompt, query, retrievalResults, modelID, maxtokens, history)
+                        citations = eda_assistant_bedrock_api.get_citation_uris(retrievalResults)
+                    if sign_citations and citations:
+                        signing = asyncio.ensure_future(self._call(trace_context, self._sign_citations, citations))
+                    text_stream = await self._call(trace_context, lambda: eda_assistant_tracing.trace_stream(
+                        eda_assistant_bedrock_api.get_bedrock_response_stream(prompt, modelID, temperature, topp, topk, maxtokens), model=modelID))
+                    fragments = []
+                    while True:
+                        text = await self._call(trace_context, next, text_stream, None)
+                        if text is None:
+                            break
+                        fragments.append(text)
+                        yield {'text': text}
+                    result = "".join(fragments)
+                    if use_cache and self.response_cache:
+                        await self._call(trace_context, self._cache_put, query, modelID, result, citations, kbId, generation_params)
+                if signing is not None:
+                    reference_urls = await signing
+                elif sign_citations and citations:
+                    reference_urls = await self._call(trace_context, self._sign_citations, citations)
+                else:
+                    reference_urls = []
+            except BaseException as e:
+                trace.root.status = "ERROR"
+                trace.root.set_attributes(error=str(e) or type(e).__name__)
+                raise
+            finally:
+                trace.end()
+                self.active_queries -= 1
+        if conversation:
+            self._add_turn(conversation, query, result)
+
+        yield {
+            'result': result,
+            'usage': None,
+            'citations': citations,
+            'reference_urls': reference_urls,
+            'cached': cached_response['match'] if cached_response else None,
+            'latency_s': round(time.perf_counter() - start_time, 3),
+            'phases_ms': {phase: round(seconds * 1000, 1) for phase, seconds in trace.get_phase_timings().items()},
+            'trace': trace,
+        }
+
+    ## Use the engine from other threads
+    def run(self, coroutine):
+        """Run a coroutine on the engine's loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def iter_sync(self, async_iterator):
+        """Iterate an async generator, such as query_stream(), from another thread."""
+        try:
+            while True:
+                try:
+                    yield self.run(async_iterator.__anext__())
+                except StopAsyncIteration:
+                    return
+        except GeneratorExit:
+            # Abandoned by the caller (a Streamlit rerun), release the query slot now
+            self.run(async_iterator.aclose())
+            raise
+
+    def get_stats(self):
+        return {"active_queries": self.active_queries, "queries": self.num_queries,
+                "max_queries": self.max_queries, "max_workers": self.max_workers}
+
+
+## One engine per process, shared by every caller
+def get_shared_engine(max_workers=default_max_workers, max_queries=default_max_queries, response_cache=None):
+    """Return the process-wide engine, created with these arguments on first use."""
+    global shared_engine
+    with shared_engine_lock:
+        if shared_engine is None:
+            shared_engine = AsyncQueryEngine(max_workers, max_queries, response_cache)
+        return shared_engine
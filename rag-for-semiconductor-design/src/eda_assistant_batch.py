@@ -0,0 +1,123 @@
+## Batch evaluation of a prompt file
+import os
+import json
+import time
+import asyncio
+import eda_assistant_async_engine
+import eda_assistant_bedrock_calls
+
+
+## Read prompts from a JSON or text file
+def load_batch_prompts(path):
+    """Read prompts from a batch file.
+
+    Args:
+    path: A .json file holding a dictionary of id to prompt (like
+        eda_assistant_sample_questions.json), a list of prompts or a list of
+        {"id": ..., "prompt": ...} objects. Any other file is read as one
+        prompt per non-empty line.
+
+    Returns:
+    A list of (id, prompt) tuples.
+    """
+    with open(path, 'r', encoding="utf-8") as file:
+        if not path.endswith(".json"):
+            return [(str(i + 1), line.strip()) for i, line in enumerate(file) if line.strip()]
+        prompts = json.load(file)
+
+    if isinstance(prompts, dict):
+        return [(str(prompt_id), prompt) for prompt_id, prompt in prompts.items()]
+    batch_prompts = []
+    for i, prompt in enumerate(prompts):
+        if isinstance(prompt, dict):
+            batch_prompts.append((str(prompt.get("id", i + 1)), prompt["prompt"]))
+        else:
+            batch_prompts.append((str(i + 1), prompt))
+    return batch_prompts
+
+
+## Answer a single batch prompt
+async def run_batch_prompt(engine, prompt_id, prompt, modelID, kbId, temperature, topp, topk, maxtokens, numberOfResults=5, retrieve_fn=None, trace_file=None):
+    """Answer one prompt with RAG if kbId is given, otherwise with the base FM.
+    retrieve_fn replaces the knowledge base, see eda_assistant_query_engine.
+
+    Returns:
+    A result dictionary with the answer, citations, token counts, latency and
+    the milliseconds spent in each phase. Errors are recorded in the result
+    instead of raised.
+    """
+    result = {"id": prompt_id, "prompt": prompt, "modelid": modelID, "kbid": kbId}
+    start_time = time.perf_counter()
+    try:
+        # Batch answers are always generated, citations are reported unsigned
+        response = await engine.query(prompt, modelID, kbId, temperature, topp, topk, maxtokens, numberOfResults, retrieve_fn,
+                                      sign_citations=False, use_cache=False, trace_file=trace_file, mode="batch", prompt_id=prompt_id)
+        result.update({"answer": response['result'], "citations": response['citations'],
+                       "input_tokens": response['usage']['input_tokens'], "output_tokens": response['usage']['output_tokens'], "error": None})
+        result["phases_ms"] = response['phases_ms']
+    except Exception as e:
+        result.update({"answer": None, "citations": [], "input_tokens": None, "output_tokens": None, "error": str(e)})
+        result["phases_ms"] = {}
+    result["latency_s"] = round(time.perf_counter() - start_time, 3)
+    return result
+
+
+## Answer every prompt of a batch file concurrently, write JSONL results
+def run_batch(path, output_path, modelID, kbId, temperature, topp, topk, maxtokens, workers=4, numberOfResults=5, retrieve_fn=None, trace_file=None, engine=None):
+    """Run the prompts of a batch file through the query engine, at most
+    workers prompts at a time.
+
+    Results are written to output_path as JSON lines in the order of the batch
+    file, each as soon as it and all earlier prompts are answered.
+
+    Returns:
+    The number of prompts that failed.
+    """
+    engine = engine or eda_assistant_async_engine.get_shared_engine()
+    batch_prompts = load_batch_prompts(path)
+    print(f"-I- Running {len(batch_prompts)} prompts with {workers} workers...")
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    start_time = time.perf_counter()
+    num_failed = 0
+    phase_timings = {}
+
+    async def run_batch_prompts():
+        prompt_slots = asyncio.Semaphore(workers)
+
+        async def run_prompt(prompt_id, prompt):
+            async with prompt_slots:
+                return await run_batch_prompt(engine, prompt_id, prompt, modelID, kbId, temperature, topp, topk, maxtokens, numberOfResults, retrieve_fn, trace_file)
+        tasks = [asyncio.ensure_future(run_prompt(prompt_id, prompt)) for prompt_id, prompt in batch_prompts]
+        for task in tasks:
+            yield await task
+
+    with open(output_path, 'w', encoding="utf-8") as output_file:
+        for result in engine.iter_sync(run_batch_prompts()):
+            output_file.write(json.dumps(result) + "\n")
+            output_file.flush()
+            for phase, milliseconds in result["phases_ms"].items():
+                phase_timings.setdefault(phase, []).append(milliseconds)
+            if result["error"]:
+                num_failed += 1
+                print(f"-E- Prompt {result['id']} failed: {result['error']}")
+            else:
+                print(f"-I- Prompt {result['id']} answered in {result['latency_s']}s")
+
+    elapsed = time.perf_counter() - start_time
+    print(f"-I- Batch finished in {elapsed:.2f}s, {len(batch_prompts) - num_failed} answered, {num_failed} failed")
+    print("-I- Results written to ", output_path)
+
+    # Latency percentiles per phase, to see which phase drives the tail
+    print(f"\n{'phase':<16}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for phase, timings in phase_timings.items():
+        timings.sort()
+        p50 = timings[len(timings) // 2]
+        p95 = timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))]
+        print(f"{phase:<16}{len(timings):>6}{p50:>10.1f}{p95:>10.1f}{timings[-1]:>10.1f}")
+
+    # Retries and throttles explain tail latency that the phases alone do not
+    print()
+    print(eda_assistant_bedrock_calls.format_metrics())
+    return num_failed
@@ -1,24 +1,62 @@
 import boto3
 import json
 import sys
+import functools
+import threading
 import eda_assistant_model_options
+import eda_assistant_bedrock_calls
+import eda_assistant_tokens
+import eda_assistant_tracing
 from botocore.client import Config
-from anthropic_bedrock import AnthropicBedrock
+from botocore.exceptions import ClientError
 
 
 ## -- Bedrock Config
-bedrock_config = Config(connect_timeout=120, read_timeout=120, retries={'max_attempts': 0})
-bedrock_client = boto3.client('bedrock-runtime')
-bedrock_agent_client = boto3.client('bedrock-agent')
-bedrock_agent_client_runtime = boto3.client("bedrock-agent-runtime", config=bedrock_config)
-configured_region = boto3.Session().region_name
+# Clients are created on first use so each mode only pays for the clients it calls.
+# Retries, pacing and circuit breaking are done by eda_assistant_bedrock_calls, botocore
+# retries are off so a throttled request is not retried by both layers.
+bedrock_config = Config(connect_timeout=10, read_timeout=120, retries={'mode': 'standard', 'total_max_attempts': 1},
+                        max_pool_connections=50, tcp_keepalive=True)
 supported_regions = ['us-west-2', 'us-east-1']
 endpoint_url_dict = {'us-west-2' : 'https://bedrock.us-west-2.amazonaws.com/', 
                      'us-east-1' : 'https://bedrock.us-east-1.amazonaws.com/' }
+# boto3 client creation is not thread safe, batch workers may race on first use
+client_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def get_bedrock_client():
+    with client_lock:
+        return boto3.client('bedrock-runtime', config=bedrock_config)
+
+
+# bedrock-runtime client for libraries that invoke models themselves, e.g. LangChain
+@functools.lru_cache(maxsize=None)
+def get_rate_limited_bedrock_client():
+    return eda_assistant_bedrock_calls.RateLimitedClient(get_bedrock_client())
+
+
+@functools.lru_cache(maxsize=None)
+def get_bedrock_agent_client():
+    with client_lock:
+        return boto3.client('bedrock-agent', config=bedrock_config)
+
+
+@functools.lru_cache(maxsize=None)
+def get_bedrock_agent_runtime_client():
+    with client_lock:
+        return boto3.client("bedrock-agent-runtime", config=bedrock_config)
+
+
+@functools.lru_cache(maxsize=None)
+def get_configured_region():
+    return boto3.Session().region_name
+
 
 # Check if the configured region is supported for the Bedrock service
 def check_bedrock_region():
     try:
+        configured_region = get_configured_region()
         # Check if the configured region is available for the Bedrock service
         if configured_region in supported_regions:
             print(f"-I- The configured region ({configured_region}) is available for Amazon Bedrock.")
@@ -28,7 +66,7 @@ def check_bedrock_region():
                 print(f"-I- {region}")
             sys.exit(1)
 
-    except bedrock_client.exceptions.ClientError as e:
+    except ClientError as e:
         print(f"-E- Error: {e}")
         print("-E- Please check your AWS credentials and ensure you have the necessary permissions.")
         sys.exit(1)
@@ -44,7 +82,7 @@ def retrieve(query, kbId, numberOfResults=5):
     Returns:
     Retrieve Response
     """
-    return bedrock_agent_client_runtime.retrieve(
+    return eda_assistant_bedrock_calls.call_bedrock("Retrieve", "retrieve", lambda: get_bedrock_agent_runtime_client().retrieve(
         retrievalQuery= {
             'text': query
         },
@@ -55,7 +93,37 @@ def retrieve(query, kbId, numberOfResults=5):
                 'overrideSearchType': "HYBRID", # optional
             }
         }
-    )
+    ))
+
+
+# Identify the last completed sync of a knowledge base
+def get_kb_sync_version(kbId):
+    """Get a version string that changes whenever a knowledge base is re-synced.
+
+    Args:
+    kbId: Knowledge Base ID
+
+    Returns:
+    The latest completed ingestion job ID and time of each data source, or
+    None if the ingestion jobs cannot be listed.
+    """
+    try:
+        versions = []
+        data_sources = get_bedrock_agent_client().list_data_sources(knowledgeBaseId=kbId)['dataSourceSummaries']
+        for data_source in data_sources:
+            ingestion_jobs = get_bedrock_agent_client().list_ingestion_jobs(
+                knowledgeBaseId=kbId,
+                dataSourceId=data_source['dataSourceId'],
+                filters=[{'attribute': 'STATUS', 'operator': 'EQ', 'values': ['COMPLETE']}],
+                sortBy={'attribute': 'STARTED_AT', 'order': 'DESCENDING'},
+                maxResults=1
+            )['ingestionJobSummaries']
+            for job in ingestion_jobs:
+                versions.append(f"{data_source['dataSourceId']}:{job['ingestionJobId']}:{job['updatedAt'].isoformat()}")
+        return ",".join(sorted(versions))
+    except ClientError as e:
+        print(f"-W- Could not get knowledge base sync version: {e}")
+        return None
 
 
 # Queries a knowledge base and generates responses based on the retrieved results. 
@@ -70,8 +138,8 @@ def retrieveAndGenerate(input, kbId, model_id):
     Returns:
     RAG Response
     """
-    model_arn = f'arn:aws:bedrock:{configured_region}::foundation-model/{model_id}'
-    return bedrock_agent_client_runtime.retrieve_and_generate(
+    model_arn = f'arn:aws:bedrock:{get_configured_region()}::foundation-model/{model_id}'
+    return eda_assistant_bedrock_calls.call_bedrock("RetrieveAndGenerate", "retrieve", lambda: get_bedrock_agent_runtime_client().retrieve_and_generate(
         input={
             'text': input
         },
@@ -88,19 +156,31 @@ def retrieveAndGenerate(input, kbId, model_id):
             }
         }
 
-    )
+    ))
     
 
 # Get response from Bedrock, return text output without metadata
 def get_bedrock_response(query, modelID, temperature, topp, topk, maxtokens):
+    output_text, usage = get_bedrock_response_and_usage(query, modelID, temperature, topp, topk, maxtokens)
+    return output_text
+
+
+# Get response from Bedrock, return text output and token usage
+def get_bedrock_response_and_usage(query, modelID, temperature, topp, topk, maxtokens):
+    """Generate a response and report the tokens Bedrock billed for it.
+
+    Returns:
+    A tuple of the output text and a dictionary with 'input_tokens' and
+    'output_tokens' (None if Bedrock did not report them).
+    """
     prompt_payload = get_model_prompt_payload(query, modelID, temperature, topp, topk, maxtokens)
+    prompt_tokens = check_prompt_budget(query, modelID, maxtokens)
 
-    #TODO: Add error handling incase it cant connect to endpoint
-    response = bedrock_client.invoke_model(body=prompt_payload,
+    response = eda_assistant_bedrock_calls.call_bedrock("InvokeModel", modelID, lambda: get_bedrock_client().invoke_model(body=prompt_payload,
                             modelId=modelID,
                             accept='application/json',
                             contentType = 'application/json'   
-                            )
+                            ), tokens=get_quota_tokens(prompt_tokens, maxtokens))
     
     response_body = json.loads(response.get("body").read())    
 
@@ -111,7 +191,71 @@ def get_bedrock_response(query, modelID, temperature, topp, topk, maxtokens):
     else:
         output_text = response_body.get('results')[0].get('outputText')
 
-    return output_text
+    headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    usage = {
+        'input_tokens': int(headers['x-amzn-bedrock-input-token-count']) if 'x-amzn-bedrock-input-token-count' in headers else None,
+        'output_tokens': int(headers['x-amzn-bedrock-output-token-count']) if 'x-amzn-bedrock-output-token-count' in headers else None
+    }
+    return output_text, usage
+
+
+# Stream response from Bedrock, yield text as it is generated
+def get_bedrock_response_stream(query, modelID, temperature, topp, topk, maxtokens):
+    """Generate a response with invoke_model_with_response_stream.
+
+    Args:
+    query: Prompt to send to the model
+    modelID: LLM specific Model identifier
+    temperature, topp, topk, maxtokens: Model parameters
+
+    Returns:
+    A generator of text fragments in the order the model produces them.
+    The token budget is checked right away, the request is sent when the
+    first fragment is read.
+    """
+    prompt_payload = get_model_prompt_payload(query, modelID, temperature, topp, topk, maxtokens)
+    prompt_tokens = check_prompt_budget(query, modelID, maxtokens)
+    return get_bedrock_response_stream_chunks(prompt_payload, modelID, get_quota_tokens(prompt_tokens, maxtokens))
+
+
+def get_bedrock_response_stream_chunks(prompt_payload, modelID, quota_tokens=0):
+    # Only opening the stream is retried, an error in the middle of a response is raised
+    response = eda_assistant_bedrock_calls.call_bedrock("InvokeModelWithResponseStream", modelID, lambda: get_bedrock_client().invoke_model_with_response_stream(body=prompt_payload,
+                            modelId=modelID,
+                            accept='application/json',
+                            contentType = 'application/json'
+                            ), tokens=quota_tokens)
+
+    for event in response.get("body"):
+        chunk = event.get("chunk")
+        if not chunk:
+            continue
+        chunk_body = json.loads(chunk.get("bytes"))
+
+        if modelID in eda_assistant_model_options.anthropic_models:
+            output_text = chunk_body.get('delta', {}).get('text') if chunk_body.get('type') == 'content_block_delta' else None
+        elif modelID in eda_assistant_model_options.mistral_models:
+            output_text = chunk_body.get('outputs')[0]['text']
+        else:
+            output_text = chunk_body.get('outputText')
+
+        if output_text:
+            yield output_text
+
+
+# Count prompt tokens locally and refuse prompts that overflow the context window
+def check_prompt_budget(query, modelID, maxtokens):
+    prompt = query
+    if modelID in eda_assistant_model_options.anthropic_models:
+        prompt = get_system_prompt(modelID) + "\n\n" + query
+    prompt_tokens = eda_assistant_tokens.check_token_budget(prompt, modelID, maxtokens)
+    eda_assistant_tracing.set_attributes(prompt_tokens_local=prompt_tokens)
+    return prompt_tokens
+
+
+# Tokens a request takes from the tokens per minute quota, Bedrock counts the prompt and the output
+def get_quota_tokens(prompt_tokens, maxtokens):
+    return prompt_tokens + min(maxtokens, eda_assistant_tokens.max_reserved_output_tokens)
 
 
 # List All Foundational Models available in your AWS account
@@ -121,6 +265,7 @@ def get_available_bedrock_models():
     Returns:
         A list of available bedrock models.
     """
+    configured_region = get_configured_region()
     bedrock = boto3.client(service_name='bedrock',
                        region_name=configured_region,
                        endpoint_url=endpoint_url_dict[configured_region])
@@ -136,6 +281,17 @@ def get_contexts(retrievalResults):
     return contexts
 
 
+# Fetch unique S3 source URIs from the response, in retrieval order
+def get_citation_uris(retrievalResults):
+    citation_uris = []
+    for retrievedResult in retrievalResults:
+        s3_uri = retrievedResult.get('location', {}).get('s3Location', {}).get('uri')
+        if s3_uri and s3_uri not in citation_uris:
+            citation_uris.append(s3_uri)
+
+    return citation_uris
+
+
 # Get specific instructions for llm
 def get_system_prompt (modelID):
     system_prompt = "You are an expert in semiconductor chip design and electronic design automation. Your goal is to provide informative and substantive responses to assist in semiconductor design engineering. You are to respond in markdown format. If you dont know the exact answer, just say you don't know. Do not make up an answer"
@@ -168,23 +324,18 @@ def get_model_prompt_payload(prompt_body, modelID, temperature, top_p, top_k, ma
 
     elif modelID in eda_assistant_model_options.mistral_models:
         mistral_prompt = prompt_body
-        user_prompt_obj = {"prompt": mistral_prompt,
+        user_prompt_obj = json.dumps({"prompt": mistral_prompt,
                            "max_tokens": max_tokens,
                            "temperature": temperature
-        }
+        })
 
     else: #default                                   
-        user_prompt_obj = {"inputText": prompt_body,
+        user_prompt_obj = json.dumps({"inputText": prompt_body,
                         "textGenerationConfig": {
                         "maxTokenCount": max_tokens,
                         "stopSequences": [],
                         "temperature":0,
                         "topP":1
                             },
-                        }
-    return user_prompt_obj
-
-#Get Native Token Client
-# For counting tokens. TODO: Make generic to model 
-def get_token_client():
-    return AnthropicBedrock()
\ No newline at end of file
+                        })
+    return user_prompt_obj
\ No newline at end of file
@@ -0,0 +1,277 @@
+## Shared call layer for Bedrock requests
+# Every invoke_model, retrieve and retrieve_and_generate call goes through
+# call_bedrock(), which
+# - waits for the model's token buckets, sized to the account's requests and
+#   tokens per minute quotas, so concurrent users queue instead of failing,
+# - lowers the bucket rates when Bedrock throttles and restores them as
+#   calls succeed (additive increase, multiplicative decrease),
+# - retries throttling and transient errors with full jitter backoff,
+# - stops calling a model for a while after repeated failures (circuit
+#   breaker) so a struggling endpoint fails fast,
+# - counts calls, retries, throttles and failures per operation and model.
+import json
+import time
+import random
+import threading
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, ReadTimeoutError
+import eda_assistant_model_options
+import eda_assistant_tokens
+import eda_assistant_tracing
+
+# Error codes worth retrying after a backoff
+retryable_error_codes = ['ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException',
+                         'ModelNotReadyException', 'InternalServerException', 'ModelTimeoutException']
+throttling_error_codes = ['ThrottlingException', 'TooManyRequestsException']
+max_attempts = 6
+backoff_base = 0.5
+backoff_cap = 20.0
+# Seconds of quota a bucket can hold, the largest burst it lets through at once
+burst_seconds = 10
+# Rates never drop below this fraction of the quota
+min_rate_fraction = 0.05
+circuit_failure_threshold = 5
+circuit_reset_timeout = 30.0
+
+
+class CircuitOpenError(Exception):
+    """Calls to a model are suspended after repeated failures."""
+
+
+class TokenBucket:
+    """Blocking token bucket whose refill rate adapts to throttling."""
+
+    def __init__(self, per_minute):
+        self.max_rate = per_minute / 60.0
+        self.rate = self.max_rate
+        self.capacity = self.max_rate * burst_seconds
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        """Wait until amount tokens are available and take them.
+
+        Returns:
+        The seconds spent waiting.
+        """
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def throttled(self):
+        with self.lock:
+            self._refill()
+            self.rate = max(self.max_rate * min_rate_fraction, self.rate * 0.5)
+
+    def succeeded(self):
+        with self.lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.02)
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failed requests and lets one
+    trial request through once reset_timeout has passed."""
+
+    def __init__(self, failure_threshold=circuit_failure_threshold, reset_timeout=circuit_reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self, name):
+        """Raise CircuitOpenError while the circuit is open.
+
+        Returns:
+        True for the trial request of a half-open circuit, which must record
+        its outcome without retrying.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_running:
+                raise CircuitOpenError(f"Calls to {name} are suspended after {self.failures} consecutive failures, retry in {self.reset_timeout:.0f}s")
+            self.trial_running = True
+            return True
+
+    def release_trial(self):
+        """End a request whose error says nothing about the endpoint's health,
+        such as a throttle or a validation error, without recording an outcome."""
+        with self.lock:
+            self.trial_running = False
+
+    def record(self, success):
+        with self.lock:
+            self.trial_running = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+
+
+class ModelLimiter:
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.circuit = CircuitBreaker()
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+metrics = {}
+metrics_lock = threading.Lock()
+
+
+def get_limiter(model_key):
+    with limiters_lock:
+        if model_key not in limiters:
+            quota = eda_assistant_model_options.bedrock_quotas.get(model_key, eda_assistant_model_options.default_bedrock_quota)
+            limiters[model_key] = ModelLimiter(quota['rpm'], quota.get('tpm'))
+        return limiters[model_key]
+
+
+def _count(operation, model_key, name, value=1):
+    with metrics_lock:
+        counters = metrics.setdefault(f"{operation}:{model_key}", {"calls": 0, "retries": 0, "throttles": 0, "failures": 0, "circuit_open": 0, "wait_s": 0.0})
+        counters[name] += value
+
+
+def get_metrics():
+    """Counters per "operation:model", e.g. calls, retries, throttles, failures."""
+    with metrics_lock:
+        return {key: dict(counters) for key, counters in metrics.items()}
+
+
+def format_metrics():
+    lines = [f"{'call':<72}{'calls':>7}{'retries':>9}{'throttles':>11}{'failures':>10}{'wait s':>9}"]
+    for key, counters in get_metrics().items():
+        lines.append(f"{key:<72}{counters['calls']:>7}{counters['retries']:>9}{counters['throttles']:>11}{counters['failures']:>10}{counters['wait_s']:>9.2f}")
+    return "\n".join(lines)
+
+
+def is_retryable(error):
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in retryable_error_codes
+    return isinstance(error, (BotocoreConnectionError, ReadTimeoutError))
+
+
+## Call Bedrock through the limiter, retry and circuit breaker of a model
+def call_bedrock(operation, model_key, fn, tokens=0, attempts=max_attempts, last_attempt=True):
+    """Call fn() for a Bedrock operation on model_key.
+
+    Args:
+    operation: Operation name used in metrics, e.g. "InvokeModel".
+    model_key: Model ID, or "retrieve" for knowledge base calls, selects
+        the quota in eda_assistant_model_options.bedrock_quotas.
+    fn: Function sending the request.
+    tokens: Tokens the request is expected to use, taken from the tokens
+        per minute bucket.
+    attempts: Maximum number of calls, 1 for callers with their own retries.
+    last_attempt: False if the caller retries a failure itself. The circuit
+        counts one failure per request, once its retries are exhausted.
+
+    Returns:
+    The result of fn().
+
+    Raises:
+    CircuitOpenError if the model's circuit is open, otherwise the last
+    error once retries are exhausted or the error is not retryable.
+    """
+    limiter = get_limiter(model_key)
+    for attempt in range(attempts):
+        # Checked on every attempt so retries stop as soon as the circuit opens
+        try:
+            trial = limiter.circuit.before_call(model_key)
+        except CircuitOpenError:
+            _count(operation, model_key, "circuit_open")
+            raise
+        waited = limiter.requests.acquire(1)
+        if limiter.tokens is not None and tokens:
+            waited += limiter.tokens.acquire(tokens)
+        _count(operation, model_key, "calls")
+        _count(operation, model_key, "wait_s", waited)
+        try:
+            result = fn()
+        except Exception as e:
+            error_code = e.response.get("Error", {}).get("Code") if isinstance(e, ClientError) else None
+            if error_code in throttling_error_codes:
+                _count(operation, model_key, "throttles")
+                limiter.requests.throttled()
+                if limiter.tokens is not None:
+                    limiter.tokens.throttled()
+            if not is_retryable(e) or attempt == attempts - 1 or trial:
+                # Throttling and errors such as validation failures neither open nor close the
+                # circuit, only server errors and timeouts count as failures and successes close it
+                if error_code in throttling_error_codes or not is_retryable(e):
+                    limiter.circuit.release_trial()
+                elif last_attempt or trial:
+                    limiter.circuit.record(False)
+                _count(operation, model_key, "failures")
+                raise
+            _count(operation, model_key, "retries")
+            eda_assistant_tracing.set_attributes(retries=attempt + 1)
+            time.sleep(random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt)))
+        else:
+            limiter.requests.succeeded()
+            if limiter.tokens is not None:
+                limiter.tokens.succeeded()
+            limiter.circuit.record(True)
+            return result
+
+
+## Bedrock runtime client for libraries that call it directly
+class RateLimitedClient:
+    """Wraps a bedrock-runtime client so model invocations made by other
+    libraries (LangChain BedrockChat) go through call_bedrock() too."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def invoke_model(self, **kwargs):
+        return call_bedrock("InvokeModel", kwargs.get("modelId"), lambda: self.client.invoke_model(**kwargs),
+                            tokens=get_request_tokens(kwargs.get("body", ""), kwargs.get("modelId")))
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        return call_bedrock("InvokeModelWithResponseStream", kwargs.get("modelId"),
+                            lambda: self.client.invoke_model_with_response_stream(**kwargs),
+                            tokens=get_request_tokens(kwargs.get("body", ""), kwargs.get("modelId")))
+
+
+def get_request_tokens(body, modelID):
+    """Tokens an invoke_model request body takes from the tokens per minute
+    quota: its prompt plus the requested maximum output, which Bedrock
+    reserves when the request starts."""
+    try:
+        request = json.loads(body)
+    except (TypeError, ValueError):
+        return len(body or "") // 4
+    # Anthropic messages, or the prompt of the other model families
+    texts = [request.get("system"), request.get("prompt"), request.get("inputText")]
+    for message in request.get("messages", []):
+        content = message.get("content")
+        texts.extend([content] if isinstance(content, str) else [part.get("text") for part in content or [] if isinstance(part, dict)])
+    prompt_tokens = eda_assistant_tokens.count_tokens("\n".join(text for text in texts if isinstance(text, str)), modelID)
+    max_output_tokens = (request.get("max_tokens") or request.get("max_tokens_to_sample") or request.get("max_gen_len")
+                         or request.get("textGenerationConfig", {}).get("maxTokenCount") or 0)
+    return prompt_tokens + max_output_tokens
@@ -2,10 +2,8 @@
 import sys
 import json
 import os
-import platform
-from weakref import ref
-import pandas as pd
-import streamlit as st
+import itertools
+import functools
 
 # Check major and minor version
 if sys.version_info.major == 3 and sys.version_info.minor < 11:
@@ -15,9 +13,27 @@ if sys.version_info.major == 3 and sys.version_info.minor < 11:
 
 #Import eda_assistant modules
 import eda_assistant_arg
+import eda_assistant_utils
+
+#Time the imports below and any done lazily while answering
+if eda_assistant_arg.args.profile_startup:
+    eda_assistant_utils.ImportProfiler().install()
+
 import eda_assistant_bedrock_api
+import eda_assistant_bedrock_calls
 import eda_assistant_presigned_url
 import eda_assistant_langchain_api
+import eda_assistant_query_engine
+import eda_assistant_faiss_index
+import eda_assistant_doc_loader
+import eda_assistant_response_cache
+import eda_assistant_batch
+import eda_assistant_async_engine
+import eda_assistant_conversation
+import eda_assistant_tracing
+import eda_assistant_tokens
+import eda_assistant_model_options
+import eda_assistant_reranker
 
 
 #TODO:
@@ -25,21 +41,107 @@ import eda_assistant_langchain_api
 
 
 ## -- Defaults
-num_retrieve_results = 5
+num_retrieve_results = eda_assistant_arg.args.num_results
 modelID= 'anthropic.claude-3-haiku-20240307-v1:0' if not eda_assistant_arg.args.modelid else eda_assistant_arg.args.modelid.strip()
 default_prompt = "Write a verilog code to swap contents of two registers with and without a temporary register"
 src_code_dir = os.path.dirname(os.path.abspath(__file__))
-os_platform = platform.system()
-supported_os_platforms_tokenclient = ["Linux", "Darwin"]
-tokenclient = eda_assistant_bedrock_api.get_token_client()
+# Chat messages kept and redrawn by the web UI
+max_chat_messages = 50
 user_prompt = ""
 
+#Override the context budget of the model
+if eda_assistant_arg.args.context_budget:
+    eda_assistant_model_options.context_budgets[modelID] = eda_assistant_arg.args.context_budget
+
+#Number of passages retrieved and reranked before keeping the best num_retrieve_results
+eda_assistant_reranker.num_candidates = eda_assistant_arg.args.rerank_candidates
+
+#Override the conversation history budget of the model
+if eda_assistant_arg.args.history_budget:
+    eda_assistant_model_options.history_budgets[modelID] = eda_assistant_arg.args.history_budget
+
 #Check if Bedrock Region is supported
 check_region = eda_assistant_bedrock_api.check_bedrock_region()
 
 
+# Streamlit reruns this script on every interaction, the web UI keeps clients,
+# retrievers and caches across reruns and sessions until they are cleared
+def cache_resource(fn):
+    if eda_assistant_arg.args.webui:
+        import streamlit as st
+        return st.cache_resource(show_spinner=False)(fn)
+    return functools.lru_cache(maxsize=None)(fn)
+
+#OpenSearch k-NN index, retrieved from instead of a knowledge base
+opensearch_client = None
+opensearch_index = eda_assistant_arg.args.opensearch_index
+opensearch_filters = json.loads(eda_assistant_arg.args.opensearch_filter) if eda_assistant_arg.args.opensearch_filter else None
+opensearch_embeddings_modelid = 'amazon.titan-embed-text-v1'
+if opensearch_index:
+    import eda_assistant_opensearch_api
+    if not eda_assistant_arg.args.opensearch_url and not eda_assistant_arg.args.opensearch_domain:
+        print("\n-E- Please provide --opensearch_url or --opensearch_domain to use an OpenSearch index")
+        sys.exit(1)
+    print("-I- OpenSearch index selected: ", opensearch_index)
+
+
+@cache_resource
+def get_opensearch_client():
+    opensearch_password = os.environ.get('OPENSEARCH_PASSWORD')
+    if eda_assistant_arg.args.opensearch_url:
+        return eda_assistant_opensearch_api.get_opensearch_client_from_url(eda_assistant_arg.args.opensearch_url, eda_assistant_arg.args.opensearch_user, opensearch_password)
+    return eda_assistant_opensearch_api.get_opensearch_cluster_client(eda_assistant_arg.args.opensearch_domain, opensearch_password, eda_assistant_bedrock_api.get_configured_region())
+
+
+if opensearch_index:
+    opensearch_client = get_opensearch_client()
+
+
+# Get a function retrieving from the OpenSearch index for the RAG query engine
+@cache_resource
+def get_opensearch_retrieve_fn():
+    if not eda_assistant_opensearch_api.check_opensearch_index(opensearch_client, opensearch_index):
+        print(f"\n-E- OpenSearch index {opensearch_index} does not exist, build it with --docchain --filepath")
+        sys.exit(1)
+    embeddings = eda_assistant_langchain_api.create_langchain_vector_embedding_using_bedrock(opensearch_embeddings_modelid, eda_assistant_arg.args.embedding_cache, eda_assistant_arg.args.embedding_concurrency)
+    return eda_assistant_opensearch_api.get_opensearch_retrieve_fn(opensearch_client, opensearch_index, embeddings, opensearch_filters, eda_assistant_arg.args.opensearch_hybrid)
+
+
+# Version of the knowledge base or OpenSearch index behind cached responses
+def get_retrieval_source_version(kb_id):
+    if kb_id.startswith("opensearch:"):
+        return eda_assistant_opensearch_api.get_opensearch_index_version(opensearch_client, opensearch_index)
+    return eda_assistant_bedrock_api.get_kb_sync_version(kb_id)
+
+
+#Response cache, answers repeated questions without calling the model
+@cache_resource
+def get_response_cache():
+    if eda_assistant_arg.args.no_response_cache:
+        return None
+    cache_embed_fn = None
+    if eda_assistant_arg.args.semantic_cache:
+        cache_embed_fn = eda_assistant_langchain_api.create_langchain_vector_embedding_using_bedrock('amazon.titan-embed-text-v1', eda_assistant_arg.args.embedding_cache).embed_query
+    return eda_assistant_response_cache.ResponseCache(eda_assistant_arg.args.response_cache, eda_assistant_arg.args.cache_ttl, eda_assistant_arg.args.cache_max_entries, cache_embed_fn, eda_assistant_arg.args.semantic_cache_threshold, get_retrieval_source_version)
+
+
+response_cache = get_response_cache()
+
+
+# Query engine answering the web UI, batch and --serve queries on a bounded pool of threads
+def get_query_engine():
+    query_engine = eda_assistant_async_engine.get_shared_engine(eda_assistant_arg.args.query_workers, eda_assistant_arg.args.max_queries, response_cache)
+    # Follow the response cache if the web UI cleared and recreated it
+    query_engine.response_cache = response_cache
+    return query_engine
+
+
 ## -- Streamlit code - GUI Mode
 if eda_assistant_arg.args.webui: 
+    # Only the web UI needs streamlit and pandas
+    import pandas as pd
+    import streamlit as st
+
     st.set_page_config(page_title="EDA Engineering Assistant", page_icon=":trackball:", initial_sidebar_state="auto")
     st.header(":trackball: EDA Engineering Assistant")
     st.subheader("Ask questions pertaining to Digital Design, Analog design, EDA Software Tools")
@@ -55,6 +157,25 @@ if eda_assistant_arg.args.webui:
         key='temperature'
     )   
 
+    stream_response = st.sidebar.checkbox("Stream response", value=True)
+
+    if response_cache:
+        cache_stats = response_cache.get_stats()
+        st.sidebar.caption(f"Response cache: {cache_stats['entries']} entries, hits/misses {cache_stats['total']}")
+
+    # Clients, retrievers and cached data are kept across reruns, rebuild them e.g. after re-indexing
+    if st.sidebar.button("Reload resources"):
+        st.cache_resource.clear()
+        st.cache_data.clear()
+        eda_assistant_langchain_api.clear_langchain_caches()
+
+    # Timed phases of the last query
+    trace_placeholder = st.sidebar.empty()
+    if 'last_trace_rows' in st.session_state:
+        with trace_placeholder.container():
+            st.caption("Last query trace")
+            st.dataframe(pd.DataFrame(st.session_state['last_trace_rows'], columns=["Phase", "ms", "Attributes"]), hide_index=True)
+
     # Default Settings
     model_topp = eda_assistant_arg.args.top_p
     model_topk = eda_assistant_arg.args.top_k
@@ -79,33 +200,44 @@ if eda_assistant_arg.args.webui:
     selected_option_rag = st.sidebar.selectbox("Select a model query approach:", ["RAG", "Base-FM"])
     st.write("You selected:", selected_option_rag)
 
-    #Select Knowledge Base 
-    kbid = st.sidebar.text_input(
-        "Please enter Knowledge Base ID 👇",
-        label_visibility=st.session_state.visibility,
-        disabled=st.session_state.disabled,
-        key= "kbid_input"
-    )
+    #Select Knowledge Base, or retrieve from the OpenSearch index given on the command line
+    retrieve_fn = None
+    if opensearch_index:
+        kbid = "opensearch:" + opensearch_index
+        st.sidebar.caption(f"Retrieving from OpenSearch index {opensearch_index}")
+        if "RAG" in selected_option_rag:
+            retrieve_fn = get_opensearch_retrieve_fn()
+    else:
+        kbid = st.sidebar.text_input(
+            "Please enter Knowledge Base ID 👇",
+            label_visibility=st.session_state.visibility,
+            disabled=st.session_state.disabled,
+            key= "kbid_input"
+        )
 
-    if st.session_state.kbid_input != "":
-        print("-I- Selected KBID: ", kbid)
-        st.write("Knowledge Base ID you provided:", kbid)
+        if st.session_state.kbid_input != "":
+            print("-I- Selected KBID: ", kbid)
+            st.write("Knowledge Base ID you provided:", kbid)
 
     # Accept user input through the text box
-    if "Base-FM" in selected_option_rag and st.session_state.kbid_input == "":
+    if "Base-FM" in selected_option_rag and (st.session_state.kbid_input == "" or opensearch_index):
         user_prompt = st.chat_input("Ask something...")
-    elif "RAG" in selected_option_rag and st.session_state.kbid_input != "":
+    elif "RAG" in selected_option_rag and (st.session_state.kbid_input != "" or opensearch_index):
         user_prompt = st.chat_input("Ask something...")
     else:
         st.error('You must provide a Knowledge Base ID if you have selected RAG mode', icon="🚨")    
 
-    #Sample Question List
+    #Sample Question List, read again only when the file changes
+    @st.cache_data(show_spinner=False)
+    def get_sample_prompts(path, mtime):
+        with open(path, 'r', encoding="utf-8") as file:
+            example_questions = json.load(file)
+            question_list = [q for q in example_questions.values()]
+        return pd.DataFrame(question_list, columns=['Prompt'])
+
     st.markdown("##### Sample Prompts: ")
-    with open(os.path.join(src_code_dir, 'eda_assistant_sample_questions.json'), 'r', encoding="utf-8") as file:
-        example_questions = json.load(file)
-        question_list = [q for q in example_questions.values()]
-    
-    df = pd.DataFrame(question_list, columns=['Prompt'])
+    sample_questions_path = os.path.join(src_code_dir, 'eda_assistant_sample_questions.json')
+    df = get_sample_prompts(sample_questions_path, os.path.getmtime(sample_questions_path))
 
     # Display the DataFrame in Streamlit
     st.table(df)
@@ -117,7 +249,15 @@ if eda_assistant_arg.args.webui:
         st.session_state.messages = [{"role": "assistant", "content": "How may I help you?"}]
 
 
-    # Display chat messages from history on app rerun
+    # Conversation sent with each question, recent turns and a summary of older ones
+    if "conversation" not in st.session_state or st.session_state.conversation.modelID != modelID:
+        st.session_state.conversation = eda_assistant_conversation.Conversation(modelID)
+    if st.sidebar.button("New conversation"):
+        st.session_state.messages = []
+        st.session_state.conversation = eda_assistant_conversation.Conversation(modelID)
+
+    # Display chat messages from history on app rerun, keeping the most recent ones
+    del st.session_state.messages[:-max_chat_messages]
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
@@ -134,50 +274,58 @@ if eda_assistant_arg.args.webui:
 
         # Display assistant response in chat message container
         with st.chat_message("user"):
-            with st.spinner("Thinking..."):
-
-                print("-I- GUI Prompt: ", user_prompt)
-                if "RAG" in selected_option_rag:
-
-                    print("-I- Model Temperature provided: ", model_temp)
-
-                    retrieve_response = eda_assistant_bedrock_api.retrieve(user_prompt, kbid, 5)
-                    retrievalResults = retrieve_response['retrievalResults']
-                    retriever = eda_assistant_langchain_api.get_langchain_kb_retriever(kbid)
-                    docs = retriever.get_relevant_documents(query=user_prompt)
-                
-                    context = eda_assistant_bedrock_api.get_contexts(retrievalResults)
-                    model_payload, model_prompt = eda_assistant_langchain_api.get_langchain_model_prompt(context, user_prompt, model_temp, eda_assistant_arg.args.tokens, model_topp, model_topk, modelID)
-
-                    retrieval_result = eda_assistant_langchain_api.get_langchain_retrievalqa(modelID, retriever, docs, model_prompt, user_prompt)
-                    generated_text = retrieval_result['result']
-                    citations = retrieval_result["source_documents"]
-
-
-                    if len(retrieval_result["source_documents"]) > 0 and len(retrieval_result["source_documents"][0].metadata) > 0:
-                        for x in range(len(retrieval_result["source_documents"][0].metadata)):
-                            metadata_tag = retrieval_result["source_documents"][x].metadata
-                            s3_uri = metadata_tag["location"]["s3Location"]["uri"]
-                            temp_s3_url = eda_assistant_presigned_url.create_presigned_url(s3_uri)
-                            ref_urls.append(temp_s3_url) 
-
+            print("-I- GUI Prompt: ", user_prompt)
+            rag_kbid = kbid if "RAG" in selected_option_rag else None
+            print("-I- RAG mode selected..." if rag_kbid else "-I- No RAG mode selected...")
+            print("-I- Model Temperature provided: ", model_temp)
+            query_args = {"kbId": rag_kbid, "temperature": model_temp, "topp": model_topp, "topk": model_topk, "maxtokens": eda_assistant_arg.args.tokens,
+                          "numberOfResults": num_retrieve_results, "retrieve_fn": retrieve_fn, "trace_file": eda_assistant_arg.args.trace_file, "conversation": st.session_state.conversation, "mode": "webui"}
+
+            # TODO: Fix citations GUI output
+            message_placeholder = st.empty()
+            citation_placeholder = st.empty()
+
+            # The query engine is shared by all sessions, this script thread only waits for the answer
+            query_engine = get_query_engine()
+            try:
+                if stream_response:
+                    query_events = query_engine.iter_sync(query_engine.query_stream(user_prompt, modelID, **query_args))
+                    with st.spinner("Thinking..."):
+                        first_event = next(query_events)
+
+                    # Update the message as text arrives from the model
+                    streamed_text = ""
+                    for query_event in itertools.chain([first_event], query_events):
+                        if 'text' in query_event:
+                            streamed_text += query_event['text']
+                            message_placeholder.markdown(streamed_text + "▌")
+                        else:
+                            query_response = query_event
                 else:
-                    print("-I- No RAG mode selected...")
-                    generated_text = eda_assistant_bedrock_api.get_bedrock_response(user_prompt, modelID, model_temp, model_topp, model_topk, eda_assistant_arg.args.tokens)
-                                             
-                # TODO: Fix citations GUI output
-                message_placeholder = st.empty()
-                citation_placeholder = st.empty()
-                message_placeholder.markdown(generated_text)
-
-                if not eda_assistant_arg.args.noref:
-                    if len(ref_urls) > 0:
-                        unique_list = set(ref_urls)
-                        ref_url_md = "\n".join(unique_list)
-                        markdown_string = "###### References:\n\n"
-                        for url in unique_list:
-                            markdown_string += f"- {url}\n"
-                        citation_placeholder.markdown(markdown_string)
+                    with st.spinner("Thinking..."):
+                        query_response = query_engine.run(query_engine.query(user_prompt, modelID, **query_args))
+            except (eda_assistant_tokens.TokenBudgetError, eda_assistant_bedrock_calls.CircuitOpenError) as e:
+                print("-E-", e)
+                message_placeholder.error(str(e), icon="🚨")
+                st.stop()
+
+            if query_response['cached']:
+                print(f"-I- Using cached response ({query_response['cached']} match)")
+            generated_text = query_response['result']
+            ref_urls = query_response['reference_urls']
+            message_placeholder.markdown(generated_text)
+
+            st.session_state['last_trace_rows'] = query_response['trace'].get_rows()
+            with trace_placeholder.container():
+                st.caption("Last query trace")
+                st.dataframe(pd.DataFrame(st.session_state['last_trace_rows'], columns=["Phase", "ms", "Attributes"]), hide_index=True)
+
+            if not eda_assistant_arg.args.noref:
+                if len(ref_urls) > 0:
+                    markdown_string = "###### References:\n\n"
+                    for url in ref_urls:
+                        markdown_string += f"- {url}\n"
+                    citation_placeholder.markdown(markdown_string)
 
         # Add assistant response to chat history
         st.session_state.messages.append({"role": "assistant", "content": generated_text })
@@ -192,7 +340,6 @@ elif eda_assistant_arg.args.docchain:
     #   This is just to demonstrate ability to source docs from file systems.
     #   Only works in CLI mode.
     #   TODO: test on FSX Netapp Ontap and FSX OpenZFS
-    #   TODO: improve performance on the FAISS vector store creation. Do not create it if its already there.
     
     print("\n-I- Document Chain mode selected...")
     print("-I- ModelID selected: ", modelID)
@@ -204,44 +351,126 @@ elif eda_assistant_arg.args.docchain:
         print("\n-E- Please provide a Knowledge Base ID to run in RAG mode")
         sys.exit(1)
 
-    # Get raw docs
-    print("-I- Getting raw documents from filepath...")
     if not os.path.exists(eda_assistant_arg.args.filepath):
         print("\n-E- Filepath does not exist, please ensure path is valida and user has permissions to access.")
         sys.exit(1)
 
-    filedata = eda_assistant_langchain_api.get_langchain_docs_fs(eda_assistant_arg.args.filepath)
-    
-    # Split into chunks
-    print("-I- Splitting documents into chunks...")
     chunksize = 1000
-    documents = eda_assistant_langchain_api.get_langchain_split_chunks(filedata, chunksize)
- 
+    embeddings_modelid = 'amazon.titan-embed-text-v1'
+
     # Get embeddings
     print("-I- Creating embeddings model...")
-    embeddings_modelid = 'amazon.titan-embed-text-v1'
-    embeddings = eda_assistant_langchain_api.create_langchain_vector_embedding_using_bedrock(embeddings_modelid)
+    embeddings = eda_assistant_langchain_api.create_langchain_vector_embedding_using_bedrock(embeddings_modelid, eda_assistant_arg.args.embedding_cache, eda_assistant_arg.args.embedding_concurrency)
+
+    if opensearch_index:
+        # Ingest into OpenSearch if the index is missing or a rebuild is requested
+        index_exists = eda_assistant_opensearch_api.check_opensearch_index(opensearch_client, opensearch_index)
+        if eda_assistant_arg.args.reindex or not index_exists:
+            if index_exists:
+                eda_assistant_opensearch_api.delete_opensearch_index(opensearch_client, opensearch_index)
+            print("-I- Creating OpenSearch index ", opensearch_index)
+            eda_assistant_opensearch_api.create_index(opensearch_client, opensearch_index, embeddings_modelid)
+            # Stream parsed files through the splitter into the bulk indexer
+            file_docs = eda_assistant_doc_loader.iter_documents(eda_assistant_arg.args.filepath, cache_path=eda_assistant_arg.args.parse_cache, workers=eda_assistant_arg.args.parse_workers, include_globs=eda_assistant_arg.args.include_glob, exclude_globs=eda_assistant_arg.args.exclude_glob)
+            chunks = (chunk for relpath, docs in file_docs if docs for chunk in eda_assistant_langchain_api.get_langchain_split_chunks(docs, chunksize))
+            actions = eda_assistant_opensearch_api.generate_opensearch_actions(opensearch_index, chunks, embeddings)
+            indexed, failed = eda_assistant_opensearch_api.put_streaming_bulk_in_opensearch(opensearch_client, actions)
+            if failed:
+                print(f"-W- {len(failed)} chunks could not be indexed")
+            opensearch_client.indices.refresh(index=opensearch_index)
+        print("-I- OpenSearch Index Size - ", opensearch_client.count(index=opensearch_index)['count'])
+
+        # Retriever
+        print("-I- Creating retriever...")
+        retriever = eda_assistant_langchain_api.get_langchain_opensearch_retriever(opensearch_client, opensearch_index, embeddings, max(num_retrieve_results, eda_assistant_reranker.num_candidates), filters=opensearch_filters, hybrid=eda_assistant_arg.args.opensearch_hybrid)
 
-    # Get Vector Store
-    print("-I- Creating & indexing vector store...")
-    vectorstore = eda_assistant_langchain_api.get_langchain_faiss_vector_store(documents, embeddings)
-    print("-I- FAISS Index Size - ", vectorstore.index.ntotal)
+    else:
+        # Reuse the saved index, re-indexing only files added, changed or removed since the last run
+        faiss_options = {"index_type": eda_assistant_arg.args.faiss_index, "encoding": eda_assistant_arg.args.faiss_encoding, "nlist": eda_assistant_arg.args.faiss_nlist, "pq_m": eda_assistant_arg.args.faiss_pq_m,
+                         "nprobe": eda_assistant_arg.args.faiss_nprobe, "ef_search": eda_assistant_arg.args.faiss_ef_search, "rescore": eda_assistant_arg.args.faiss_rescore}
+        vectorstore = eda_assistant_faiss_index.get_faiss_vector_store(eda_assistant_arg.args.filepath, eda_assistant_arg.args.index_dir, chunksize, embeddings_modelid, embeddings, eda_assistant_arg.args.reindex, eda_assistant_arg.args.parse_cache, eda_assistant_arg.args.parse_workers, eda_assistant_arg.args.include_glob, eda_assistant_arg.args.exclude_glob, faiss_options)
+        if vectorstore is None:
+            print("\n-E- No documents found in filepath.")
+            sys.exit(1)
+        print("-I- FAISS Index Size - ", vectorstore.index.ntotal, vectorstore.index_options.get('factory', 'Flat'))
+
+        # Retriever
+        print("-I- Creating retriever...")
+        retriever = vectorstore.as_retriever(search_kwargs={"k": max(num_retrieve_results, eda_assistant_reranker.num_candidates)})
 
-    # Retriever
-    print("-I- Creating retriever...")
-    retriever = vectorstore.as_retriever()
+    # Earlier turns of the conversation, if one is kept
+    conversation = eda_assistant_conversation.load_conversation(eda_assistant_arg.args.conversation, modelID) if eda_assistant_arg.args.conversation else None
+    history = conversation.get_history_text() if conversation else ""
+
+    # Keep the best documents after local reranking
+    retriever = eda_assistant_langchain_api.get_langchain_reranked_retriever(retriever, num_retrieve_results)
 
     #Generating Prompt Payload
-    model_payload, model_prompt = eda_assistant_langchain_api.get_langchain_model_prompt(documents, query, eda_assistant_arg.args.temperature, eda_assistant_arg.args.tokens, eda_assistant_arg.args.top_p, eda_assistant_arg.args.top_k, modelID)
+    model_payload, model_prompt = eda_assistant_langchain_api.get_langchain_model_prompt([], query, eda_assistant_arg.args.temperature, eda_assistant_arg.args.tokens, eda_assistant_arg.args.top_p, eda_assistant_arg.args.top_k, modelID)
+
+    # Fit the retrieved documents into the model's context budget
+    prompt_overhead_tokens = eda_assistant_tokens.count_tokens(model_prompt.format(context="", question=history + query), modelID)
+    retriever = eda_assistant_langchain_api.get_langchain_packed_retriever(retriever, modelID, eda_assistant_arg.args.tokens, prompt_overhead_tokens)
 
     # Get response
     print("-I- Getting response...")
-    retrieval_result = eda_assistant_langchain_api.get_langchain_retrievalqa(modelID, retriever, documents, model_prompt, query)
-    # retrieval_result_doc = eda_assistant_langchain_api.get_langchain_doc_retrievalqa(modelID, vectorstore, documents, model_prompt, query)
-    response_body = retrieval_result['result']
+    if eda_assistant_arg.args.stream:
+        print("-I- Output Response...\n")
+        response_body, first_token_time = eda_assistant_utils.print_stream(eda_assistant_langchain_api.get_langchain_retrievalqa_stream(modelID, retriever, model_prompt, query, conversation))
+        print(f"\n-I- Time to first token: {first_token_time:.2f}s")
+    else:
+        retrieval_result = eda_assistant_langchain_api.get_langchain_retrievalqa(modelID, retriever, [], model_prompt, query, conversation)
+        # retrieval_result_doc = eda_assistant_langchain_api.get_langchain_doc_retrievalqa(modelID, vectorstore, documents, model_prompt, query)
+        response_body = retrieval_result['result']
 
-    print("-I- Output Response...\n")
-    print(response_body)
+        print("-I- Output Response...\n")
+        print(response_body)
+
+    if conversation:
+        conversation.add_turn(query, response_body)
+        eda_assistant_conversation.save_conversation(conversation, eda_assistant_arg.args.conversation)
+
+
+## -- Query API Mode
+elif eda_assistant_arg.args.serve:
+    print("\n-I- Query API mode selected...")
+    print("-I- Default ModelID: ", modelID)
+    kbid = None
+    retrieve_fn = None
+    if opensearch_index:
+        kbid = "opensearch:" + opensearch_index
+        retrieve_fn = get_opensearch_retrieve_fn()
+    elif eda_assistant_arg.args.kbid:
+        kbid = eda_assistant_arg.args.kbid
+    print("-I- RAG source: ", kbid if kbid else "none, base FM only")
+
+    query_defaults = {"modelID": modelID, "kbId": kbid, "retrieve_fn": retrieve_fn, "temperature": eda_assistant_arg.args.temperature,
+                      "topp": eda_assistant_arg.args.top_p, "topk": eda_assistant_arg.args.top_k, "maxtokens": eda_assistant_arg.args.tokens,
+                      "numberOfResults": num_retrieve_results, "trace_file": eda_assistant_arg.args.trace_file}
+    import eda_assistant_query_server
+    eda_assistant_query_server.serve(get_query_engine(), query_defaults, eda_assistant_arg.args.serve_host, eda_assistant_arg.args.serve_port)
+
+
+## -- Batch Mode
+elif eda_assistant_arg.args.batch:
+    print("\n-I- Batch mode selected...")
+    print("-I- ModelID selected: ", modelID)
+    kbid = None
+    retrieve_fn = None
+    if not eda_assistant_arg.args.norag:
+        print("-I- RAG mode selected...")
+        if opensearch_index:
+            kbid = "opensearch:" + opensearch_index
+            retrieve_fn = get_opensearch_retrieve_fn()
+        elif eda_assistant_arg.args.kbid is None:
+            print("\n-E- Please provide a Knowledge Base ID to run in RAG mode")
+            sys.exit(1)
+        else:
+            kbid = eda_assistant_arg.args.kbid
+
+    batch_output = eda_assistant_arg.args.batch_output if eda_assistant_arg.args.batch_output else os.path.splitext(eda_assistant_arg.args.batch)[0] + "_results.jsonl"
+    num_failed = eda_assistant_batch.run_batch(eda_assistant_arg.args.batch, batch_output, modelID, kbid, eda_assistant_arg.args.temperature, eda_assistant_arg.args.top_p, eda_assistant_arg.args.top_k, eda_assistant_arg.args.tokens, eda_assistant_arg.args.batch_workers, num_retrieve_results, retrieve_fn, eda_assistant_arg.args.trace_file, get_query_engine())
+    sys.exit(1 if num_failed else 0)
 
 
 ##CLI Mode
@@ -253,48 +482,95 @@ else:
 
     print("-I- User Prompt: ", query) 
 
-    if os_platform in supported_os_platforms_tokenclient:
-        prompt_tokens = tokenclient.count_tokens(query)
-        print("-I- No. of input prompt tokens:", prompt_tokens)
+    print("-I- No. of input prompt tokens:", eda_assistant_tokens.count_tokens(query, modelID))
     
-    if eda_assistant_arg.args.norag:
-        response_body = eda_assistant_bedrock_api.get_bedrock_response(query, modelID, eda_assistant_arg.args.temperature, eda_assistant_arg.args.top_p, eda_assistant_arg.args.top_k, eda_assistant_arg.args.tokens)
-
-    else:
+    kbid = None
+    retrieve_fn = None
+    if not eda_assistant_arg.args.norag:
         print("-I- RAG mode selected...")
-        if eda_assistant_arg.args.kbid is None:
+        if opensearch_index:
+            kbid = "opensearch:" + opensearch_index
+            retrieve_fn = get_opensearch_retrieve_fn()
+        elif eda_assistant_arg.args.kbid is None:
             print("\n-E- Please provide a Knowledge Base ID to run in RAG mode")
             sys.exit(1)
         else:
             kbid = eda_assistant_arg.args.kbid
 
-        retrieve_response = eda_assistant_bedrock_api.retrieve(query, kbid, 5)
-        retrievalResults = retrieve_response['retrievalResults']
-        retriever = eda_assistant_langchain_api.get_langchain_kb_retriever(kbid)
-        docs = retriever.get_relevant_documents(query=query)
-        context = eda_assistant_bedrock_api.get_contexts(retrievalResults)
-        model_payload, model_prompt = eda_assistant_langchain_api.get_langchain_model_prompt(context, query, eda_assistant_arg.args.temperature, eda_assistant_arg.args.tokens, eda_assistant_arg.args.top_p, eda_assistant_arg.args.top_k, modelID)
-        retrieval_result = eda_assistant_langchain_api.get_langchain_retrievalqa(modelID, retriever, docs, model_prompt, query)
-        response_body = retrieval_result['result']
-        citations = retrieval_result["source_documents"]
+    trace = eda_assistant_tracing.begin_trace("query", eda_assistant_arg.args.trace_file, mode="cli", model=modelID, rag=kbid is not None)
+
+    # Earlier turns of the conversation, answers to follow-up questions are not cached
+    conversation = eda_assistant_conversation.load_conversation(eda_assistant_arg.args.conversation, modelID) if eda_assistant_arg.args.conversation else None
+    history = conversation.get_history_text() if conversation else ""
+    if history:
+        response_cache = None
+    generation_params = {"temperature": eda_assistant_arg.args.temperature, "top_p": eda_assistant_arg.args.top_p, "top_k": eda_assistant_arg.args.top_k, "max_tokens": eda_assistant_arg.args.tokens}
+    with eda_assistant_tracing.span("cache_lookup"):
+        cached_response = response_cache.get(query, modelID, kbid, generation_params) if response_cache else None
+        eda_assistant_tracing.set_attributes(hit=cached_response['match'] if cached_response else False)
+    stream_response = eda_assistant_arg.args.stream and cached_response is None
+    citations = []
+
+    try:
+        if cached_response:
+            print(f"-I- Using cached response ({cached_response['match']} match)")
+            response_body = cached_response['result']
+            citations = cached_response['citations']
+
+        elif eda_assistant_arg.args.norag and stream_response:
+            response_body = eda_assistant_tracing.trace_stream(eda_assistant_bedrock_api.get_bedrock_response_stream(history + query, modelID, eda_assistant_arg.args.temperature, eda_assistant_arg.args.top_p, eda_assistant_arg.args.top_k, eda_assistant_arg.args.tokens), model=modelID)
+
+        elif eda_assistant_arg.args.norag:
+            with eda_assistant_tracing.span("generate", model=modelID):
+                response_body, usage = eda_assistant_bedrock_api.get_bedrock_response_and_usage(history + query, modelID, eda_assistant_arg.args.temperature, eda_assistant_arg.args.top_p, eda_assistant_arg.args.top_k, eda_assistant_arg.args.tokens)
+                eda_assistant_tracing.set_attributes(**usage)
 
-        if len(retrieval_result["source_documents"]) > 0 and len(retrieval_result["source_documents"][0].metadata) > 0:
-            for x in range(len(retrieval_result["source_documents"][0].metadata)):
-                metadata_tag = retrieval_result["source_documents"][x].metadata
-                s3_uri = metadata_tag["location"]["s3Location"]["uri"]
-                temp_s3_url = eda_assistant_presigned_url.create_presigned_url(s3_uri)
-                ref_urls.append(temp_s3_url)
+        else:
+            rag_response = eda_assistant_query_engine.get_rag_response(query, kbid, modelID, eda_assistant_arg.args.temperature, eda_assistant_arg.args.top_p, eda_assistant_arg.args.top_k, eda_assistant_arg.args.tokens, num_retrieve_results, stream_response, retrieve_fn, conversation)
+            response_body = rag_response['result']
+            citations = rag_response['citations']
+    except (eda_assistant_tokens.TokenBudgetError, eda_assistant_bedrock_calls.CircuitOpenError) as e:
+        print("\n-E-", e)
+        sys.exit(1)
+
+    with eda_assistant_tracing.span("sign_citations", citations=len(citations)):
+        ref_urls = eda_assistant_presigned_url.create_presigned_urls(citations)
 
 
     print("-I- Output Response...\n")
-    print(response_body)
+    if stream_response:
+        response_body, first_token_time = eda_assistant_utils.print_stream(response_body)
+    else:
+        print(response_body)
+
+    if response_cache and cached_response is None:
+        with eda_assistant_tracing.span("cache_store"):
+            response_cache.put(query, modelID, response_body, citations, kbid, generation_params)
+    if conversation:
+        conversation.add_turn(query, response_body)
+    trace.end()
+    if conversation:
+        eda_assistant_conversation.save_conversation(conversation, eda_assistant_arg.args.conversation)
 
     if not eda_assistant_arg.args.noref:
             
         if len(ref_urls) > 0:
             print("\n-I- Reference URLs: ")
-            for refurl in set(ref_urls):
+            for refurl in ref_urls:
                 print("-I-", refurl)
 
-    if os_platform in supported_os_platforms_tokenclient:
-        print("\n-I- No. of output tokens: ", tokenclient.count_tokens(response_body)) 
\ No newline at end of file
+    if stream_response:
+        print(f"\n-I- Time to first token: {first_token_time:.2f}s")
+
+    if response_cache:
+        cache_stats = response_cache.get_stats()
+        print("\n-I- Response cache hits/misses (this run): ", cache_stats['session'])
+        print("-I- Response cache hits/misses (all runs): ", cache_stats['total'])
+
+    print("\n-I- No. of output tokens: ", eda_assistant_tokens.count_tokens(response_body, modelID))
+
+    if eda_assistant_arg.args.trace_summary:
+        print("\n-I- Query trace:")
+        print(trace.format_summary())
+        print("\n-I- Bedrock calls:")
+        print(eda_assistant_bedrock_calls.format_metrics()) 
\ No newline at end of file
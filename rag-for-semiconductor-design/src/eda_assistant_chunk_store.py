@@ -0,0 +1,213 @@
+## On-disk chunk store addressed by vector ID
+# Replaces the pickled InMemoryDocstore of LangChain's FAISS store, which
+# deserializes every chunk into Python objects on load and keeps them all
+# resident. A saved store is
+#   chunks.txt           the chunk texts back to back, UTF-8
+#   chunk_offsets.npy    int64 start of each chunk in chunks.txt, plus the end
+#   chunk_ids.npy        fixed width docstore ID of each chunk
+#   chunk_metadata.json  metadata fields: integer columns, or a table of
+#                        distinct values for the others (sources, languages)
+#   chunk_metadata.npy   one column per field, the integer or the value code
+# all memory-mapped on load, so opening an index reads almost nothing and a
+# search reads only the rows of the chunks it returns. Row i is the chunk of
+# vector i in the FAISS index. Metadata values of None are not stored.
+import os
+import json
+import mmap
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+
+TEXT_FILE = "chunks.txt"
+OFFSETS_FILE = "chunk_offsets.npy"
+IDS_FILE = "chunk_ids.npy"
+METADATA_FILE = "chunk_metadata.json"
+METADATA_COLUMNS_FILE = "chunk_metadata.npy"
+# Missing value of a metadata column, integer columns store the value itself
+missing_value = np.iinfo(np.int64).min
+
+
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value != missing_value
+
+
+class ChunkStore(Docstore):
+    """Chunk texts and metadata by row, memory-mapped once loaded.
+
+    Rows loaded from disk stay on disk, deletes only drop them from the row
+    selection and added chunks are kept in memory until the next save().
+    """
+
+    def __init__(self):
+        self.text = b""
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.ids = np.zeros(0, dtype="S1")
+        self.fields = []
+        self.columns = np.zeros((0, 0), dtype=np.int64)
+        # Selected rows of the loaded store, then the added (id, document) pairs
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.added = []
+        self.row_by_id = None
+
+    def __len__(self):
+        return len(self.rows) + len(self.added)
+
+    ## Read chunks
+    def get_id(self, i):
+        if i < len(self.rows):
+            return self.ids[self.rows[i]].decode("utf-8")
+        return self.added[i - len(self.rows)][0]
+
+    def get_document(self, i):
+        """The document of row i, reading only its text and metadata."""
+        if i >= len(self.rows):
+            return self.added[i - len(self.rows)][1]
+        row = self.rows[i]
+        text = self.text[self.offsets[row]:self.offsets[row + 1]].decode("utf-8")
+        metadata = {}
+        for (name, values), value in zip(self.fields, self.columns[:, row].tolist()):
+            if value == missing_value:
+                continue
+            metadata[name] = value if values is None else values[value]
+        return Document(page_content=text, metadata=metadata)
+
+    def get_column(self, name):
+        """Values of a metadata field for every row, e.g. the sources."""
+        field_names = [field_name for field_name, _ in self.fields]
+        if name in field_names:
+            values = self.fields[field_names.index(name)][1]
+            column = self.columns[field_names.index(name)][self.rows].tolist()
+            loaded = [None if value == missing_value else value if values is None else values[value] for value in column]
+        else:
+            loaded = [None] * len(self.rows)
+        return loaded + [doc.metadata.get(name) for _, doc in self.added]
+
+    def search(self, search):
+        """Document of a docstore ID, for LangChain code addressing chunks by ID."""
+        if self.row_by_id is None:
+            self.row_by_id = {self.get_id(i): i for i in range(len(self))}
+        if search not in self.row_by_id:
+            return f"ID {search} not found."
+        return self.get_document(self.row_by_id[search])
+
+    ## Change chunks
+    def add_documents(self, ids, documents):
+        self.added.extend(zip(ids, documents))
+        self.row_by_id = None
+
+    def keep(self, positions):
+        """Keep the chunks at positions, in that order, and drop the others."""
+        positions = np.asarray(positions, dtype=np.int64)
+        num_loaded = len(self.rows)
+        self.added = [self.added[i - num_loaded] for i in positions[positions >= num_loaded].tolist()]
+        self.rows = self.rows[positions[positions < num_loaded]]
+        self.row_by_id = None
+
+    def delete(self, ids):
+        delete_ids = set(ids)
+        self.keep([i for i in range(len(self)) if self.get_id(i) not in delete_ids])
+
+    ## Create a store from documents
+    @classmethod
+    def from_documents(cls, ids, documents):
+        store = cls()
+        store.add_documents(ids, documents)
+        return store
+
+    ## Save and load
+    def save(self, folder_path):
+        """Write the selected and added chunks to folder_path, which must not be
+        the folder the store was loaded from: its files are still mapped."""
+        # Texts of loaded rows are copied in runs of consecutive rows
+        offsets = [0]
+        with open(os.path.join(folder_path, TEXT_FILE), "wb") as f:
+            if len(self.rows):
+                run_starts = np.flatnonzero(np.diff(self.rows, prepend=-2) != 1)
+                for start, end in zip(run_starts, np.append(run_starts[1:], len(self.rows))):
+                    first_row, last_row = self.rows[start], self.rows[end - 1]
+                    f.write(self.text[self.offsets[first_row]:self.offsets[last_row + 1]])
+                    offsets.extend((self.offsets[first_row + 1:last_row + 2] - self.offsets[first_row] + offsets[-1]).tolist())
+            for _, doc in self.added:
+                text = doc.page_content.encode("utf-8")
+                f.write(text)
+                offsets.append(offsets[-1] + len(text))
+        np.save(os.path.join(folder_path, OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+        ids = [self.get_id(i).encode("utf-8") for i in range(len(self))]
+        np.save(os.path.join(folder_path, IDS_FILE), np.array(ids, dtype=f"S{max(map(len, ids), default=1)}"))
+
+        # Columns are encoded again so value tables only hold values still in use
+        field_names = [name for name, _ in self.fields]
+        for _, doc in self.added:
+            field_names.extend(name for name in doc.metadata if name not in field_names)
+        fields = []
+        columns = np.full((len(field_names), len(self)), missing_value, dtype=np.int64)
+        for column, name in enumerate(field_names):
+            values = self.get_column(name)
+            if all(value is None or is_integer(value) for value in values):
+                columns[column] = [missing_value if value is None else value for value in values]
+                fields.append({"name": name, "values": None})
+                continue
+            codes = {}
+            table = []
+            for i, value in enumerate(values):
+                if value is None:
+                    continue
+                key = json.dumps(value, default=str, sort_keys=True)
+                if key not in codes:
+                    codes[key] = len(table)
+                    table.append(json.loads(key))
+                columns[column, i] = codes[key]
+            fields.append({"name": name, "values": table})
+        np.save(os.path.join(folder_path, METADATA_COLUMNS_FILE), columns)
+        with open(os.path.join(folder_path, METADATA_FILE), "w", encoding="utf-8") as f:
+            json.dump({"fields": fields}, f)
+
+    @classmethod
+    def load(cls, folder_path):
+        """Memory-map a store written by save()."""
+        store = cls()
+        text_path = os.path.join(folder_path, TEXT_FILE)
+        if os.path.getsize(text_path):
+            with open(text_path, "rb") as f:
+                store.text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        store.offsets = np.load(os.path.join(folder_path, OFFSETS_FILE), mmap_mode="r")
+        store.ids = np.load(os.path.join(folder_path, IDS_FILE), mmap_mode="r")
+        store.columns = np.load(os.path.join(folder_path, METADATA_COLUMNS_FILE), mmap_mode="r")
+        with open(os.path.join(folder_path, METADATA_FILE), "r", encoding="utf-8") as f:
+            store.fields = [(field["name"], field["values"]) for field in json.load(f)["fields"]]
+        store.rows = np.arange(len(store.ids), dtype=np.int64)
+        return store
+
+    @staticmethod
+    def exists(folder_path):
+        return os.path.exists(os.path.join(folder_path, IDS_FILE))
+
+
+class ChunkIdView:
+    """index_to_docstore_id of LangChain's FAISS store, read from a ChunkStore."""
+
+    def __init__(self, chunk_store):
+        self.chunk_store = chunk_store
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self.chunk_store):
+            raise KeyError(i)
+        return self.chunk_store.get_id(i)
+
+    def __len__(self):
+        return len(self.chunk_store)
+
+    def __iter__(self):
+        return iter(range(len(self.chunk_store)))
+
+    def __contains__(self, i):
+        return isinstance(i, (int, np.integer)) and 0 <= i < len(self.chunk_store)
+
+    def keys(self):
+        return range(len(self.chunk_store))
+
+    def values(self):
+        return [self.chunk_store.get_id(i) for i in range(len(self.chunk_store))]
+
+    def items(self):
+        return [(i, self.chunk_store.get_id(i)) for i in range(len(self.chunk_store))]
@@ -0,0 +1,232 @@
+## Structure aware chunking of HDL, TCL/SDC and Liberty files
+# Files are split on module, process and command boundaries instead of a fixed
+# number of characters, so a chunk never ends in the middle of an always block
+# or a TCL command. Units are packed into chunks up to a token budget and only
+# units larger than the budget are split further, first on inner boundaries
+# (always/process/pin blocks) and then on lines.
+import os
+import re
+
+# File extension to language
+language_extensions = {
+    ".v": "verilog", ".vh": "verilog", ".vams": "verilog",
+    ".sv": "systemverilog", ".svh": "systemverilog",
+    ".vhd": "vhdl", ".vhdl": "vhdl",
+    ".tcl": "tcl", ".sdc": "tcl", ".xdc": "tcl", ".upf": "tcl", ".cpf": "tcl",
+    ".lib": "liberty",
+}
+
+verilog_top = re.compile(r"^\s*(?:(?:virtual|static|automatic|extern)\s+)*(module|macromodule|interface|package|program|class|primitive|config|checker)\s+(?:(?:automatic|static)\s+)?(\w+)")
+verilog_inner = re.compile(r"^\s*(always_ff|always_comb|always_latch|always|initial|final|assign|generate|covergroup|property|sequence|function|task)\b(?:.*?\bbegin\s*:\s*(\w+)|\s+(?:(?:automatic|static|virtual)\s+)*(?:[\w:\[\]\s]+?\s+)?(\w+)\s*[(;])?")
+vhdl_top = re.compile(r"^\s*(entity|architecture|package\s+body|package|configuration|context)\s+(\w+)", re.IGNORECASE)
+vhdl_inner = re.compile(r"^\s*(?:(\w+)\s*:\s*)?(process|block|(?:for|if)\b.*?\bgenerate|(?:pure\s+|impure\s+)?function|procedure)\b\s*(\w+)?", re.IGNORECASE)
+tcl_command = re.compile(r"^\s*(proc|namespace\s+eval)\s+(\S+)|^\s*([A-Za-z_][\w:.-]*)")
+liberty_top = re.compile(r"^\s*(cell|operating_conditions|lu_table_template|power_lut_template|type)\s*\(\s*\"?([^\")\s]*)")
+liberty_inner = re.compile(r"^\s*(pin|bus|bundle|pg_pin|ff|latch|statetable|leakage_power|test_cell)\s*\(\s*\"?([^\")\s]*)")
+
+comment_prefixes = {"verilog": ("//", "/*", "*"), "systemverilog": ("//", "/*", "*"), "vhdl": ("--",), "tcl": ("#",), "liberty": ("/*", "*", "//")}
+
+
+## Detect the language of a file from its extension
+def get_file_language(file_path):
+    """Return the structured language of a file, or None for documents that
+    should be split as prose."""
+    return language_extensions.get(os.path.splitext(str(file_path))[1].lower())
+
+
+## Approximate token count
+def estimate_tokens(text):
+    """Count words and punctuation, a close match to BPE token counts for code."""
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def _is_comment(line, language):
+    return line.strip().startswith(comment_prefixes[language])
+
+
+def _match_top(line, language):
+    """Return (kind, name) if a top-level unit starts on this line."""
+    if language in ("verilog", "systemverilog"):
+        match = verilog_top.match(line)
+        return (match.group(1), match.group(2)) if match else None
+    if language == "vhdl":
+        match = vhdl_top.match(line)
+        return (match.group(1).lower(), match.group(2)) if match else None
+    if language == "liberty":
+        match = liberty_top.match(line)
+        return (match.group(1), match.group(2)) if match else None
+    match = tcl_command.match(line)
+    if not match:
+        return None
+    if match.group(1):
+        return (match.group(1).split()[0], match.group(2))
+    return ("command", match.group(3))
+
+
+def _match_inner(line, language):
+    """Return (kind, name) if a block inside a unit starts on this line."""
+    if language in ("verilog", "systemverilog"):
+        match = verilog_inner.match(line)
+        return (match.group(1), match.group(2) or match.group(3) or "") if match else None
+    if language == "vhdl":
+        match = vhdl_inner.match(line)
+        return (match.group(2).split()[-1].lower(), match.group(1) or match.group(3) or "") if match else None
+    if language == "liberty":
+        match = liberty_inner.match(line)
+        return (match.group(1), match.group(2)) if match else None
+    return None
+
+
+def _get_boundaries(lines, language, match_fn, start=0):
+    """Find the lines where units start, moving each start up over the
+    comments directly above it so a unit keeps its header comment.
+
+    TCL and Liberty boundaries are only taken outside of braces, and TCL
+    command boundaries never split a backslash continued line.
+    """
+    boundaries = []
+    depth = 0
+    continued = False
+    # Liberty cells live one level below the library group
+    top_depth = 1 if language == "liberty" and match_fn is _match_top else 0
+    for i, line in enumerate(lines):
+        if i >= start and not continued and (language not in ("tcl", "liberty") or depth <= top_depth or match_fn is _match_inner):
+            unit = match_fn(line, language)
+            if unit and not _is_comment(line, language):
+                first = i
+                previous = boundaries[-1][0] if boundaries else -1
+                while first > max(start, previous + 1) and _is_comment(lines[first - 1], language):
+                    first -= 1
+                boundaries.append((first, unit[0], unit[1]))
+        if language in ("tcl", "liberty"):
+            depth += line.count("{") - line.count("}")
+            continued = language == "tcl" and line.rstrip().endswith("\\")
+    return boundaries
+
+
+def _get_units(lines, language, match_fn, line_offset=0, start=0):
+    """Split lines into (kind, name, first line, lines) units at boundaries."""
+    boundaries = _get_boundaries(lines, language, match_fn, start)
+    if not boundaries or boundaries[0][0] > 0:
+        boundaries.insert(0, (0, "header", ""))
+    units = []
+    for (first, kind, name), (next_first, _, _) in zip(boundaries, boundaries[1:] + [(len(lines), None, None)]):
+        if next_first > first:
+            units.append((kind, name, line_offset + first, lines[first:next_first]))
+    return units
+
+
+def _split_lines(unit, chunk_tokens, overlap_lines):
+    """Split a unit without inner boundaries on line boundaries."""
+    kind, name, first_line, lines = unit
+    pieces = []
+    start = 0
+    while start < len(lines):
+        end = start
+        tokens = 0
+        while end < len(lines) and (end == start or tokens + estimate_tokens(lines[end]) <= chunk_tokens):
+            tokens += estimate_tokens(lines[end])
+            end += 1
+        pieces.append((kind, name, first_line + start, lines[start:end]))
+        if end >= len(lines):
+            break
+        # Only overlap pieces long enough that the overlap does not dominate them
+        start = end - overlap_lines if end - start > 2 * overlap_lines else end
+    return pieces
+
+
+def _split_unit(unit, language, chunk_tokens, overlap_lines):
+    """Split a unit larger than the token budget on inner boundaries, then on lines."""
+    kind, name, first_line, lines = unit
+    inner_units = _get_units(lines, language, _match_inner, first_line, start=1)
+    if len(inner_units) <= 1:
+        return _split_lines(unit, chunk_tokens, overlap_lines)
+    pieces = []
+    for inner_kind, inner_name, inner_first_line, inner_lines in inner_units:
+        # The lines before the first inner block are the unit's own header (ports, declarations)
+        inner_unit = (kind if inner_kind == "header" else inner_kind,
+                      name if inner_kind == "header" else f"{name}.{inner_name}" if inner_name else name,
+                      inner_first_line, inner_lines)
+        if estimate_tokens("".join(inner_lines)) > chunk_tokens:
+            pieces.extend(_split_lines(inner_unit, chunk_tokens, overlap_lines))
+        else:
+            pieces.append(inner_unit)
+    return pieces
+
+
+def _get_chunk(units, language):
+    names = []
+    for unit in units:
+        if unit[1] and unit[1] not in names:
+            names.append(unit[1])
+    first_line = units[0][2]
+    text = "".join(line for unit in units for line in unit[3])
+    metadata = {
+        "language": language,
+        "unit_kind": units[0][0] if len({unit[0] for unit in units}) == 1 else "mixed",
+        "unit_name": ", ".join(names),
+        "start_line": first_line + 1,
+        "end_line": first_line + sum(len(unit[3]) for unit in units),
+    }
+    return text, metadata
+
+
+## Split one structured file
+def split_text(text, language, chunk_tokens=256, overlap_lines=2):
+    """Split the text of an HDL, TCL/SDC or Liberty file into chunks.
+
+    Args:
+    text: File contents.
+    language: A language returned by get_file_language().
+    chunk_tokens: Approximate maximum tokens per chunk.
+    overlap_lines: Lines repeated between chunks when a block has to be split
+        on line boundaries.
+
+    Returns:
+    A list of (text, metadata) tuples, the metadata holding the language, the
+    kind and names of the units in the chunk and its 1-based line range.
+    """
+    lines = text.splitlines(keepends=True)
+    pieces = []
+    for unit in _get_units(lines, language, _match_top):
+        if estimate_tokens("".join(unit[3])) > chunk_tokens:
+            pieces.extend(_split_unit(unit, language, chunk_tokens, overlap_lines))
+        else:
+            pieces.append(unit)
+
+    # Pack consecutive small units, e.g. SDC commands, into one chunk
+    chunks = []
+    packed = []
+    packed_tokens = 0
+    for piece in pieces:
+        piece_tokens = estimate_tokens("".join(piece[3]))
+        if packed and (packed_tokens + piece_tokens > chunk_tokens or piece[2] < packed[-1][2] + len(packed[-1][3])):
+            chunks.append(_get_chunk(packed, language))
+            packed, packed_tokens = [], 0
+        packed.append(piece)
+        packed_tokens += piece_tokens
+    if packed:
+        chunks.append(_get_chunk(packed, language))
+    return [(chunk_text, metadata) for chunk_text, metadata in chunks if chunk_text.strip()]
+
+
+## Split LangChain documents of structured files
+def split_documents(docs, chunk_tokens=256, overlap_lines=2):
+    """Split documents loaded from HDL, TCL/SDC and Liberty files.
+
+    Args:
+    docs: A list of LangChain documents whose 'source' metadata has a
+        structured file extension.
+    chunk_tokens, overlap_lines: See split_text().
+
+    Returns:
+    A list of chunk documents carrying the source metadata plus the
+    structural metadata of split_text().
+    """
+    from langchain_core.documents import Document
+    chunks = []
+    for doc in docs:
+        language = get_file_language(doc.metadata.get("source", ""))
+        for chunk_text, metadata in split_text(doc.page_content, language, chunk_tokens, overlap_lines):
+            chunks.append(Document(page_content=chunk_text, metadata={**doc.metadata, **metadata}))
+    return chunks
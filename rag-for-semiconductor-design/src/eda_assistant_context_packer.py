@@ -0,0 +1,111 @@
+## Pack retrieved passages into a token budget
+# Passages are taken in score order. A passage is dropped if most of it is
+# already covered by passages taken before it (duplicates, chunks repeated
+# by the splitter overlap, the same section from two documents), or if it
+# does not fit the remaining budget. The budget is the smaller of the
+# model's configured context budget and what its context window leaves after
+# the question and the reserved response tokens.
+import re
+import eda_assistant_model_options
+import eda_assistant_tokens
+
+shingle_size = 5
+# Passages with at least this fraction of their shingles already taken are dropped
+default_overlap_threshold = 0.8
+# Passages shorter than this after truncation are not worth including
+min_passage_tokens = 50
+
+
+def get_shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= shingle_size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)}
+
+
+def get_context_budget(modelID, maxtokens, prompt_overhead_tokens=0):
+    """Tokens available for passages in a prompt for modelID."""
+    configured_budget = eda_assistant_model_options.context_budgets.get(modelID, eda_assistant_model_options.default_context_budget)
+    window_budget = (eda_assistant_tokens.get_context_window(modelID)
+                     - min(maxtokens, eda_assistant_tokens.max_reserved_output_tokens) - prompt_overhead_tokens)
+    return max(0, min(configured_budget, window_budget))
+
+
+def truncate_to_tokens(text, max_tokens, modelID):
+    """Cut text at a line or word boundary to at most max_tokens."""
+    tokens = eda_assistant_tokens.count_tokens(text, modelID)
+    while tokens > max_tokens and text:
+        text = text[:int(len(text) * max_tokens / tokens * 0.95)]
+        cut = max(text.rfind("\n"), text.rfind(" "))
+        if cut > len(text) // 2:
+            text = text[:cut]
+        tokens = eda_assistant_tokens.count_tokens(text, modelID)
+    return text
+
+
+## Select passages for a prompt
+def pack_passages(passages, modelID, maxtokens, prompt_overhead_tokens=0, overlap_threshold=default_overlap_threshold):
+    """Select and order passages to fit the model's context budget.
+
+    Args:
+    passages: A list of (text, score) tuples, a None score keeps the
+        retrieval order.
+    modelID: LLM specific Model identifier
+    maxtokens: Requested maximum output tokens
+    prompt_overhead_tokens: Tokens of the prompt besides the passages
+        (instructions, question, system prompt).
+    overlap_threshold: Drop passages with at least this fraction of their
+        word shingles already covered by selected passages.
+
+    Returns:
+    A tuple of the selected (index into passages, text) pairs in score order,
+    the text truncated if only part of the best passage fits, and a
+    dictionary of packing statistics.
+    """
+    budget = get_context_budget(modelID, maxtokens, prompt_overhead_tokens)
+    order = sorted(range(len(passages)), key=lambda i: -passages[i][1] if passages[i][1] is not None else 0)
+    selected = []
+    covered = set()
+    used_tokens = 0
+    num_duplicates = 0
+    num_over_budget = 0
+    for i in order:
+        text = passages[i][0]
+        shingles = get_shingles(text)
+        if not shingles or len(shingles & covered) >= overlap_threshold * len(shingles):
+            num_duplicates += 1
+            continue
+        tokens = eda_assistant_tokens.count_tokens(text, modelID)
+        if used_tokens + tokens > budget:
+            remaining = budget - used_tokens
+            # Keep part of the best passage rather than sending no context at all
+            if selected or remaining < min_passage_tokens:
+                num_over_budget += 1
+                continue
+            text = truncate_to_tokens(text, remaining, modelID)
+            tokens = eda_assistant_tokens.count_tokens(text, modelID)
+        selected.append((i, text))
+        covered |= shingles
+        used_tokens += tokens
+
+    stats = {"passages_in": len(passages), "passages_out": len(selected), "duplicates": num_duplicates,
+             "over_budget": num_over_budget, "context_tokens": used_tokens, "budget_tokens": budget}
+    return selected, stats
+
+
+## Pack knowledge base retrieval results
+def pack_retrieval_results(retrievalResults, modelID, maxtokens, prompt_overhead_tokens=0):
+    """Apply pack_passages() to retrievalResults, keeping their format."""
+    passages = [(result['content']['text'], result.get('score')) for result in retrievalResults]
+    selected, stats = pack_passages(passages, modelID, maxtokens, prompt_overhead_tokens)
+    packed = [{**retrievalResults[i], 'content': {**retrievalResults[i]['content'], 'text': text}} for i, text in selected]
+    return packed, stats
+
+
+## Pack LangChain documents
+def pack_documents(docs, modelID, maxtokens, prompt_overhead_tokens=0):
+    """Apply pack_passages() to LangChain documents, scored by their 'score' metadata if any."""
+    passages = [(doc.page_content, doc.metadata.get('score')) for doc in docs]
+    selected, stats = pack_passages(passages, modelID, maxtokens, prompt_overhead_tokens)
+    packed = [docs[i].copy(update={'page_content': text}) for i, text in selected]
+    return packed, stats
@@ -0,0 +1,177 @@
+## Multi-turn conversation memory
+# The most recent turns are sent verbatim, older turns are folded into a
+# rolling summary, so the history sent with each question stays within the
+# model's history budget (eda_assistant_model_options.history_budgets) however
+# long the conversation gets. The summary is updated with one call to the
+# summary model when turns fall out of the verbatim window, after the answer
+# has been shown, so it does not add to the latency of the next question.
+import threading
+import eda_assistant_bedrock_api
+import eda_assistant_context_packer
+import eda_assistant_model_options
+import eda_assistant_tokens
+import eda_assistant_tracing
+
+# Fraction of the history budget kept for the summary, the rest holds recent turns
+summary_fraction = 0.25
+
+
+def get_history_budget(modelID):
+    return eda_assistant_model_options.history_budgets.get(modelID, eda_assistant_model_options.default_history_budget)
+
+
+def format_turns(turns):
+    return "\n\n".join(f"User: {user}\n\nAssistant: {assistant}" for user, assistant in turns)
+
+
+def format_history(summary, turns):
+    history_text = ""
+    if summary:
+        history_text += f"<conversation_summary>\n{summary}\n</conversation_summary>\n\n"
+    if turns:
+        history_text += f"<previous_turns>\n{format_turns(turns)}\n</previous_turns>\n\n"
+    return history_text + "Answer the question below as a follow-up to this conversation.\n\n"
+
+
+## Summarize older turns into the running summary
+def summarize_turns(summary, turns, max_tokens):
+    """Fold turns into summary with the summary model.
+
+    Returns:
+    The updated summary text.
+    """
+    prompt = f"""Update the summary of a conversation between a semiconductor design engineer and an assistant with the turns below.
+Keep the engineer's goals, requirements and decisions, and the names of modules, signals, commands, files and tools that were discussed.
+Leave out pleasantries and code bodies, mention what the code does instead. Answer with the updated summary only, in at most {max_tokens * 3 // 4} words.
+
+<summary>
+{summary}
+</summary>
+
+<turns>
+{format_turns(turns)}
+</turns>"""
+    return eda_assistant_bedrock_api.get_bedrock_response(prompt, eda_assistant_model_options.summary_model, 0.0, 0.5, 50, max_tokens).strip()
+
+
+class Conversation:
+    """History of one chat session, a rolling summary and the recent turns.
+
+    Args:
+    modelID: Model the conversation is with, sets the history budget
+    summarize_fn: Function (summary, turns, max_tokens) -> summary, defaults
+        to summarize_turns()
+    """
+
+    def __init__(self, modelID, summarize_fn=summarize_turns):
+        self.modelID = modelID
+        self.summarize_fn = summarize_fn
+        self.summary = ""
+        self.turns = []
+        self.lock = threading.Lock()
+        # Turn being added in the background by eda_assistant_async_engine
+        self.pending_update = None
+
+    def _count(self, text):
+        return eda_assistant_tokens.count_tokens(text, self.modelID)
+
+    def get_budgets(self):
+        # The tags and instruction around the history count towards the budget too
+        history_budget = get_history_budget(self.modelID) - self._count(format_history("-", [("-", "-")]))
+        summary_budget = int(history_budget * summary_fraction)
+        return summary_budget, history_budget - summary_budget
+
+    ## Record a turn, summarizing turns that no longer fit
+    def add_turn(self, user, assistant):
+        with self.lock:
+            self.turns.append((user, assistant))
+            summary_budget, turns_budget = self.get_budgets()
+            # Keep the newest turns that fit, at least the last one
+            kept_tokens = 0
+            num_kept = 0
+            for turn_user, turn_assistant in reversed(self.turns):
+                turn_tokens = self._count(turn_user) + self._count(turn_assistant)
+                if num_kept and kept_tokens + turn_tokens > turns_budget:
+                    break
+                kept_tokens += turn_tokens
+                num_kept += 1
+            old_turns = self.turns[:-num_kept]
+            if not old_turns:
+                return
+            with eda_assistant_tracing.span("history_compact", turns=len(old_turns)):
+                try:
+                    summary = self.summarize_fn(self.summary, old_turns, summary_budget)
+                except Exception as e:
+                    # Keep the questions at least, the answers are lost
+                    print(f"-W- Could not summarize the conversation: {e}")
+                    summary = "\n".join([self.summary] + [f"The user asked: {user}" for user, _ in old_turns]).strip()
+                self.summary = truncate_start(summary, summary_budget, self.modelID)
+                self.turns = self.turns[-num_kept:]
+
+    ## History block for the prompt
+    def get_history_text(self):
+        """The summary and recent turns to put before the question, or an
+        empty string at the start of the conversation."""
+        with self.lock:
+            if not self.summary and not self.turns:
+                return ""
+            _, turns_budget = self.get_budgets()
+            turns = self.turns
+            # A single turn larger than the budget (a long code answer) is cut
+            if len(turns) == 1 and self._count(format_turns(turns)) > turns_budget:
+                user, assistant = turns[0]
+                turns = [(user, eda_assistant_context_packer.truncate_to_tokens(assistant, max(0, turns_budget - self._count(user)), self.modelID))]
+            return format_history(self.summary, turns)
+
+    ## Retrieval query for a follow-up question
+    def get_retrieval_query(self, query):
+        """A follow-up such as "now make it parameterized" says little on its
+        own, retrieve with the previous question as well."""
+        with self.lock:
+            if not self.turns:
+                return query
+            return self.turns[-1][0] + "\n" + query
+
+    def to_dict(self):
+        with self.lock:
+            return {"model": self.modelID, "summary": self.summary, "turns": [list(turn) for turn in self.turns]}
+
+    @classmethod
+    def from_dict(cls, data, modelID=None, summarize_fn=summarize_turns):
+        conversation = cls(modelID or data.get("model"), summarize_fn)
+        conversation.summary = data.get("summary", "")
+        conversation.turns = [tuple(turn) for turn in data.get("turns", [])]
+        return conversation
+
+
+def truncate_start(text, max_tokens, modelID):
+    """Keep the end of text, the most recent part of a summary, within max_tokens."""
+    tokens = eda_assistant_tokens.count_tokens(text, modelID)
+    while tokens > max_tokens and text:
+        text = text[len(text) - int(len(text) * max_tokens / tokens * 0.95):]
+        cut = min(i for i in (text.find("\n"), text.find(" "), len(text)) if i >= 0)
+        if cut < len(text) // 2:
+            text = text[cut + 1:]
+        tokens = eda_assistant_tokens.count_tokens(text, modelID)
+    return text
+
+
+## Keep a CLI conversation in a JSON file between runs
+def load_conversation(path, modelID):
+    """Read the conversation saved in path, a new one if the file does not
+    exist. A conversation saved with another model keeps its history."""
+    import os
+    import json
+    if not os.path.exists(path):
+        return Conversation(modelID)
+    with open(path, 'r', encoding="utf-8") as file:
+        return Conversation.from_dict(json.load(file), modelID)
+
+
+def save_conversation(conversation, path):
+    import os
+    import json
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding="utf-8") as file:
+        json.dump(conversation.to_dict(), file, indent=1)
@@ -0,0 +1,187 @@
+## Parallel document loading for file system corpora
+# Files are parsed in a process pool, since unstructured is CPU bound and
+# threads are held back by the GIL. Parsed text is cached by file hash so
+# unchanged files are never parsed twice, and documents are yielded file by
+# file so callers can split them without holding the whole corpus in memory.
+import os
+import json
+import time
+import fnmatch
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+#Bump when the loaders change so cached text is parsed again
+PARSER_VERSION = 1
+DEFAULT_INCLUDE_GLOBS = ["**/[!.]*"]
+# Layout databases, waveform dumps and other binaries never hold useful text
+DEFAULT_EXCLUDE_GLOBS = [
+    "*.gds", "*.gds2", "*.gdsii", "*.oas", "*.oasis",
+    "*.vcd", "*.evcd", "*.fsdb", "*.vpd", "*.wlf", "*.trn", "*.dsn", "*.shm", "*.tr0", "*.psf",
+    "*.db", "*.ndm", "*.mw", "*.lef.gz", "*.def.gz", "*.gz", "*.tgz", "*.tar", "*.zip", "*.7z",
+    "*.o", "*.so", "*.a", "*.bin", "*.exe",
+]
+
+
+## Hash a single file
+def get_file_hash(file_path, blocksize=1 << 20):
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+## List the files of a corpus
+def list_files(path, include_globs=None, exclude_globs=None):
+    """List the files below path matching any include glob and no exclude glob.
+
+    Args:
+    path: Path to the file system directory containing the documents.
+    include_globs: Globs relative to path, default every non-hidden file.
+    exclude_globs: Patterns matched against the relative path and the file
+        name, default DEFAULT_EXCLUDE_GLOBS.
+
+    Returns:
+    A sorted list of relative file paths.
+    """
+    include_globs = include_globs or DEFAULT_INCLUDE_GLOBS
+    exclude_globs = DEFAULT_EXCLUDE_GLOBS if exclude_globs is None else exclude_globs
+    relpaths = set()
+    for glob in include_globs:
+        for file_path in Path(path).glob(glob):
+            if not file_path.is_file():
+                continue
+            relpath = str(file_path.relative_to(path))
+            if any(fnmatch.fnmatch(relpath, pattern) or fnmatch.fnmatch(file_path.name, pattern) for pattern in exclude_globs):
+                continue
+            relpaths.add(relpath)
+    return sorted(relpaths)
+
+
+class ParsedTextCache:
+    """SQLite cache of the documents parsed from a file, keyed by file hash."""
+
+    def __init__(self, cache_path):
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self.conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS parsed (file_hash TEXT, parser_version INTEGER, docs TEXT, PRIMARY KEY (file_hash, parser_version))")
+
+    def contains(self, file_hash):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM parsed WHERE file_hash = ? AND parser_version = ?", (file_hash, PARSER_VERSION)).fetchone() is not None
+
+    def get(self, file_hash):
+        with self.lock:
+            row = self.conn.execute("SELECT docs FROM parsed WHERE file_hash = ? AND parser_version = ?", (file_hash, PARSER_VERSION)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, file_hash, docs):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO parsed VALUES (?, ?, ?)", (file_hash, PARSER_VERSION, json.dumps(docs, default=str)))
+
+
+## Parse one file, runs in a worker process
+def parse_file(file_path):
+    """Parse a file into a list of (page_content, metadata) pairs, or None if it cannot be parsed."""
+    import eda_assistant_langchain_api
+    try:
+        docs = eda_assistant_langchain_api.get_langchain_file_loader(file_path).load()
+    except Exception as e:
+        print(f"-W- Could not parse {file_path}: {e}")
+        return None
+    return [(doc.page_content, doc.metadata) for doc in docs]
+
+
+def get_executor(workers):
+    """Get a process pool, or a thread pool where processes cannot be forked.
+
+    Processes are forked rather than spawned, a spawned worker would re-run
+    the eda_assistant_chat script it was started from.
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+## Load files in parallel, yielding documents as each file is parsed
+def iter_documents(path, relpaths=None, file_hashes=None, cache_path=None, workers=None, include_globs=None, exclude_globs=None):
+    """Parse the files of a corpus in a process pool.
+
+    Args:
+    path: Path to the file system directory containing the documents.
+    relpaths: Files to load relative to path, default every file of
+        list_files(path, include_globs, exclude_globs).
+    file_hashes: Optional dictionary of relative path to sha256 already known
+        to the caller, other files are hashed here.
+    cache_path: Optional SQLite file caching parsed text by file hash.
+    workers: Number of parser processes, default the number of CPUs.
+    include_globs, exclude_globs: See list_files().
+
+    Returns:
+    A generator of (relative path, list of LangChain documents) in the order
+    files finish parsing. The documents are None for a file that could not be
+    parsed, so callers can retry it on the next run instead of recording it
+    as empty. At most two files per worker are parsed ahead of the consumer.
+    """
+    from langchain_core.documents import Document
+    if relpaths is None:
+        relpaths = list_files(path, include_globs, exclude_globs)
+    file_hashes = file_hashes or {}
+    workers = workers or os.cpu_count() or 1
+    cache = ParsedTextCache(cache_path) if cache_path else None
+
+    def get_documents(relpath, parsed_docs):
+        # Sources point to the current location even if the text was cached from another path
+        return [Document(page_content=page_content, metadata={**metadata, "source": os.path.join(path, relpath)})
+                for page_content, metadata in parsed_docs]
+
+    start_time = time.perf_counter()
+    num_failed = 0
+    cached = []
+    pending = []
+    for relpath in relpaths:
+        file_hash = file_hashes.get(relpath) or get_file_hash(os.path.join(path, relpath))
+        if cache and cache.contains(file_hash):
+            cached.append((relpath, file_hash))
+        else:
+            pending.append((relpath, file_hash))
+
+    if not pending:
+        for relpath, file_hash in cached:
+            yield relpath, get_documents(relpath, cache.get(file_hash))
+    else:
+        with get_executor(min(workers, len(pending))) as executor:
+            futures = {}
+            queue = iter(pending)
+            for relpath, file_hash in queue:
+                futures[executor.submit(parse_file, os.path.join(path, relpath))] = (relpath, file_hash)
+                if len(futures) >= 2 * workers:
+                    break
+
+            # Hand out cached files while the workers parse the others
+            for relpath, file_hash in cached:
+                yield relpath, get_documents(relpath, cache.get(file_hash))
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    relpath, file_hash = futures.pop(future)
+                    parsed_docs = future.result()
+                    # Failures are not cached, the file is parsed again next time
+                    if parsed_docs is not None and cache:
+                        cache.put(file_hash, parsed_docs)
+                    num_failed += parsed_docs is None
+                    next_file = next(queue, None)
+                    if next_file:
+                        futures[executor.submit(parse_file, os.path.join(path, next_file[0]))] = next_file
+                    yield relpath, None if parsed_docs is None else get_documents(relpath, parsed_docs)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"-I- Loaded {len(relpaths)} files ({len(cached)} from parse cache, {len(pending) - num_failed} parsed, {num_failed} failed) in {elapsed:.2f}s")
@@ -0,0 +1,169 @@
+## Concurrent Bedrock embeddings with an on-disk cache
+import os
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import ClientError
+from langchain_core.embeddings import Embeddings
+import eda_assistant_bedrock_calls
+import eda_assistant_tracing
+
+# Error codes that lower the concurrency limit, other transient errors are retried without lowering it
+throttling_error_codes = ['ThrottlingException', 'TooManyRequestsException']
+# Cohere embedding models accept up to 96 texts per request
+cohere_batch_size = 96
+# Bump when the cache key changes, tables of older versions are not read
+EMBEDDING_CACHE_TABLE = "embeddings_v2"
+
+
+class AdaptiveConcurrencyLimiter:
+    """Caps in-flight requests. The cap is halved whenever a request is
+    throttled and grows back by one for every window of successful requests."""
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.limit < self.max_concurrency and self.successes >= self.limit:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+class EmbeddingCache:
+    """SQLite store of embedding vectors keyed by (model ID, input type, text
+    hash). Cohere embeds documents and queries differently, so the same text
+    has a vector per input type."""
+
+    def __init__(self, cache_path):
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self.conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {EMBEDDING_CACHE_TABLE} (model_id TEXT, input_type TEXT, text_hash TEXT, vector BLOB, PRIMARY KEY (model_id, input_type, text_hash))")
+
+    def get_many(self, model_id, input_type, text_hashes):
+        vectors = {}
+        unique_hashes = list(set(text_hashes))
+        with self.lock:
+            # Stay below SQLite's limit on the number of query parameters
+            for i in range(0, len(unique_hashes), 500):
+                batch = unique_hashes[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT text_hash, vector FROM {EMBEDDING_CACHE_TABLE} WHERE model_id = ? AND input_type = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                    [model_id, input_type] + batch)
+                for text_hash, vector in rows:
+                    vectors[text_hash] = array('f', vector).tolist()
+        return vectors
+
+    def put_many(self, model_id, input_type, hashed_vectors):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {EMBEDDING_CACHE_TABLE} (model_id, input_type, text_hash, vector) VALUES (?, ?, ?, ?)",
+                [(model_id, input_type, text_hash, array('f', vector).tobytes()) for text_hash, vector in hashed_vectors.items()])
+
+
+class CachedBedrockEmbeddings(Embeddings):
+    """Embeds texts with a Bedrock embedding model using concurrent requests,
+    adaptive backoff on throttling and an optional on-disk vector cache."""
+
+    def __init__(self, client, model_id, cache_path=None, max_concurrency=8, max_retries=8):
+        self.client = client
+        self.model_id = model_id
+        self.cache = EmbeddingCache(cache_path) if cache_path else None
+        self.limiter = AdaptiveConcurrencyLimiter(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+
+    def _invoke(self, texts, input_type, last_attempt=True):
+        if self.model_id.startswith("cohere."):
+            body = {"texts": texts, "input_type": input_type}
+        else:
+            body = {"inputText": texts[0]}
+        # One attempt through the shared call layer for quota pacing and metrics, retries are done here
+        response = eda_assistant_bedrock_calls.call_bedrock(
+            "InvokeModel", self.model_id,
+            lambda: self.client.invoke_model(body=json.dumps(body), modelId=self.model_id,
+                                             accept='application/json', contentType='application/json'),
+            tokens=sum(len(text) for text in texts) // 4, attempts=1, last_attempt=last_attempt)
+        response_body = json.loads(response.get("body").read())
+        if self.model_id.startswith("cohere."):
+            return response_body["embeddings"]
+        return [response_body["embedding"]]
+
+    def _invoke_with_backoff(self, texts, input_type):
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            throttled = False
+            try:
+                return self._invoke(texts, input_type, attempt == self.max_retries)
+            except Exception as e:
+                # Throttles, server errors and connection or read timeouts are retried
+                throttled = isinstance(e, ClientError) and e.response.get("Error", {}).get("Code") in throttling_error_codes
+                if not eda_assistant_bedrock_calls.is_retryable(e) or attempt == self.max_retries:
+                    raise
+            finally:
+                # Released on every outcome, a lost slot would block later requests forever
+                self.limiter.release(throttled=throttled)
+            # Full jitter exponential backoff, capped at 20 seconds
+            time.sleep(random.uniform(0, min(20, 0.5 * 2 ** attempt)))
+
+    def _embed(self, texts, input_type):
+        start_time = time.perf_counter()
+        text_hashes = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+        vectors = self.cache.get_many(self.model_id, input_type, text_hashes) if self.cache else {}
+        num_cached = sum(1 for text_hash in text_hashes if text_hash in vectors)
+
+        # Embed each distinct uncached text once
+        pending = {}
+        for text_hash, text in zip(text_hashes, texts):
+            if text_hash not in vectors:
+                pending[text_hash] = text
+        pending_hashes = list(pending)
+        batch_size = cohere_batch_size if self.model_id.startswith("cohere.") else 1
+        batches = [pending_hashes[i:i + batch_size] for i in range(0, len(pending_hashes), batch_size)]
+
+        if batches:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                futures = {executor.submit(self._invoke_with_backoff, [pending[h] for h in batch], input_type): batch for batch in batches}
+                for future in as_completed(futures):
+                    batch_vectors = dict(zip(futures[future], future.result()))
+                    vectors.update(batch_vectors)
+                    if self.cache:
+                        self.cache.put_many(self.model_id, input_type, batch_vectors)
+
+        elapsed = time.perf_counter() - start_time
+        eda_assistant_tracing.set_attributes(embedding_cache_hits=num_cached, embedding_requests=len(pending))
+        if len(texts) > 1:
+            print(f"-I- Embedded {len(texts)} chunks ({num_cached} cached, {len(pending)} requested) in {elapsed:.2f}s, {len(texts) / max(elapsed, 1e-9):.1f} chunks/s")
+        return [vectors[text_hash] for text_hash in text_hashes]
+
+    def embed_documents(self, texts):
+        return self._embed(texts, "search_document")
+
+    def embed_query(self, text):
+        with eda_assistant_tracing.span("embed_query", model=self.model_id):
+            return self._embed([text], "search_query")[0]
@@ -0,0 +1,168 @@
+## Persistent, incrementally updated FAISS index for file system corpora
+import os
+import json
+import hashlib
+from pathlib import Path
+import eda_assistant_langchain_api
+import eda_assistant_doc_loader
+
+#Bump when the on-disk FAISS index layout or the chunking changes so stale indexes are rebuilt
+FAISS_INDEX_VERSION = 5
+MANIFEST_FILE = "manifest.json"
+
+
+## Get the directory of the FAISS index for a corpus
+def get_faiss_index_path(index_dir, path, chunksize, embeddings_modelid, index_options=None):
+    """Get the index directory for a corpus and its indexing parameters.
+
+    Args:
+    index_dir: Directory holding all saved indexes.
+    path: Path to the file system directory containing the documents.
+    chunksize: The chunk size used to split the documents.
+    embeddings_modelid: The ID of the embedding model.
+    index_options: Optional FAISS index type and encoding, see
+        eda_assistant_faiss_store.default_index_options.
+
+    Returns:
+    A directory path that changes whenever the corpus location, the chunk size,
+    the embedding model, the index type or the index format changes.
+    """
+    build_options = "|".join(str((index_options or {}).get(name)) for name in ("index_type", "encoding", "nlist", "pq_m"))
+    index_key = hashlib.sha256(f"{FAISS_INDEX_VERSION}|{os.path.abspath(path)}|{chunksize}|{embeddings_modelid}|{build_options}".encode("utf-8")).hexdigest()
+    return os.path.join(index_dir, f"faiss_v{FAISS_INDEX_VERSION}_{index_key[:16]}")
+
+
+## Load the manifest of files in an index
+def load_manifest(index_path):
+    manifest_path = os.path.join(index_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {"version": FAISS_INDEX_VERSION, "files": {}}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+## Compare the corpus on disk with the manifest
+def scan_corpus(path, manifest_files, include_globs=None, exclude_globs=None):
+    """Find files that were added, changed or removed since the last index run.
+
+    Files whose size and mtime match the manifest are not read. Files whose
+    size or mtime changed are hashed, so a touched but unmodified file is not
+    re-indexed.
+
+    Args:
+    path: Path to the file system directory containing the documents.
+    manifest_files: The "files" entry of the index manifest.
+    include_globs, exclude_globs: Files to index, see
+        eda_assistant_doc_loader.list_files().
+
+    Returns:
+    A tuple of (changed, removed, files) where changed is a list of relative
+    paths to (re)index, removed is a list of relative paths no longer on disk
+    and files maps every current relative path to its size, mtime and hash.
+    """
+    changed = []
+    files = {}
+    for relpath in eda_assistant_doc_loader.list_files(path, include_globs, exclude_globs):
+        file_path = Path(path) / relpath
+        stat = file_path.stat()
+        entry = manifest_files.get(relpath)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            files[relpath] = entry
+            continue
+
+        file_hash = eda_assistant_doc_loader.get_file_hash(file_path)
+        files[relpath] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_hash,
+                          "chunk_ids": entry["chunk_ids"] if entry else []}
+        if not entry or entry["sha256"] != file_hash:
+            changed.append(relpath)
+
+    removed = [relpath for relpath in manifest_files if relpath not in files]
+    return changed, removed, files
+
+
+## Stable IDs for the chunks of a file
+def get_chunk_ids(relpath, file_hash, num_chunks):
+    return [hashlib.sha256(f"{relpath}|{file_hash}|{i}".encode("utf-8")).hexdigest()[:32] for i in range(num_chunks)]
+
+
+## Load or incrementally update the FAISS index for a corpus
+def get_faiss_vector_store(path, index_dir, chunksize, embeddings_modelid, embeddings, reindex=False,
+                           parse_cache=None, parse_workers=None, include_globs=None, exclude_globs=None, index_options=None):
+    """Load the saved FAISS index for a corpus, re-indexing only the files that
+    were added or changed and deleting vectors of files that were removed.
+
+    Args:
+    path: Path to the file system directory containing the documents.
+    index_dir: Directory holding all saved indexes.
+    chunksize: The chunk size used to split the documents.
+    embeddings_modelid: The ID of the embedding model.
+    embeddings: Embeddings model matching embeddings_modelid.
+    reindex: Ignore any saved index and index the whole corpus.
+    parse_cache, parse_workers: Parsed text cache and number of parser
+        processes, see eda_assistant_doc_loader.iter_documents().
+    include_globs, exclude_globs: Files to index, see
+        eda_assistant_doc_loader.list_files().
+    index_options: Optional FAISS index type, vector encoding and search
+        parameters, see eda_assistant_faiss_store.default_index_options.
+
+    Returns:
+    A vector store object, or None if the corpus has no documents.
+    """
+    index_path = get_faiss_index_path(index_dir, path, chunksize, embeddings_modelid, index_options)
+    vectorstore = None
+    manifest = {"version": FAISS_INDEX_VERSION, "files": {}}
+    if not reindex:
+        vectorstore = eda_assistant_langchain_api.load_langchain_faiss_vector_store(index_path, embeddings, index_options)
+        if vectorstore is not None:
+            manifest = load_manifest(index_path)
+            print("-I- Loaded FAISS index from ", index_path)
+
+    changed, removed, files = scan_corpus(path, manifest["files"], include_globs, exclude_globs)
+    print(f"-I- Files added or changed: {len(changed)}, removed: {len(removed)}, unchanged: {len(files) - len(changed)}")
+    if vectorstore is not None and not changed and not removed:
+        return vectorstore
+
+    # Drop vectors of removed files and of the old version of changed files
+    stale_ids = [chunk_id for relpath in removed for chunk_id in manifest["files"][relpath]["chunk_ids"]]
+    stale_ids += [chunk_id for relpath in changed for chunk_id in files[relpath]["chunk_ids"]]
+    if vectorstore is not None and stale_ids:
+        vectorstore.delete(stale_ids)
+
+    # Parse, split and embed only the files that were added or changed
+    documents = []
+    document_ids = []
+    if changed:
+        print("-I- Parsing and splitting documents from filepath...")
+        file_hashes = {relpath: files[relpath]["sha256"] for relpath in changed}
+        # Each file is split as soon as it is parsed, its raw documents are not kept
+        for relpath, file_docs in eda_assistant_doc_loader.iter_documents(path, changed, file_hashes, parse_cache, parse_workers):
+            if file_docs is None:
+                # Left out of the manifest so the next run parses it again
+                del files[relpath]
+                continue
+            chunks = eda_assistant_langchain_api.get_langchain_split_chunks(file_docs, chunksize)
+            chunk_ids = get_chunk_ids(relpath, files[relpath]["sha256"], len(chunks))
+            files[relpath]["chunk_ids"] = chunk_ids
+            documents.extend(chunks)
+            document_ids.extend(chunk_ids)
+
+    if documents:
+        print("-I- Creating & indexing vector store...")
+        if vectorstore is None:
+            vectorstore = eda_assistant_langchain_api.get_langchain_faiss_vector_store(documents, embeddings, document_ids, index_options)
+        else:
+            vectorstore.add_documents(documents, ids=document_ids)
+
+    if vectorstore is None:
+        return None
+
+    # A corpus that was too small for the requested index type when it was built may have grown enough
+    import eda_assistant_faiss_store
+    requested_type = (index_options or {}).get("index_type") or "flat"
+    if requested_type != "flat" and not vectorstore.is_ann() and vectorstore.index.ntotal >= eda_assistant_faiss_store.min_ann_vectors:
+        vectorstore.rebuild_index({"index_type": requested_type})
+
+    manifest = {"version": FAISS_INDEX_VERSION, "chunksize": chunksize, "embeddings_modelid": embeddings_modelid, "files": files}
+    eda_assistant_langchain_api.save_langchain_faiss_vector_store(vectorstore, index_path, {MANIFEST_FILE: json.dumps(manifest, indent=1)})
+    print("-I- Saved FAISS index to ", index_path)
+    return vectorstore
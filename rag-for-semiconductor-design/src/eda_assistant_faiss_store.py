@@ -0,0 +1,363 @@
+## FAISS vector store with a choice of index type and vector encoding
+# LangChain's FAISS always builds a flat index of float32 vectors, whose
+# memory and query time grow linearly with the corpus. FaissStore builds
+#   flat      exact search, optionally of float16 or int8 vectors
+#   hnsw      graph search, tuned at query time with efSearch
+#   ivf_flat  inverted lists of clusters, tuned at query time with nprobe
+#   ivf_pq    inverted lists of product quantized codes, the smallest index
+# IVF clusters are trained on a sample spread across the source files.
+# Quantized indexes (int8, float16, PQ) keep the float32 vectors next to the
+# index in vectors.npy, memory-mapped after loading, so approximate results
+# can be re-scored exactly: rescore times k candidates are fetched and only
+# their rows are read from disk. Exact indexes hold the vectors themselves,
+# they are read back from the index when it has to be rebuilt.
+# Chunks are kept in an eda_assistant_chunk_store.ChunkStore instead of a
+# pickled docstore, nothing is unpickled when an index is loaded.
+import os
+import json
+import math
+import numpy as np
+from langchain_community.vectorstores import FAISS
+import eda_assistant_chunk_store
+
+index_types = ["flat", "hnsw", "ivf_flat", "ivf_pq"]
+vector_encodings = ["float32", "float16", "int8"]
+# index_type, encoding, nlist and pq_m are fixed when the index is built, the others can change between runs
+default_index_options = {"index_type": "flat", "encoding": "float32", "nlist": None, "pq_m": None,
+                         "nprobe": 16, "ef_search": 64, "rescore": 4}
+# Corpora smaller than this are searched exactly, IVF and PQ need enough vectors to train
+min_ann_vectors = 10000
+hnsw_neighbors = 32
+training_vectors_per_list = 64
+min_training_vectors = 10000
+max_training_vectors = 200000
+# Vectors copied into an index at a time, so a rebuild never holds them all in memory
+add_batch_size = 65536
+VECTORS_FILE = "vectors.npy"
+OPTIONS_FILE = "index_options.json"
+
+
+def get_index_options(index_options=None):
+    return {**default_index_options, **{name: value for name, value in (index_options or {}).items() if value is not None}}
+
+
+def get_nlist(num_vectors, nlist=None):
+    """Number of IVF lists, about 4 * sqrt(num_vectors) by default."""
+    nlist = nlist or int(4 * math.sqrt(num_vectors))
+    return max(1, min(nlist, num_vectors // 39))
+
+
+def get_pq_m(dimension, pq_m=None):
+    """Sub-quantizers of a PQ code, one byte per 16 dimensions by default."""
+    pq_m = pq_m or max(1, dimension // 16)
+    while dimension % pq_m:
+        pq_m -= 1
+    return pq_m
+
+
+def get_factory_string(index_type, encoding, dimension, num_vectors, nlist=None, pq_m=None):
+    """faiss.index_factory() description of an index."""
+    storage = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8"}[encoding]
+    if index_type == "hnsw":
+        return f"HNSW{hnsw_neighbors}" if encoding == "float32" else f"HNSW{hnsw_neighbors},{storage}"
+    if index_type == "ivf_flat":
+        return f"IVF{get_nlist(num_vectors, nlist)},{storage}"
+    if index_type == "ivf_pq":
+        # The PQ code is the encoding
+        return f"IVF{get_nlist(num_vectors, nlist)},PQ{get_pq_m(dimension, pq_m)}"
+    return storage
+
+
+## Choose the vectors IVF clusters are trained on
+def select_training_sample(groups, sample_size, seed=0):
+    """Positions of a training sample taken from each group (source file) in
+    proportion to its size, so a few large files do not decide the clusters.
+
+    Args:
+    groups: Group of each vector, e.g. its source file
+    sample_size: Number of vectors to select
+
+    Returns:
+    A sorted array of positions.
+    """
+    if len(groups) <= sample_size:
+        return np.arange(len(groups))
+    rng = np.random.default_rng(seed)
+    positions_by_group = {}
+    for position, group in enumerate(groups):
+        positions_by_group.setdefault(group, []).append(position)
+    fraction = sample_size / len(groups)
+    sample = []
+    for positions in positions_by_group.values():
+        num_selected = max(1, round(len(positions) * fraction))
+        sample.extend(rng.choice(positions, min(num_selected, len(positions)), replace=False))
+    sample = np.array(sample)
+    if len(sample) > sample_size:
+        sample = rng.choice(sample, sample_size, replace=False)
+    return np.sort(sample)
+
+
+## Build a FAISS index of vectors
+def create_faiss_index(vectors, groups, index_options):
+    """Build, train and fill the index described by index_options.
+
+    Returns:
+    A tuple of the index and its factory string.
+    """
+    import faiss
+    num_vectors, dimension = vectors.shape
+    index_type = index_options["index_type"]
+    if index_type != "flat" and num_vectors < min_ann_vectors:
+        print(f"-W- {num_vectors} vectors are too few for a {index_type} index, searching them exactly")
+        index_type = "flat"
+    factory_string = get_factory_string(index_type, index_options["encoding"], dimension, num_vectors, index_options["nlist"], index_options["pq_m"])
+    index = faiss.index_factory(dimension, factory_string)
+    if not index.is_trained:
+        num_training_vectors = min(max_training_vectors, max(min_training_vectors, get_nlist(num_vectors, index_options["nlist"]) * training_vectors_per_list))
+        training_positions = select_training_sample(groups, num_training_vectors)
+        print(f"-I- Training {factory_string} index on {len(training_positions)} of {num_vectors} vectors...")
+        index.train(np.ascontiguousarray(vectors[training_positions], dtype=np.float32))
+    add_vectors(index, vectors)
+    return index, factory_string
+
+
+def add_vectors(index, vectors, positions=None):
+    """Add vectors[positions], default all of them, to index in batches."""
+    positions = np.arange(len(vectors)) if positions is None else positions
+    for start in range(0, len(positions), add_batch_size):
+        index.add(np.ascontiguousarray(vectors[positions[start:start + add_batch_size]], dtype=np.float32))
+
+
+class VectorFile:
+    """float32 vectors in index order: the rows of a memory-mapped vectors.npy
+    still in use, then the vectors added since it was loaded.
+
+    Deletes only drop rows from the selection and appends are kept in memory,
+    the file is never copied into memory. save() writes the result in batches.
+    """
+
+    def __init__(self, vectors):
+        self.base = vectors
+        self.rows = np.arange(len(vectors), dtype=np.int64)
+        self.added = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.rows) + len(self.added)
+
+    @property
+    def shape(self):
+        return len(self), self.base.shape[1]
+
+    def __getitem__(self, positions):
+        """Vectors at a slice or an array of positions."""
+        positions = np.arange(len(self))[positions] if isinstance(positions, slice) else np.asarray(positions, dtype=np.int64)
+        vectors = np.empty((len(positions), self.shape[1]), dtype=np.float32)
+        loaded = positions < len(self.rows)
+        vectors[loaded] = self.base[self.rows[positions[loaded]]]
+        vectors[~loaded] = self.added[positions[~loaded] - len(self.rows)]
+        return vectors
+
+    def append(self, vectors):
+        self.added = np.concatenate([self.added, np.asarray(vectors, dtype=np.float32)])
+
+    def keep(self, positions):
+        """Keep the vectors at positions, in that order, and drop the others."""
+        num_loaded = len(self.rows)
+        self.added = self.added[positions[positions >= num_loaded] - num_loaded]
+        self.rows = self.rows[positions[positions < num_loaded]]
+
+    def save(self, file_path):
+        """Write the vectors to file_path, which must not be the file they were loaded from."""
+        saved = np.lib.format.open_memmap(file_path, mode="w+", dtype=np.float32, shape=self.shape)
+        for start in range(0, len(self), add_batch_size):
+            saved[start:start + add_batch_size] = self[start:start + add_batch_size]
+        saved.flush()
+        del saved
+
+    @classmethod
+    def load(cls, file_path):
+        return cls(np.load(file_path, mmap_mode="r"))
+
+
+class IndexVectors:
+    """Vectors read back from an index whose encoding is exact, in the same
+    interface as VectorFile."""
+
+    def __init__(self, index):
+        import faiss
+        self.index = index
+        ivf_index = faiss.try_extract_index_ivf(index)
+        if ivf_index is not None:
+            # IVF indexes find a vector's list through the direct map
+            ivf_index.make_direct_map()
+
+    def __len__(self):
+        return self.index.ntotal
+
+    @property
+    def shape(self):
+        return self.index.ntotal, self.index.d
+
+    def __getitem__(self, positions):
+        positions = np.arange(self.index.ntotal)[positions] if isinstance(positions, slice) else np.asarray(positions, dtype=np.int64)
+        return self.index.reconstruct_batch(positions)
+
+
+class FaissStore(FAISS):
+    """LangChain FAISS store over any index type, with exact re-scoring.
+
+    Attributes:
+    docstore: eda_assistant_chunk_store.ChunkStore, row i is the chunk of vector i
+    vectors: VectorFile of the float32 vectors of a quantized index, None
+        for exact indexes, which hold the vectors themselves
+    index_options: See default_index_options, plus the built "factory" string
+    """
+
+    def __init__(self, embeddings, index, chunk_store, vectors=None, index_options=None, **kwargs):
+        super().__init__(embeddings, index, chunk_store, eda_assistant_chunk_store.ChunkIdView(chunk_store), **kwargs)
+        self.index_options = get_index_options(index_options)
+        if vectors is not None and not isinstance(vectors, VectorFile):
+            vectors = VectorFile(vectors)
+        self.vectors = None if self.has_exact_distances() else vectors
+        self.set_search_options()
+
+    ## Query time parameters
+    def set_search_options(self, nprobe=None, ef_search=None, rescore=None):
+        import faiss
+        for name, value in (("nprobe", nprobe), ("ef_search", ef_search), ("rescore", rescore)):
+            if value is not None:
+                self.index_options[name] = value
+        factory = self.index_options.get("factory", "")
+        if factory.startswith("IVF"):
+            faiss.ParameterSpace().set_index_parameter(self.index, "nprobe", self.index_options["nprobe"])
+        elif factory.startswith("HNSW"):
+            faiss.ParameterSpace().set_index_parameter(self.index, "efSearch", self.index_options["ef_search"])
+
+    def has_exact_distances(self):
+        # Scalar and product quantized vectors give approximate distances
+        factory = self.index_options.get("factory", "Flat")
+        return "SQ" not in factory and "PQ" not in factory
+
+    def is_ann(self):
+        return self.index_options.get("factory", "Flat").startswith(("IVF", "HNSW"))
+
+    def get_vectors(self):
+        """The float32 vectors in index order, as a VectorFile or IndexVectors."""
+        return self.vectors if self.vectors is not None else IndexVectors(self.index)
+
+    ## Create a store from documents
+    @classmethod
+    def from_documents_with_options(cls, documents, embeddings, ids=None, index_options=None):
+        """Embed documents and index them as described by index_options."""
+        index_options = get_index_options(index_options)
+        vectors = np.array(embeddings.embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+        index, index_options["factory"] = create_faiss_index(vectors, [doc.metadata.get("source") for doc in documents], index_options)
+        ids = ids or [str(i) for i in range(len(documents))]
+        chunk_store = eda_assistant_chunk_store.ChunkStore.from_documents(ids, documents)
+        return cls(embeddings, index, chunk_store, vectors, index_options)
+
+    ## Rebuild the index from the stored vectors, without embedding again
+    def rebuild_index(self, index_options=None):
+        self.index_options = get_index_options({**self.index_options, **(index_options or {})})
+        groups = self.docstore.get_column("source")
+        vectors = self.get_vectors()
+        self.index, self.index_options["factory"] = create_faiss_index(vectors, groups, self.index_options)
+        if self.has_exact_distances():
+            self.vectors = None
+        elif self.vectors is None:
+            # A quantized index needs the originals for re-scoring, read back from the exact index it replaces
+            self.vectors = VectorFile(vectors[:])
+        self.set_search_options()
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        import uuid
+        from langchain_core.documents import Document
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        new_vectors = np.array(self._embed_documents(texts), dtype=np.float32)
+        self.index.add(new_vectors)
+        if self.vectors is not None:
+            self.vectors.append(new_vectors)
+        self.docstore.add_documents(ids, [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)])
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        """Delete by ID. Vectors are removed from flat indexes in place, other
+        indexes are refilled with the remaining vectors in batches: IVF and
+        HNSW indexes cannot remove vectors and keep positions contiguous."""
+        if ids is None:
+            raise ValueError("No ids provided to delete.")
+        delete_ids = set(ids)
+        stored_ids = self.index_to_docstore_id.values()
+        missing_ids = delete_ids.difference(stored_ids)
+        if missing_ids:
+            raise ValueError(f"Some specified ids do not exist in the current store. Ids not found: {missing_ids}")
+        keep = np.array([i for i, chunk_id in enumerate(stored_ids) if chunk_id not in delete_ids], dtype=np.int64)
+        self.docstore.keep(keep)
+        if self.vectors is not None:
+            self.vectors.keep(keep)
+            # Trained clusters and codebooks are kept
+            self.index.reset()
+            add_vectors(self.index, self.vectors)
+        elif self.index_options.get("factory", "Flat") == "Flat":
+            self.index.remove_ids(np.setdiff1d(np.arange(self.index.ntotal), keep))
+        else:
+            import faiss
+            index = faiss.clone_index(self.index)
+            index.reset()
+            add_vectors(index, IndexVectors(self.index), keep)
+            self.index = index
+            self.set_search_options()
+        return True
+
+    ## Search, re-scoring approximate results with the exact vectors
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20, **kwargs):
+        vector = np.array([embedding], dtype=np.float32)
+        num_candidates = k if filter is None else fetch_k
+        rescore = self.index_options["rescore"] if not self.has_exact_distances() and self.vectors is not None else 0
+        if rescore:
+            num_candidates *= rescore
+        distances, positions = self.index.search(vector, num_candidates)
+        candidates = [(int(i), float(distance)) for i, distance in zip(positions[0], distances[0]) if i != -1]
+        if rescore and candidates:
+            # Reading rows in file order touches each page of the memory-mapped vectors once
+            rows = np.array(sorted(i for i, _ in candidates))
+            exact_distances = ((self.vectors[rows] - vector) ** 2).sum(axis=1)
+            candidates = sorted(zip(rows.tolist(), exact_distances.tolist()), key=lambda candidate: candidate[1])
+
+        filter_func = self._create_filter_func(filter) if filter is not None else None
+        score_threshold = kwargs.get("score_threshold")
+        docs = []
+        for i, distance in candidates:
+            doc = self.docstore.get_document(i)
+            if filter_func is not None and not filter_func(doc.metadata):
+                continue
+            if score_threshold is not None and distance > score_threshold:
+                continue
+            docs.append((doc, distance))
+        return docs[:k]
+
+    ## Persistence
+    def save_local(self, folder_path, index_name="index"):
+        import faiss
+        os.makedirs(folder_path, exist_ok=True)
+        faiss.write_index(self.index, os.path.join(folder_path, f"{index_name}.faiss"))
+        self.docstore.save(folder_path)
+        if self.vectors is not None:
+            self.vectors.save(os.path.join(folder_path, VECTORS_FILE))
+        with open(os.path.join(folder_path, OPTIONS_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.index_options, f, indent=1)
+
+    @classmethod
+    def load_local(cls, folder_path, embeddings, index_name="index", **kwargs):
+        """Load a store saved by save_local(), memory-mapping its chunks and vectors."""
+        import faiss
+        with open(os.path.join(folder_path, OPTIONS_FILE), "r", encoding="utf-8") as f:
+            index_options = json.load(f)
+        index = faiss.read_index(os.path.join(folder_path, f"{index_name}.faiss"))
+        chunk_store = eda_assistant_chunk_store.ChunkStore.load(folder_path)
+        vectors = None
+        if os.path.exists(os.path.join(folder_path, VECTORS_FILE)):
+            vectors = VectorFile.load(os.path.join(folder_path, VECTORS_FILE))
+        return cls(embeddings, index, chunk_store, vectors, index_options, **kwargs)
@@ -1,42 +1,23 @@
 ## Import Python libraries and custom modules
 import eda_assistant_model_options
+import eda_assistant_bedrock_api
 import json
-import boto3
 import os
-import random
+import shutil
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 # from utils import opensearch, secret
 
-##Bedrock and Bedrock Embeddings
-from langchain_community.embeddings import BedrockEmbeddings
-from langchain.llms.bedrock import Bedrock
-from langchain_community.chat_models import BedrockChat
+# LangChain, FAISS and unstructured are imported inside the functions that use
+# them, so modes that never touch LangChain do not pay their import cost
 
-## Data Ingestion
-from langchain.retrievers.bedrock import AmazonKnowledgeBasesRetriever
-from langchain_community.document_loaders import DirectoryLoader
-
-## Data splitting
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-
-## Embeddings
-from langchain_community.embeddings import BedrockEmbeddings
-
-## Vector Stores
-from langchain_community.vectorstores import FAISS
-# from langchain_community.vectorstores import OpenSearchVectorSearch
-
-## Chains
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough
-from langchain_core.output_parsers import StrOutputParser
-
-## LLM Models
-from langchain.chains import RetrievalQA
-from langchain.prompts import PromptTemplate
-
-#Bedrock Client
-bedrock_client = boto3.client('bedrock-runtime')
 region = 'us-west-2'
 
+# RetrievalQA chains by (model, retriever, prompt template), see get_langchain_retrievalqa_chain()
+retrievalqa_chains = {}
+retrievalqa_chains_lock = threading.Lock()
+
 
 # Get specific instructions for llm
 def get_langchain_system_prompt (modelID):
@@ -88,26 +69,115 @@ def get_langchain_model_kwargs(modelID, temperature = 0.1, topk = 1, max_tokens=
 
 
 ##Get Amazon Knowledge Bases Retriever
-def get_langchain_kb_retriever(kb_id):
-    """Generate a knowledge base retriever for the language model.
+@functools.lru_cache(maxsize=None)
+def get_langchain_kb_retriever(kb_id, numberOfResults=4):
+    """Generate a knowledge base retriever for the language model, once per
+    knowledge base until clear_langchain_caches() is called.
 
     Args:
-    Knowledge Base ID
+    kb_id: Knowledge Base ID
+    numberOfResults: Number of documents to retrieve, the best of
+        eda_assistant_reranker.num_candidates if reranking is enabled
 
     Returns:
     A knowledge base retriever for the language model.
     """
+    import eda_assistant_reranker
+    from langchain.retrievers.bedrock import AmazonKnowledgeBasesRetriever
     retriever = AmazonKnowledgeBasesRetriever(
+            client=eda_assistant_bedrock_api.get_bedrock_agent_runtime_client(),
             knowledge_base_id=kb_id,
             retrieval_config={"vectorSearchConfiguration": 
-                            {"numberOfResults": 4,
+                            {"numberOfResults": max(numberOfResults, eda_assistant_reranker.num_candidates),
                             'overrideSearchType': "HYBRID", # optional
                             }
                             },
         )
+    return get_langchain_reranked_retriever(retriever, numberOfResults)
+
+
+##Get a retriever reranking over-fetched documents
+def get_langchain_reranked_retriever(retriever, numberOfResults=4):
+    """Wrap a retriever fetching eda_assistant_reranker.num_candidates
+    documents so only the best numberOfResults after local lexical reranking
+    are returned. Returns retriever itself if reranking is disabled.
+
+    Args:
+    retriever: Retriever to wrap
+    numberOfResults: Number of documents to keep
+
+    Returns:
+    A retriever for the language model.
+    """
+    import eda_assistant_reranker
+    if eda_assistant_reranker.num_candidates <= numberOfResults:
+        return retriever
+    import eda_assistant_reranked_retriever
+    return eda_assistant_reranked_retriever.RerankedRetriever(retriever=retriever, top_n=numberOfResults)
+
+
+##Get OpenSearch k-NN Retriever
+def get_langchain_opensearch_retriever(opensearch_client, index_name, embeddings, numberOfResults=4, filters=None, hybrid=False):
+    """Generate a retriever over an OpenSearch k-NN index for the language model.
+
+    Args:
+    opensearch_client: OpenSearch client
+    index_name: Index created by eda_assistant_opensearch_api.create_index()
+    embeddings: Embeddings model the index was built with
+    numberOfResults: Number of documents to retrieve
+    filters: Optional dictionary of metadata field to value(s)
+    hybrid: Combine k-NN with a BM25 match on the text
+
+    Returns:
+    An OpenSearch retriever for the language model.
+    """
+    import eda_assistant_opensearch_retriever
+    retriever = eda_assistant_opensearch_retriever.OpenSearchKnnRetriever(
+            client=opensearch_client,
+            index_name=index_name,
+            embeddings=embeddings,
+            numberOfResults=numberOfResults,
+            filters=filters,
+            hybrid=hybrid
+        )
     return retriever
 
 
+## Pick a loader for a file
+def get_langchain_file_loader(file_path, **kwargs):
+    """Load HDL, TCL/SDC and Liberty files as plain text so their lines stay
+    intact for eda_assistant_chunker, and any other file with unstructured."""
+    import eda_assistant_chunker
+    if eda_assistant_chunker.get_file_language(file_path):
+        from langchain_community.document_loaders import TextLoader
+        return TextLoader(file_path, autodetect_encoding=True)
+    from langchain_community.document_loaders import UnstructuredFileLoader
+    return UnstructuredFileLoader(file_path, **kwargs)
+
+
+##Get a retriever packing documents into the model's context budget
+def get_langchain_packed_retriever(retriever, modelID, maxtokens, prompt_overhead_tokens=0):
+    """Wrap a retriever so overlapping documents are dropped and the rest fit
+    the context budget of the model, see eda_assistant_context_packer.
+
+    Args:
+    retriever: Retriever to wrap
+    modelID: LLM specific Model identifier
+    maxtokens: Requested maximum output tokens
+    prompt_overhead_tokens: Tokens of the prompt besides the documents
+
+    Returns:
+    A retriever for the language model.
+    """
+    import eda_assistant_packed_retriever
+    return eda_assistant_packed_retriever.PackedRetriever(
+        retriever=retriever,
+        modelID=modelID,
+        maxtokens=maxtokens,
+        prompt_overhead_tokens=prompt_overhead_tokens
+    )
+
+
 ##Get Documents from File System:
 def get_langchain_docs_fs(path):
     """Generate a list of documents from a file system path.
@@ -118,7 +188,8 @@ def get_langchain_docs_fs(path):
     Returns:
     A list of documents from the file system directory.
     """
-    loader = DirectoryLoader(path, use_multithreading=True, show_progress=True)
+    from langchain_community.document_loaders import DirectoryLoader
+    loader = DirectoryLoader(path, loader_cls=get_langchain_file_loader, use_multithreading=True, show_progress=True)
     docs = loader.load()
     print("-I- Total Files loaded: ", len(docs))
     print("-I- File paths loaded: ")
@@ -128,37 +199,76 @@ def get_langchain_docs_fs(path):
     return docs
 
 
+##Get specific Documents from File System:
+def get_langchain_docs_files(path, relpaths):
+    """Load a list of files below a file system path.
+
+    Args:
+    path: Path to the file system directory.
+    relpaths: File paths relative to path.
+
+    Returns:
+    A dictionary of relative file path to the list of documents loaded from it.
+    """
+    def load_file(relpath):
+        return get_langchain_file_loader(os.path.join(path, relpath)).load()
+
+    with ThreadPoolExecutor() as executor:
+        file_docs = list(executor.map(load_file, relpaths))
+    print("-I- Total Files loaded: ", len(file_docs))
+    return dict(zip(relpaths, file_docs))
+
+
 ## Split into chunks
-def get_langchain_split_chunks(docs, chunksize):
+def get_langchain_split_chunks(docs, chunksize, chunk_tokens=None):
     """Split a list of documents into chunks of a specified size.
 
+    HDL, TCL/SDC and Liberty files are split on module, process and command
+    boundaries by eda_assistant_chunker, other documents by characters.
+
     Args:
     docs: A list of documents.
-    chunksize: The size of each chunk.
+    chunksize: The size of each prose chunk in characters.
+    chunk_tokens: The size of each HDL/TCL/Liberty chunk in tokens, about a
+        quarter of chunksize by default.
 
     Returns:
-    A list of chunks of the specified size.
+    A list of chunks of the specified size, in the order of docs.
     """
+    import eda_assistant_chunker
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunksize, chunk_overlap=20, length_function=len
     )
-    chunks = text_splitter.split_documents(docs)
+    chunk_tokens = chunk_tokens or chunksize // 4
+    chunks = []
+    for doc in docs:
+        if eda_assistant_chunker.get_file_language(doc.metadata.get('source', '')):
+            chunks.extend(eda_assistant_chunker.split_documents([doc], chunk_tokens))
+        else:
+            chunks.extend(text_splitter.split_documents([doc]))
     return chunks
 
 
 ## Create an Embeddings model
-def create_langchain_vector_embedding_using_bedrock(bedrock_embedding_model_id):
-    """Create a vector embedding model using the Bedrock Embeddings library.
+def create_langchain_vector_embedding_using_bedrock(bedrock_embedding_model_id, cache_path=None, max_concurrency=8):
+    """Create a vector embedding model that embeds chunks with concurrent
+    Bedrock requests and reuses vectors from an on-disk cache.
 
     Args:
     bedrock_embedding_model_id: The ID of the embedding model to use.
+    cache_path: Optional SQLite file caching vectors by (model ID, chunk hash).
+    max_concurrency: Maximum number of embedding requests in flight.
 
     Returns:
-    A vector embedding model using the Bedrock Embeddings library.
+    A LangChain compatible vector embedding model.
     """
-    bedrock_embeddings_client = BedrockEmbeddings(
-        client=bedrock_client,
-        model_id=bedrock_embedding_model_id)
+    import eda_assistant_embeddings
+    bedrock_embeddings_client = eda_assistant_embeddings.CachedBedrockEmbeddings(
+        client=eda_assistant_bedrock_api.get_bedrock_client(),
+        model_id=bedrock_embedding_model_id,
+        cache_path=cache_path,
+        max_concurrency=max_concurrency)
     return bedrock_embeddings_client
 
 
@@ -182,6 +292,10 @@ def create_rag_pipeline_with_sourcing(documents, prompt_template, llm) -> str:
     Returns:
         The answer to the query based on the documents content.
     """
+    from langchain_community.vectorstores import FAISS
+    from langchain_core.runnables import RunnableParallel, RunnablePassthrough
+    from langchain_core.output_parsers import StrOutputParser
+
     # Create a vector store from PDF documents
     # index_file_path = os.path.join(os.getcwd(), "faiss_index")
     vector_store = FAISS.from_documents(documents, create_langchain_vector_embedding_using_bedrock("amazon.titan-embed-text-v1"))
@@ -207,36 +321,114 @@ def create_rag_pipeline_with_sourcing(documents, prompt_template, llm) -> str:
 
 ## Setup a retrieval QA for documents
 def get_langchain_doc_retrievalqa(modelID, vectorstore, docs, prompt_template, query):
-    llm = BedrockChat(model_id=modelID, 
-                    model_kwargs=get_langchain_model_kwargs(modelID),
-                    client=bedrock_client)
-
-    rag_pipeline_with_sourcing = create_rag_pipeline_with_sourcing(docs, prompt_template, llm)
+    rag_pipeline_with_sourcing = create_rag_pipeline_with_sourcing(docs, prompt_template, get_langchain_chat_model(modelID))
     return rag_pipeline_with_sourcing.invoke(query)
 
 
-## Create a FAISS index, save index to a specified file path
-def get_langchain_faiss_vector_store(documents, embeddings):
+## Create a FAISS index
+def get_langchain_faiss_vector_store(documents, embeddings, ids=None, index_options=None):
     """Create a vector store from a list of documents and embeddings.
 
     Args:
         documents: A list of document objects.
         embeddings: A list of embeddings corresponding to the documents.
+        ids: Optional list of stable IDs for the documents.
+        index_options: Optional index type, vector encoding and search
+            parameters, see eda_assistant_faiss_store.default_index_options.
 
     Returns:
         A vector store object.
     """
-    # TODO: Can be scripted to load a FAISS db if already created, 
-    # however need to implement safer way to check
+    import eda_assistant_faiss_store
+    db = eda_assistant_faiss_store.FaissStore.from_documents_with_options(documents, embeddings, ids, index_options)
+    return db
+
+
+## Save a FAISS index to a specified directory
+def save_langchain_faiss_vector_store(db, index_path, extra_files=None):
+    """Save a vector store, replacing any index already at index_path.
+
+    Args:
+        db: A vector store object.
+        index_path: Directory to save the index to.
+        extra_files: Optional dictionary of file name to text content saved
+            alongside the index, such as a manifest.
+    """
+    # Write to a temporary directory first so a killed run never leaves
+    # a partial index behind under the final name
+    tmp_index_path = index_path + ".tmp"
+    shutil.rmtree(tmp_index_path, ignore_errors=True)
+    db.save_local(tmp_index_path)
+    for file_name, content in (extra_files or {}).items():
+        with open(os.path.join(tmp_index_path, file_name), "w", encoding="utf-8") as f:
+            f.write(content)
+    shutil.rmtree(index_path, ignore_errors=True)
+    os.replace(tmp_index_path, index_path)
+
+
+## Load a previously saved FAISS index
+def load_langchain_faiss_vector_store(index_path, embeddings, index_options=None):
+    """Load a FAISS vector store saved by save_langchain_faiss_vector_store().
 
-    index_file_path = os.path.join(os.getcwd(), "faiss_index_" + str(random.randint(1000, 9999)))
-    db = FAISS.from_documents(documents, embeddings)
-    db.save_local(index_file_path)
+    Args:
+        index_path: Directory the index was saved to.
+        embeddings: Embeddings model used to embed queries.
+        index_options: Optional search parameters (nprobe, ef_search,
+            rescore) overriding the saved ones.
+
+    Returns:
+        A vector store object, or None if no index exists at index_path.
+    """
+    import eda_assistant_faiss_store
+    if not os.path.exists(os.path.join(index_path, "index.faiss")):
+        return None
+    db = eda_assistant_faiss_store.FaissStore.load_local(index_path, embeddings)
+    if index_options:
+        db.set_search_options(index_options.get("nprobe"), index_options.get("ef_search"), index_options.get("rescore"))
     return db
 
 
+## Get a Bedrock chat model, once per model
+@functools.lru_cache(maxsize=None)
+def get_langchain_chat_model(modelID, streaming=False):
+    """BedrockChat for modelID with the default model kwargs, reused until
+    clear_langchain_caches() is called."""
+    from langchain_community.chat_models import BedrockChat
+    return BedrockChat(model_id=modelID,
+                       model_kwargs=get_langchain_model_kwargs(modelID),
+                       client=eda_assistant_bedrock_api.get_rate_limited_bedrock_client(),
+                       streaming=streaming)
+
+
+## Get a RetrievalQA chain, once per model, retriever and prompt template
+def get_langchain_retrievalqa_chain(modelID, retriever, prompt_template):
+    # Retrievers and templates are not hashable, they are keyed by identity and kept alive by the entry
+    key = (modelID, id(retriever), id(prompt_template))
+    with retrievalqa_chains_lock:
+        if key not in retrievalqa_chains:
+            from langchain.chains import RetrievalQA
+            #TODO: need to migrate to new chains
+            qa = RetrievalQA.from_chain_type(
+                llm=get_langchain_chat_model(modelID),
+                chain_type="stuff",
+                retriever=retriever,
+                return_source_documents=True,
+                chain_type_kwargs={"prompt": prompt_template}
+            )
+            retrievalqa_chains[key] = (qa, retriever, prompt_template)
+        return retrievalqa_chains[key][0]
+
+
+## Drop cached retrievers, chat models and chains, e.g. after a knowledge base or model change
+def clear_langchain_caches():
+    get_langchain_kb_retriever.cache_clear()
+    get_langchain_chat_model.cache_clear()
+    with retrievalqa_chains_lock:
+        retrievalqa_chains.clear()
+
+
 # Get response from Langchain RAG, return text output without metadata
-def get_langchain_retrievalqa(modelID, retriever, docs, prompt_template, query):
+def get_langchain_retrievalqa(modelID, retriever, docs, prompt_template, query, conversation=None):
     """Create a retrieval chain for QA.
     
     Args:
@@ -245,29 +437,51 @@ def get_langchain_retrievalqa(modelID, retriever, docs, prompt_template, query):
         prompt_template: A model specific prompt template
         query: original user query
         embeddings: A list of embeddings corresponding to the documents.
+        conversation: Optional eda_assistant_conversation.Conversation whose
+            history is sent with the question
 
     Returns:
         Query Response 
 
     """
-    llm = BedrockChat(model_id=modelID, 
-                      model_kwargs=get_langchain_model_kwargs(modelID),
-                      client=bedrock_client)
-
-    #TODO: need to migrate to new chains
-    qa = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=retriever,
-        return_source_documents=True,
-        chain_type_kwargs={"prompt": prompt_template}
-    )
+    qa = get_langchain_retrievalqa_chain(modelID, retriever, prompt_template)
+    if conversation is None:
+        return qa.invoke(query)
+
+    # The chain would retrieve with the question, history included, retrieve with the retrieval query instead
+    docs = retriever.get_relevant_documents(conversation.get_retrieval_query(query))
+    result = qa.combine_documents_chain.invoke({"input_documents": docs, "question": conversation.get_history_text() + query})
+    return {"query": query, "result": result["output_text"], "source_documents": docs}
+
+
+# Stream response from Langchain RAG, yield text output as it is generated
+def get_langchain_retrievalqa_stream(modelID, retriever, prompt_template, query, conversation=None):
+    """Stream a retrieval QA response, same prompt as get_langchain_retrievalqa().
+
+    Args:
+        modelID : LLM model ID
+        retriever: A retriever object
+        prompt_template: A model specific prompt template
+        query: original user query
+        conversation: Optional eda_assistant_conversation.Conversation whose
+            history is sent with the question
+
+    Returns:
+        A generator of text fragments of the response
+    """
+    llm = get_langchain_chat_model(modelID, streaming=True)
 
-    return qa.invoke(query)
+    history = conversation.get_history_text() if conversation else ""
+    retrieval_query = conversation.get_retrieval_query(query) if conversation else query
+    docs = retriever.get_relevant_documents(retrieval_query)
+    prompt = prompt_template.format(context=format_documents(docs), question=history + query)
+    for chunk in llm.stream(prompt):
+        yield chunk.content
 
 
 # Get model prompt template for langchain retrieval
 def get_langchain_model_prompt(context, question, temperature, max_tokens, topp, topk, modelID):
+    from langchain.prompts import PromptTemplate
 
     #TODO: Move to messages API for claude in langchain
     if modelID in eda_assistant_model_options.anthropic_models:
@@ -4,4 +4,36 @@ anthropic_models = ['anthropic.claude-instant-v1', 'anthropic.claude-v1', 'anthr
 amazon_models = ['amazon.titan-tg1-large', 'amazon.titan-e1t-medium', 'amazon.titan-text-express-v1', 'amazon.titan-embed-g1-text-02', 'amazon.titan-embed-text-v1'] 
 cohere_models = ['cohere.command-text-v14']
 meta_models = ['meta.llama2-13b-v1', 'meta.llama2-70b-chat-v1:0:4k']
-mistral_models = ['mistral.mistral-7b-instruct-v0:2', 'mistral.mixtral-8x7b-instruct-v0:1']
\ No newline at end of file
+mistral_models = ['mistral.mistral-7b-instruct-v0:2', 'mistral.mixtral-8x7b-instruct-v0:1']
+
+# Vector dimension of each embedding model
+embedding_dimensions = {'amazon.titan-embed-text-v1': 1536, 'amazon.titan-embed-g1-text-02': 1536, 'amazon.titan-embed-text-v2:0': 1024, 'cohere.embed-english-v3': 1024, 'cohere.embed-multilingual-v3': 1024}
+
+# Context window in tokens (prompt and response) of each text model
+context_windows = {'anthropic.claude-instant-v1': 100000, 'anthropic.claude-v1': 100000, 'anthropic.claude-v2': 100000, 'anthropic.claude-3-sonnet-20240229-v1:0': 200000, 'anthropic.claude-3-haiku-20240307-v1:0': 200000,
+                   'amazon.titan-tg1-large': 8000, 'amazon.titan-text-express-v1': 8000, 'cohere.command-text-v14': 4000, 'meta.llama2-13b-v1': 4096, 'meta.llama2-70b-chat-v1:0:4k': 4096,
+                   'mistral.mistral-7b-instruct-v0:2': 32000, 'mistral.mixtral-8x7b-instruct-v0:1': 32000}
+default_context_window = 4000
+
+# Tokens of retrieved passages packed into a RAG prompt, lower budgets answer faster and cheaper
+context_budgets = {'anthropic.claude-instant-v1': 6000, 'anthropic.claude-v1': 6000, 'anthropic.claude-v2': 8000, 'anthropic.claude-3-sonnet-20240229-v1:0': 8000, 'anthropic.claude-3-haiku-20240307-v1:0': 8000,
+                   'mistral.mistral-7b-instruct-v0:2': 6000, 'mistral.mixtral-8x7b-instruct-v0:1': 6000, 'amazon.titan-text-express-v1': 3000}
+default_context_budget = 3000
+
+# On-demand requests and tokens per minute quotas of the account for each model, set these to the
+# values in Service Quotas so calls are paced before Bedrock throttles them. 'retrieve' covers
+# knowledge base retrieve and retrieve_and_generate calls, which have no tokens per minute quota
+bedrock_quotas = {'anthropic.claude-instant-v1': {'rpm': 1000, 'tpm': 1000000}, 'anthropic.claude-v1': {'rpm': 500, 'tpm': 500000}, 'anthropic.claude-v2': {'rpm': 500, 'tpm': 500000},
+                  'anthropic.claude-3-sonnet-20240229-v1:0': {'rpm': 500, 'tpm': 1000000}, 'anthropic.claude-3-haiku-20240307-v1:0': {'rpm': 1000, 'tpm': 2000000},
+                  'mistral.mistral-7b-instruct-v0:2': {'rpm': 800, 'tpm': 300000}, 'mistral.mixtral-8x7b-instruct-v0:1': {'rpm': 400, 'tpm': 300000},
+                  'amazon.titan-text-express-v1': {'rpm': 400, 'tpm': 300000}, 'amazon.titan-embed-text-v1': {'rpm': 2000, 'tpm': 300000},
+                  'amazon.titan-embed-g1-text-02': {'rpm': 2000, 'tpm': 300000}, 'amazon.titan-embed-text-v2:0': {'rpm': 2000, 'tpm': 300000},
+                  'cohere.embed-english-v3': {'rpm': 2000, 'tpm': 300000}, 'cohere.embed-multilingual-v3': {'rpm': 2000, 'tpm': 300000}, 'retrieve': {'rpm': 1200}}
+default_bedrock_quota = {'rpm': 100, 'tpm': 100000}
+
+# Tokens of conversation history (rolling summary and recent turns) sent with each question
+history_budgets = {'anthropic.claude-instant-v1': 2000, 'anthropic.claude-v1': 2000, 'anthropic.claude-v2': 3000, 'anthropic.claude-3-sonnet-20240229-v1:0': 3000, 'anthropic.claude-3-haiku-20240307-v1:0': 3000,
+                   'mistral.mistral-7b-instruct-v0:2': 2000, 'mistral.mixtral-8x7b-instruct-v0:1': 2000, 'amazon.titan-text-express-v1': 1000}
+default_history_budget = 1000
+# Model summarizing older conversation turns
+summary_model = 'anthropic.claude-3-haiku-20240307-v1:0'
@@ -1,26 +1,71 @@
 import boto3
+import time
+import random
+import hashlib
+import functools
+import urllib.parse
+import threading
+import eda_assistant_model_options
 from opensearchpy import OpenSearch, RequestsHttpConnection
-from opensearchpy.helpers import bulk
+from opensearchpy.helpers import parallel_bulk, streaming_bulk
 import logging
 
+# Bulk item statuses worth retrying: throttled or server side errors
+retryable_bulk_statuses = [429, 500, 502, 503, 504]
 
-def get_opensearch_cluster_client(name, password, region):
+# Clients by connection parameters, shared so each host keeps one connection pool
+opensearch_clients = {}
+client_lock = threading.Lock()
+
+
+def get_opensearch_cluster_client(name, password, region, pool_maxsize=20, timeout=30):
+    """Get a client for an Amazon OpenSearch Service domain.
+
+    The domain endpoint and the client are cached per domain, so repeated
+    calls reuse one HTTP connection pool instead of describing the domain and
+    opening new connections every time.
+
+    Args:
+    name: Domain name, also used as the master user name.
+    password: Master user password.
+    region: AWS region of the domain.
+    pool_maxsize: Maximum pooled HTTP connections, size it to the number of
+        concurrent bulk threads or queries.
+    timeout: Request timeout in seconds.
+    """
     opensearch_endpoint = get_opensearch_endpoint(name, region)
-    opensearch_client = OpenSearch(
-        hosts=[{
-            'host': opensearch_endpoint,
-            'port': 443
-            }],
-        http_auth=(name, password),
-        index_name = name,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection,
-        timeout=30
-        )
-    return opensearch_client
-    
-    
+    return get_opensearch_client(opensearch_endpoint, 443, (name, password), True, pool_maxsize, timeout)
+
+
+def get_opensearch_client(host, port=443, http_auth=None, use_ssl=True, pool_maxsize=20, timeout=30):
+    """Get a cached client for an OpenSearch host, such as a local container.
+
+    Args:
+    host, port: OpenSearch endpoint.
+    http_auth: Optional (user, password) tuple.
+    use_ssl: Connect over HTTPS and verify certificates.
+    pool_maxsize: Maximum pooled HTTP connections.
+    timeout: Request timeout in seconds.
+    """
+    client_key = (host, port, http_auth, use_ssl, pool_maxsize, timeout)
+    with client_lock:
+        if client_key not in opensearch_clients:
+            opensearch_clients[client_key] = OpenSearch(
+                hosts=[{
+                    'host': host,
+                    'port': port
+                    }],
+                http_auth=http_auth,
+                use_ssl=use_ssl,
+                verify_certs=use_ssl,
+                connection_class=RequestsHttpConnection,
+                pool_maxsize=pool_maxsize,
+                timeout=timeout
+                )
+        return opensearch_clients[client_key]
+
+
+@functools.lru_cache(maxsize=None)
 def get_opensearch_endpoint(name, region):
     client = boto3.client('es', region_name=region)
     response = client.describe_elasticsearch_domain(
@@ -30,41 +75,296 @@ def get_opensearch_endpoint(name, region):
 
 
 def put_bulk_in_opensearch(list, client):
+    """Index a list of bulk actions, kept for existing callers.
+
+    Returns:
+    A tuple of (number of documents indexed, list of failed item infos), see
+    put_streaming_bulk_in_opensearch(). Actions without an "_id" are not retried.
+    """
     logging.info(f"Putting {len(list)} documents in OpenSearch")
-    success, failed = bulk(client, list)
+    return put_streaming_bulk_in_opensearch(client, list)
+
+
+def generate_opensearch_actions(index_name, documents, embeddings, embed_batch_size=64):
+    """Yield bulk index actions for documents, embedding them batch by batch
+    so only one batch of vectors is held in memory at a time.
+
+    Args:
+    index_name: Index to write to.
+    documents: Iterable of LangChain documents, may be a generator.
+    embeddings: LangChain embeddings model.
+    embed_batch_size: Number of documents embedded per call.
+    """
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) == embed_batch_size:
+            yield from _get_opensearch_actions(index_name, batch, embeddings)
+            batch = []
+    if batch:
+        yield from _get_opensearch_actions(index_name, batch, embeddings)
+
+
+def _get_opensearch_actions(index_name, documents, embeddings):
+    vectors = embeddings.embed_documents([document.page_content for document in documents])
+    for document, vector in zip(documents, vectors):
+        doc_id = document.metadata.get("id") or hashlib.sha256(
+            (str(document.metadata.get("source", "")) + "|" + document.page_content).encode("utf-8")).hexdigest()
+        yield {
+            "_index": index_name,
+            "_id": doc_id,
+            "_source": {
+                "vector_field": vector,
+                "text": document.page_content,
+                "metadata": document.metadata
+            }
+        }
+
+
+def put_streaming_bulk_in_opensearch(client, actions, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024,
+                                     thread_count=4, queue_size=4, max_retries=3, progress_every=1000):
+    """Stream actions into OpenSearch with parallel_bulk, then retry only the
+    items that failed with a retryable status.
+
+    The actions generator is consumed only as fast as the bulk threads drain
+    it (at most queue_size chunks ahead), so memory stays bounded no matter
+    how large the corpus is.
+
+    Args:
+    client: OpenSearch client.
+    actions: Iterable of bulk actions, only those with an "_id" are retried.
+    chunk_size: Maximum documents per bulk request.
+    max_chunk_bytes: Maximum bytes per bulk request.
+    thread_count: Number of bulk requests in flight.
+    queue_size: Number of chunks buffered ahead of the threads.
+    max_retries: Retry rounds for failed items, with jittered exponential backoff.
+    progress_every: Report progress every this many documents.
+
+    Returns:
+    A tuple of (number of documents indexed, list of failed item infos).
+    """
+    in_flight = {}
+
+    def track(actions):
+        for action in actions:
+            # Items are matched to their actions by _id, actions without one are not retried
+            if "_id" in action:
+                in_flight[action["_id"]] = action
+            yield action
+
+    start_time = time.perf_counter()
+    success = 0
+    retry_actions = []
+    failed = []
+    for ok, item in parallel_bulk(client, track(actions), thread_count=thread_count, chunk_size=chunk_size,
+                                  max_chunk_bytes=max_chunk_bytes, queue_size=queue_size,
+                                  raise_on_error=False, raise_on_exception=False):
+        info = next(iter(item.values()))
+        action = in_flight.pop(info.get("_id"), None)
+        if ok:
+            success += 1
+            if success % progress_every == 0:
+                elapsed = time.perf_counter() - start_time
+                logging.info(f"Indexed {success} documents, {success / elapsed:.1f} docs/sec")
+                print(f"-I- Indexed {success} documents, {success / elapsed:.1f} docs/sec")
+        elif action is not None and info.get("status") in retryable_bulk_statuses:
+            retry_actions.append(action)
+        else:
+            failed.append(info)
+
+    for attempt in range(max_retries):
+        if not retry_actions:
+            break
+        time.sleep(random.uniform(0, min(30, 2 ** (attempt + 1))))
+        print(f"-I- Retrying {len(retry_actions)} failed documents, attempt {attempt + 1}")
+        retry_by_id = {action["_id"]: action for action in retry_actions}
+        retry_actions = []
+        for ok, item in streaming_bulk(client, list(retry_by_id.values()), chunk_size=chunk_size,
+                                       max_chunk_bytes=max_chunk_bytes, raise_on_error=False, raise_on_exception=False):
+            info = next(iter(item.values()))
+            if ok:
+                success += 1
+            elif info.get("status") in retryable_bulk_statuses and attempt < max_retries - 1:
+                retry_actions.append(retry_by_id[info["_id"]])
+            else:
+                failed.append(info)
+    failed.extend({"_id": action["_id"], "status": None, "error": "not retried"} for action in retry_actions)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"-I- Indexed {success} documents in {elapsed:.2f}s, {success / max(elapsed, 1e-9):.1f} docs/sec, {len(failed)} failed")
     return success, failed
 
+
+def get_opensearch_client_from_url(url, user=None, password=None, pool_maxsize=20, timeout=30):
+    """Get a cached client for an OpenSearch URL such as http://localhost:9200."""
+    parsed_url = urllib.parse.urlparse(url if "://" in url else "https://" + url)
+    use_ssl = parsed_url.scheme == "https"
+    port = parsed_url.port or (443 if use_ssl else 80)
+    http_auth = (user, password) if user else None
+    return get_opensearch_client(parsed_url.hostname, port, http_auth, use_ssl, pool_maxsize, timeout)
+
+
+def search_opensearch_index(opensearch_client, index_name, query_vector, query_text=None, numberOfResults=5,
+                            filters=None, hybrid=False, source_includes=("text", "metadata"), num_candidates=None):
+    """Query a k-NN index created by create_index().
+
+    Args:
+    opensearch_client: OpenSearch client.
+    index_name: Index to query.
+    query_vector: Embedding of the query.
+    query_text: Query text, required for hybrid queries.
+    numberOfResults: Number of results to return.
+    filters: Optional dictionary of metadata field to a value or list of
+        values. Filters are applied to the k-NN candidates, so raise
+        num_candidates when filters are selective.
+    hybrid: Combine the k-NN score with a BM25 match on the text field.
+    source_includes: Source fields to return, the vector is never returned.
+    num_candidates: Number of k-NN candidates, defaults to numberOfResults.
+
+    Returns:
+    A list of results in the format of the knowledge base retrieve API
+    ('content', 'location', 'metadata', 'score'), so they can be used
+    wherever retrievalResults are.
+    """
+    knn_query = {"knn": {"vector_field": {"vector": query_vector, "k": num_candidates or numberOfResults}}}
+    query = {"bool": {"should": [knn_query], "minimum_should_match": 1}}
+    if hybrid:
+        query["bool"]["should"].append({"match": {"text": {"query": query_text}}})
+    if filters:
+        query["bool"]["filter"] = [
+            {"terms" if isinstance(value, list) else "term": {f"metadata.{field}.keyword": value}}
+            for field, value in filters.items()
+        ]
+    body = {
+        "size": numberOfResults,
+        "query": query,
+        "_source": {"includes": list(source_includes)}
+    }
+    response = opensearch_client.search(index=index_name, body=body)
+
+    retrievalResults = []
+    for hit in response["hits"]["hits"]:
+        metadata = hit["_source"].get("metadata", {})
+        source = str(metadata.get("source", ""))
+        if source.startswith("s3://"):
+            location = {"type": "S3", "s3Location": {"uri": source}}
+        else:
+            location = {"type": "OPENSEARCH", "opensearchLocation": {"index": index_name, "id": hit["_id"], "source": source}}
+        retrievalResults.append({
+            "content": {"text": hit["_source"].get("text", "")},
+            "location": location,
+            "metadata": metadata,
+            "score": hit["_score"]
+        })
+    return retrievalResults
+
+
+def get_opensearch_retrieve_fn(opensearch_client, index_name, embeddings, filters=None, hybrid=False):
+    """Get a function (query, numberOfResults) -> retrievalResults for the RAG query engine."""
+    def retrieve_fn(query, numberOfResults):
+        return search_opensearch_index(opensearch_client, index_name, embeddings.embed_query(query), query,
+                                       numberOfResults, filters, hybrid)
+    return retrieve_fn
+
+
+def get_opensearch_index_version(opensearch_client, index_name):
+    """Get a version string that changes when an index is recreated or its
+    document count changes, used to invalidate cached responses."""
+    settings = opensearch_client.indices.get_settings(index=index_name)
+    index_uuid = next(iter(settings.values()))["settings"]["index"]["uuid"]
+    return f"{index_uuid}:{opensearch_client.count(index=index_name)['count']}"
+
+
 def check_opensearch_index(opensearch_client, index_name):
     return opensearch_client.indices.exists(index=index_name)
 
 
-def create_index(opensearch_client, index_name):
-    settings = {
+def get_index_vector_mapping(embeddings_modelid, engine="nmslib", space_type="cosinesimil", ef_construction=512, m=16, dimension=None):
+    """Build the mapping of the vector and text fields for an embedding model.
+
+    Args:
+    embeddings_modelid: Embedding model ID, selects the vector dimension.
+    engine: k-NN engine, "nmslib", "faiss" or "lucene".
+    space_type: Distance function, e.g. "cosinesimil", "l2" or "innerproduct".
+    ef_construction, m: HNSW graph parameters, higher values improve recall
+        at the cost of indexing time and memory.
+    dimension: Vector dimension, only needed for models not listed in
+        eda_assistant_model_options.embedding_dimensions.
+    """
+    if dimension is None:
+        if embeddings_modelid not in eda_assistant_model_options.embedding_dimensions:
+            raise ValueError(f"Unknown vector dimension for embedding model {embeddings_modelid}")
+        dimension = eda_assistant_model_options.embedding_dimensions[embeddings_modelid]
+
+    return {
+        "properties": {
+            "vector_field": {
+                "type": "knn_vector",
+                "dimension": dimension,
+                "method": {
+                    "name": "hnsw",
+                    "engine": engine,
+                    "space_type": space_type,
+                    "parameters": {
+                        "ef_construction": ef_construction,
+                        "m": m
+                    }
+                }
+            },
+            "text": {
+                "type": "text"
+            },
+            "metadata": {
+                "type": "object"
+            }
+        }
+    }
+
+
+def create_index(opensearch_client, index_name, embeddings_modelid="amazon.titan-embed-text-v1", engine="nmslib", space_type="cosinesimil",
+                 ef_construction=512, m=16, ef_search=512, number_of_shards=1, number_of_replicas=1, dimension=None):
+    """Create a k-NN index with its mapping.
+
+    Args:
+    opensearch_client: OpenSearch client.
+    index_name: Index to create.
+    embeddings_modelid, engine, space_type, ef_construction, m, dimension:
+        See get_index_vector_mapping().
+    ef_search: HNSW candidate list size at query time, higher values improve
+        recall at the cost of query latency. Can be changed later with
+        set_index_ef_search().
+    number_of_shards, number_of_replicas: Index sharding and replication.
+    """
+    body = {
         "settings": {
             "index": {
                 "knn": True,
-                "knn.space_type": "cosinesimil"
+                "knn.algo_param.ef_search": ef_search,
+                "number_of_shards": number_of_shards,
+                "number_of_replicas": number_of_replicas
                 }
-            }
+            },
+        "mappings": get_index_vector_mapping(embeddings_modelid, engine, space_type, ef_construction, m, dimension)
         }
-    response = opensearch_client.indices.create(index=index_name, body=settings)
+    response = opensearch_client.indices.create(index=index_name, body=body)
     return bool(response['acknowledged'])
     
     
-def create_index_mapping(opensearch_client, index_name):
+def create_index_mapping(opensearch_client, index_name, embeddings_modelid="amazon.titan-embed-text-v1", engine="nmslib", space_type="cosinesimil",
+                         ef_construction=512, m=16, dimension=None):
+    """Add the vector and text mapping to a k-NN index created without one."""
     response = opensearch_client.indices.put_mapping(
         index=index_name,
-        body={
-            "properties": {
-                "vector_field": {
-                    "type": "knn_vector",
-                    "dimension": 1536
-                },
-                "text": {
-                    "type": "keyword"
-                }
-            }
-        }
+        body=get_index_vector_mapping(embeddings_modelid, engine, space_type, ef_construction, m, dimension)
+    )
+    return bool(response['acknowledged'])
+
+
+def set_index_ef_search(opensearch_client, index_name, ef_search):
+    """Change the query time HNSW ef_search of an existing index."""
+    response = opensearch_client.indices.put_settings(
+        index=index_name,
+        body={"index": {"knn.algo_param.ef_search": ef_search}}
     )
     return bool(response['acknowledged'])
 
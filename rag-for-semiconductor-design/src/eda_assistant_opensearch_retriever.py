@@ -0,0 +1,28 @@
+## LangChain retriever over the OpenSearch k-NN indexes of eda_assistant_opensearch_api
+from typing import Any, Dict, List, Optional
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+import eda_assistant_opensearch_api
+
+
+class OpenSearchKnnRetriever(BaseRetriever):
+    """Retrieves documents with k-NN or hybrid (BM25 + vector) queries."""
+
+    client: Any
+    index_name: str
+    embeddings: Embeddings
+    numberOfResults: int = 4
+    filters: Optional[Dict[str, Any]] = None
+    hybrid: bool = False
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        retrievalResults = eda_assistant_opensearch_api.search_opensearch_index(
+            self.client, self.index_name, self.embeddings.embed_query(query), query,
+            self.numberOfResults, self.filters, self.hybrid)
+        return [
+            Document(page_content=result["content"]["text"],
+                     metadata={**result["metadata"], "location": result["location"], "score": result["score"]})
+            for result in retrievalResults
+        ]
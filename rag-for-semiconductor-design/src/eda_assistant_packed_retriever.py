@@ -0,0 +1,23 @@
+## LangChain retriever that packs the documents of another retriever into a token budget
+from typing import List
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+import eda_assistant_context_packer
+import eda_assistant_tracing
+
+
+class PackedRetriever(BaseRetriever):
+    """Drops overlapping documents and fits the rest into the context budget of modelID."""
+
+    retriever: BaseRetriever
+    modelID: str
+    maxtokens: int
+    prompt_overhead_tokens: int = 0
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        docs = self.retriever.get_relevant_documents(query, callbacks=run_manager.get_child())
+        with eda_assistant_tracing.span("context_pack"):
+            packed_docs, stats = eda_assistant_context_packer.pack_documents(docs, self.modelID, self.maxtokens, self.prompt_overhead_tokens)
+            eda_assistant_tracing.set_attributes(**stats)
+        return packed_docs
@@ -1,8 +1,20 @@
 import logging
 import boto3
+import time
+import functools
+import threading
 import urllib.parse
+from collections import OrderedDict
 from botocore.exceptions import ClientError
 
+# Signed URLs by (S3 URI, expiration), as (url, expiry time), least recently used first
+presigned_url_cache = OrderedDict()
+max_cached_urls = 1024
+# Sign again once less than this fraction of the expiration is left
+refresh_margin = 0.2
+client_lock = threading.Lock()
+cache_lock = threading.Lock()
+
 
 def parse_s3_uri(s3_uri):
     # Parse the S3 URI
@@ -18,6 +30,13 @@ def parse_s3_uri(s3_uri):
     else:
         raise ValueError("Not a valid S3 URI")
 
+# S3 client shared by every signing call, created on first use
+@functools.lru_cache(maxsize=None)
+def get_s3_client():
+    with client_lock:
+        return boto3.client('s3')
+
+
 #expiration 5 min
 def create_presigned_url(s3_uri, expiration=300):
     """Generate a presigned URL to share an S3 object
@@ -27,9 +46,16 @@ def create_presigned_url(s3_uri, expiration=300):
     :param expiration: Time in seconds for the presigned URL to remain valid
     :return: Presigned URL as string. If error, returns None.
     """
+    # Reuse a URL signed earlier while it stays valid for a while longer
+    with cache_lock:
+        cached_url = presigned_url_cache.get((s3_uri, expiration))
+        if cached_url and cached_url[1] - time.time() > expiration * refresh_margin:
+            presigned_url_cache.move_to_end((s3_uri, expiration))
+            return cached_url[0]
+
     bucket_name, object_name = parse_s3_uri(s3_uri)
     # Generate a presigned URL for the S3 object
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client()
     try:
         response = s3_client.generate_presigned_url('get_object',
                                                     Params={'Bucket': bucket_name,
@@ -39,5 +65,31 @@ def create_presigned_url(s3_uri, expiration=300):
         logging.error(e)
         return None
 
+    with cache_lock:
+        now = time.time()
+        presigned_url_cache[(s3_uri, expiration)] = (response, now + expiration)
+        presigned_url_cache.move_to_end((s3_uri, expiration))
+        # Drop expired URLs, then the least recently used beyond max_cached_urls
+        for key in [key for key, (_, expiry_time) in presigned_url_cache.items() if expiry_time <= now]:
+            del presigned_url_cache[key]
+        while len(presigned_url_cache) > max_cached_urls:
+            presigned_url_cache.popitem(last=False)
     # The response contains the presigned URL
-    return response
\ No newline at end of file
+    return response
+
+
+# Resolve all citations of an answer at once
+def create_presigned_urls(s3_uris, expiration=300):
+    """Generate presigned URLs for a list of S3 URIs.
+
+    :param s3_uris: list of S3 URIs, may contain duplicates
+    :param expiration: Time in seconds for the presigned URLs to remain valid
+    :return: List of presigned URLs for the unique URIs, in first-seen order.
+        URIs that could not be signed are left out.
+    """
+    presigned_urls = []
+    for s3_uri in dict.fromkeys(s3_uris):
+        presigned_url = create_presigned_url(s3_uri, expiration)
+        if presigned_url:
+            presigned_urls.append(presigned_url)
+    return presigned_urls
@@ -0,0 +1,128 @@
+## RAG Query Engine
+# Retrieves from the knowledge base once and reuses the same result set
+# for prompt context and citations.
+import eda_assistant_bedrock_api
+import eda_assistant_tracing
+import eda_assistant_tokens
+import eda_assistant_context_packer
+import eda_assistant_reranker
+
+
+# Build the RAG prompt from retrieved passages
+def get_rag_prompt(contexts, question, history=""):
+    """Generate a RAG prompt that embeds the retrieved passages.
+
+    Args:
+    contexts: A list of retrieved passage texts
+    question: Original User Query
+    history: Conversation history text, see eda_assistant_conversation
+
+    Returns:
+    A prompt string to send to the model.
+    """
+    context_text = "\n\n".join(contexts)
+    rag_prompt = f"""You are an expert semiconductor chip design engineer with deep knowledge about electronic design automation tools and chip design flows.
+Use the following pieces of context to provide a concise answer to the question at the end. If asked a code related task, just output the code.
+If you don't know the answer, just say that you don't know, don't try to make up an answer.
+
+<context>
+{context_text}
+</context>
+
+{history}Question: {question}"""
+    return rag_prompt
+
+
+# Get response from the RAG query engine
+def get_rag_response(query, kbId, modelID, temperature, topp, topk, maxtokens, numberOfResults=5, stream=False, retrieve_fn=None, conversation=None):
+    """Retrieve once from the knowledge base, generate a response from the
+    retrieved passages and build citations from the same result set.
+
+    Args:
+    query: Original User Query
+    kbId: Knowledge Base ID
+    modelID: LLM specific Model identifier
+    temperature, topp, topk, maxtokens: Model parameters
+    numberOfResults: Number of passages to retrieve, after reranking
+    stream: Return the generated text as a generator of text fragments
+    retrieve_fn: Optional function (query, numberOfResults) -> retrievalResults
+        used instead of the knowledge base, e.g. an OpenSearch index
+    conversation: Optional eda_assistant_conversation.Conversation whose
+        history is sent with the question
+
+    Returns:
+    A dictionary with the generated 'result', the token 'usage' (None when
+    streaming), the 'retrievalResults' packed into the prompt as context and
+    the de-duplicated S3 'citations' of those passages.
+    """
+    history = conversation.get_history_text() if conversation else ""
+    retrieval_query = conversation.get_retrieval_query(query) if conversation else query
+    retrievalResults = retrieve_results(retrieval_query, kbId, numberOfResults, retrieve_fn)
+    return generate_rag_response(query, retrievalResults, modelID, temperature, topp, topk, maxtokens, stream, history)
+
+
+# Retrieve passages from the knowledge base, or from retrieve_fn if given
+def retrieve_results(query, kbId, numberOfResults=5, retrieve_fn=None):
+    """Retrieve numberOfResults passages, the best of
+    eda_assistant_reranker.num_candidates if reranking is enabled."""
+    rerank = eda_assistant_reranker.num_candidates > numberOfResults
+    numberOfCandidates = eda_assistant_reranker.num_candidates if rerank else numberOfResults
+    with eda_assistant_tracing.span("retrieve", source="opensearch" if retrieve_fn is not None else "knowledge_base") as retrieve_span:
+        if retrieve_fn is not None:
+            retrievalResults = retrieve_fn(query, numberOfCandidates)
+        else:
+            retrieve_response = eda_assistant_bedrock_api.retrieve(query, kbId, numberOfCandidates)
+            retrievalResults = retrieve_response['retrievalResults']
+        if retrieve_span:
+            retrieve_span.set_attributes(chunks=len(retrievalResults))
+
+    if rerank:
+        with eda_assistant_tracing.span("rerank"):
+            retrievalResults, rerank_stats = eda_assistant_reranker.rerank_retrieval_results(query, retrievalResults, numberOfResults)
+            eda_assistant_tracing.set_attributes(**rerank_stats)
+    return retrievalResults
+
+
+# Pack retrieved passages into the model's context budget and build the RAG prompt
+def build_rag_prompt(query, retrievalResults, modelID, maxtokens, history=""):
+    """Returns:
+    A tuple of the RAG prompt and the retrievalResults packed into it.
+    """
+    # Drop overlapping passages and fit the rest into the model's context budget
+    with eda_assistant_tracing.span("context_pack"):
+        prompt_overhead_tokens = eda_assistant_tokens.count_tokens(eda_assistant_bedrock_api.get_system_prompt(modelID) + get_rag_prompt([], query, history), modelID)
+        retrievalResults, pack_stats = eda_assistant_context_packer.pack_retrieval_results(retrievalResults, modelID, maxtokens, prompt_overhead_tokens)
+        eda_assistant_tracing.set_attributes(**pack_stats)
+
+    with eda_assistant_tracing.span("prompt_build", chunks=len(retrievalResults)) as prompt_span:
+        contexts = eda_assistant_bedrock_api.get_contexts(retrievalResults)
+        rag_prompt = get_rag_prompt(contexts, query, history)
+        if prompt_span:
+            prompt_span.set_attributes(prompt_chars=len(rag_prompt), history_chars=len(history))
+    return rag_prompt, retrievalResults
+
+
+# Generate a response from already retrieved passages
+def generate_rag_response(query, retrievalResults, modelID, temperature, topp, topk, maxtokens, stream=False, history=""):
+    rag_prompt, retrievalResults = build_rag_prompt(query, retrievalResults, modelID, maxtokens, history)
+    usage = None
+    if stream:
+        generated_text = eda_assistant_tracing.trace_stream(eda_assistant_bedrock_api.get_bedrock_response_stream(rag_prompt, modelID, temperature, topp, topk, maxtokens), model=modelID)
+    else:
+        generated_text, usage = generate_response(rag_prompt, modelID, temperature, topp, topk, maxtokens)
+
+    return {
+        'result': generated_text,
+        'usage': usage,
+        'retrievalResults': retrievalResults,
+        'citations': eda_assistant_bedrock_api.get_citation_uris(retrievalResults)
+    }
+
+
+# Generate a response to a complete prompt in a traced "generate" phase
+def generate_response(prompt, modelID, temperature, topp, topk, maxtokens):
+    with eda_assistant_tracing.span("generate", model=modelID) as generate_span:
+        generated_text, usage = eda_assistant_bedrock_api.get_bedrock_response_and_usage(prompt, modelID, temperature, topp, topk, maxtokens)
+        if generate_span:
+            generate_span.set_attributes(**usage)
+    return generated_text, usage
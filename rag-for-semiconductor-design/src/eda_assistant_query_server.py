@@ -0,0 +1,154 @@
+## Local HTTP/JSON API in front of the asynchronous query engine
+# Built on tornado, which streamlit already depends on, and served on the
+# engine's event loop so a request is a coroutine, not a thread.
+#
+#   POST /query    {"prompt": "...", "model": "...", "rag": true, "temperature": 0.1,
+#                   "top_p": 0.5, "top_k": 50, "max_tokens": 1000, "num_results": 5,
+#                   "stream": false, "conversation_id": "..."}
+#                  Answers with the query result as JSON, or with "stream": true
+#                  as JSON lines: {"text": ...} per fragment, then the result.
+#                  Queries with the same "conversation_id" are answered as
+#                  follow-ups of the earlier ones.
+#   GET  /health   Engine load
+#   GET  /metrics  Bedrock call counters
+import json
+import threading
+from collections import OrderedDict
+import eda_assistant_bedrock_calls
+import eda_assistant_conversation
+import eda_assistant_tokens
+
+# Conversations kept by the server, the least recently used are dropped
+max_conversations = 1000
+
+
+class ConversationStore:
+    """Conversations by id, used from the event loop thread only."""
+
+    def __init__(self, max_entries=max_conversations):
+        self.max_entries = max_entries
+        self.conversations = OrderedDict()
+
+    def get(self, conversation_id, modelID):
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None or conversation.modelID != modelID:
+            conversation = eda_assistant_conversation.Conversation(modelID)
+            self.conversations[conversation_id] = conversation
+        self.conversations.move_to_end(conversation_id)
+        while len(self.conversations) > self.max_entries:
+            self.conversations.popitem(last=False)
+        return conversation
+
+    def __len__(self):
+        return len(self.conversations)
+
+
+def get_query_args(body, defaults, conversations=None):
+    """Map a /query request body onto AsyncQueryEngine.query() arguments.
+
+    Args:
+    body: The decoded request body
+    defaults: Default query arguments, see get_application()
+    conversations: ConversationStore for requests with a "conversation_id"
+
+    Raises:
+    ValueError if the body is invalid.
+    """
+    if not isinstance(body, dict) or not isinstance(body.get("prompt"), str) or not body["prompt"].strip():
+        raise ValueError('The request body must be a JSON object with a non-empty "prompt"')
+    rag = body.get("rag", defaults["kbId"] is not None)
+    if rag and defaults["kbId"] is None:
+        raise ValueError("RAG is not available, the server was started without --kbid or --opensearch_index")
+    conversation_id = body.get("conversation_id")
+    if conversation_id is not None and not isinstance(conversation_id, str):
+        raise ValueError('"conversation_id" must be a string')
+    modelID = body.get("model", defaults["modelID"])
+    return {
+        "query": body["prompt"],
+        "modelID": modelID,
+        "kbId": defaults["kbId"] if rag else None,
+        "retrieve_fn": defaults["retrieve_fn"] if rag else None,
+        "temperature": float(body.get("temperature", defaults["temperature"])),
+        "topp": float(body.get("top_p", defaults["topp"])),
+        "topk": int(body.get("top_k", defaults["topk"])),
+        "maxtokens": int(body.get("max_tokens", defaults["maxtokens"])),
+        "numberOfResults": int(body.get("num_results", defaults["numberOfResults"])),
+        "trace_file": defaults["trace_file"],
+        "conversation": conversations.get(conversation_id, modelID) if conversations is not None and conversation_id else None,
+    }
+
+
+def get_json_result(result):
+    return {key: value for key, value in result.items() if key != "trace"}
+
+
+def get_application(engine, defaults):
+    """Create the tornado application.
+
+    Args:
+    engine: eda_assistant_async_engine.AsyncQueryEngine answering the queries
+    defaults: Default query arguments: modelID, kbId (None disables RAG),
+        retrieve_fn, temperature, topp, topk, maxtokens, numberOfResults and
+        trace_file.
+    """
+    import tornado.web
+
+    conversations = ConversationStore()
+
+    class QueryHandler(tornado.web.RequestHandler):
+        def write_error(self, status_code, **kwargs):
+            error = kwargs["exc_info"][1] if "exc_info" in kwargs else None
+            if error is not None and error.__cause__ is not None:
+                error = error.__cause__
+            self.finish({"error": str(error) if error else self._reason})
+
+        async def post(self):
+            try:
+                body = json.loads(self.request.body or b"null")
+                query_args = get_query_args(body, defaults, conversations)
+            except ValueError as e:
+                raise tornado.web.HTTPError(400, reason="Bad Request") from e
+            try:
+                if body.get("stream"):
+                    self.set_header("Content-Type", "application/x-ndjson")
+                    started = False
+                    try:
+                        async for event in engine.query_stream(mode="server", **query_args):
+                            self.write(json.dumps(get_json_result(event)) + "\n")
+                            await self.flush()
+                            started = True
+                    except Exception as e:
+                        # The status line is already sent, report the error as the last line
+                        if not started:
+                            raise
+                        self.write(json.dumps({"error": str(e)}) + "\n")
+                else:
+                    result = await engine.query(mode="server", **query_args)
+                    self.write(get_json_result(result))
+            except eda_assistant_tokens.TokenBudgetError as e:
+                raise tornado.web.HTTPError(400, reason="Prompt Too Long") from e
+            except eda_assistant_bedrock_calls.CircuitOpenError as e:
+                raise tornado.web.HTTPError(503, reason="Model Unavailable") from e
+
+    class HealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.write({"status": "ok", **engine.get_stats(), "conversations": len(conversations)})
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.write({"bedrock_calls": eda_assistant_bedrock_calls.get_metrics(), "engine": engine.get_stats()})
+
+    return tornado.web.Application([(r"/query", QueryHandler), (r"/health", HealthHandler), (r"/metrics", MetricsHandler)])
+
+
+## Serve the API until interrupted
+def serve(engine, defaults, host="127.0.0.1", port=8765):
+    async def start():
+        get_application(engine, defaults).listen(port, address=host)
+
+    engine.run(start())
+    print(f"-I- Query API listening on http://{host}:{port} (POST /query, GET /health, GET /metrics)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print("\n-I- Query API stopped")
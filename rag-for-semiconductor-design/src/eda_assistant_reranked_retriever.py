@@ -0,0 +1,21 @@
+## LangChain retriever that reranks the documents of another retriever and keeps the best
+from typing import List
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+import eda_assistant_reranker
+import eda_assistant_tracing
+
+
+class RerankedRetriever(BaseRetriever):
+    """Rescores the over-fetched documents of retriever with eda_assistant_reranker and keeps top_n."""
+
+    retriever: BaseRetriever
+    top_n: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        docs = self.retriever.get_relevant_documents(query, callbacks=run_manager.get_child())
+        with eda_assistant_tracing.span("rerank"):
+            reranked_docs, stats = eda_assistant_reranker.rerank_documents(query, docs, self.top_n)
+            eda_assistant_tracing.set_attributes(**stats)
+        return reranked_docs
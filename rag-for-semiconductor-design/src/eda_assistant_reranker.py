@@ -0,0 +1,162 @@
+## Local lexical reranking of retrieved passages
+# Retrieval over-fetches num_candidates passages, which are rescored here on
+# the CPU and cut to the few that reach the prompt. The score is BM25 over the
+# candidate set, plus boosts for passages containing the exact HDL
+# identifiers (xpm_memory_spram), tool commands (report_timing, xrun) and
+# error codes (Synth 8-327, TIM-104) of the question, plus a share of the
+# retrieval score so semantic matches without shared words are not lost.
+import re
+import math
+
+# Passages fetched before reranking, 0 disables reranking
+num_candidates = 30
+# BM25 parameters
+bm25_k1 = 1.2
+bm25_b = 0.75
+# Weights of the BM25 score and the retrieval score, both scaled to [0, 1]
+bm25_weight = 1.0
+retrieval_weight = 0.5
+# Added for each exact term of the question found in the passage
+identifier_boost = 1.0
+command_boost = 0.5
+error_code_boost = 2.0
+
+# Tool commands that do not look like identifiers
+command_names = {'vcs', 'xrun', 'irun', 'ncsim', 'ncvlog', 'xmvlog', 'xmelab', 'xmsim', 'vlog', 'vcom', 'vsim', 'vlib', 'vopt',
+                 'xvlog', 'xvhdl', 'xelab', 'xsim', 'vivado', 'quartus', 'verdi', 'dve', 'simv', 'genus', 'innovus', 'tempus',
+                 'voltus', 'virtuoso', 'spectre', 'ultrasim', 'hspice', 'calibre', 'primetime', 'formality', 'conformal',
+                 'spyglass', 'verilator', 'iverilog', 'yosys', 'openroad', 'openlane', 'magic', 'netgen', 'klayout'}
+
+word_pattern = re.compile(r"\$?[A-Za-z_][A-Za-z0-9_$]*|\d+")
+# Vivado "[Synth 8-327]", Synopsys "TIM-104", Cadence "*E,NOTDIR"
+error_code_patterns = [re.compile(r"\b[A-Z][A-Za-z]+ \d+-\d+\b"), re.compile(r"\b[A-Z]{2,}-\d+\b"), re.compile(r"\*[EFW],[A-Z0-9]+\b")]
+# Command line options such as -max_paths
+option_pattern = re.compile(r"(?<![\w-])-[a-z][a-z0-9_]+\b")
+
+
+def get_terms(text):
+    """Lower case words of text for BM25, identifiers also as their parts."""
+    terms = []
+    for word in word_pattern.findall(text.lower()):
+        terms.append(word)
+        if "_" in word:
+            terms.extend(part for part in word.strip("$").split("_") if part)
+    return terms
+
+
+def is_identifier(word):
+    # xpm_memory_spram, clk_div2, $display, fifo32: names rather than prose
+    return "_" in word or word.startswith("$") or (any(c.isdigit() for c in word) and any(c.isalpha() for c in word))
+
+
+## Exact terms of the question worth boosting
+def get_exact_terms(query):
+    """Returns:
+    A list of (kind, regular expression, boost) for the identifiers, tool
+    commands, options and error codes in query.
+    """
+    exact_terms = {}
+    for pattern in error_code_patterns:
+        for code in pattern.findall(query):
+            # "Synth 8-327" also matches "Synth  8-327" and "Synth-8-327"
+            exact_terms[code.lower()] = ("error_code", r"[\s-]+".join(map(re.escape, re.split(r"[\s-]+", code))), error_code_boost)
+    for option in option_pattern.findall(query):
+        exact_terms.setdefault(option.lstrip("-").lower(), ("command", re.escape(option), command_boost))
+    for word in word_pattern.findall(query):
+        key = word.lower()
+        if key in exact_terms or len(word) < 3:
+            continue
+        if key in command_names:
+            exact_terms[key] = ("command", re.escape(word), command_boost)
+        elif is_identifier(word):
+            exact_terms[key] = ("identifier", re.escape(word), identifier_boost)
+    return [(kind, re.compile(r"(?<![\w$])" + expression + r"(?![\w$])", re.IGNORECASE), boost)
+            for kind, expression, boost in exact_terms.values()]
+
+
+def get_bm25_scores(query_terms, passage_terms):
+    """BM25 of each passage, with document frequencies over the passages themselves."""
+    num_passages = len(passage_terms)
+    if not num_passages:
+        return []
+    average_length = sum(len(terms) for terms in passage_terms) / num_passages or 1
+    term_counts = []
+    document_frequency = {}
+    for terms in passage_terms:
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        term_counts.append(counts)
+        for term in counts:
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+    idf = {term: math.log(1 + (num_passages - document_frequency.get(term, 0) + 0.5) / (document_frequency.get(term, 0) + 0.5))
+           for term in set(query_terms)}
+    scores = []
+    for terms, counts in zip(passage_terms, term_counts):
+        length_norm = bm25_k1 * (1 - bm25_b + bm25_b * len(terms) / average_length)
+        score = 0.0
+        for term in query_terms:
+            count = counts.get(term, 0)
+            if count:
+                score += idf[term] * count * (bm25_k1 + 1) / (count + length_norm)
+        scores.append(score)
+    return scores
+
+
+def scale(values):
+    """Scale values to [0, 1], all 0 if they are equal."""
+    low, high = min(values), max(values)
+    if high <= low:
+        return [0.0] * len(values)
+    return [(value - low) / (high - low) for value in values]
+
+
+## Rerank passages
+def rerank_passages(query, passages, top_n):
+    """Rescore passages for query and keep the best top_n.
+
+    Args:
+    query: Original User Query
+    passages: A list of (text, retrieval score) tuples, a None score keeps
+        the retrieval order.
+    top_n: Number of passages to keep
+
+    Returns:
+    A tuple of the kept (index into passages, score) pairs, best first, and
+    a dictionary of reranking statistics.
+    """
+    if not passages:
+        return [], {"candidates": 0, "passages_out": 0, "exact_terms": 0, "exact_matches": 0}
+    bm25_scores = scale(get_bm25_scores(get_terms(query), [get_terms(text) for text, _ in passages]))
+    # Without retrieval scores, the retrieval order is the score
+    retrieval_scores = scale([score if score is not None else -i for i, (_, score) in enumerate(passages)])
+    exact_terms = get_exact_terms(query)
+    scores = []
+    num_exact_matches = 0
+    for i, (text, _) in enumerate(passages):
+        boost = sum(term_boost for _, expression, term_boost in exact_terms if expression.search(text))
+        num_exact_matches += boost > 0
+        scores.append(bm25_weight * bm25_scores[i] + retrieval_weight * retrieval_scores[i] + boost)
+    order = sorted(range(len(passages)), key=lambda i: -scores[i])[:top_n]
+    stats = {"candidates": len(passages), "passages_out": len(order), "exact_terms": len(exact_terms), "exact_matches": num_exact_matches}
+    return [(i, round(scores[i], 4)) for i in order], stats
+
+
+## Rerank knowledge base retrieval results
+def rerank_retrieval_results(query, retrievalResults, top_n):
+    """Apply rerank_passages() to retrievalResults, keeping their format. The
+    rerank score replaces 'score', the original is kept as 'retrieval_score'."""
+    passages = [(result['content']['text'], result.get('score')) for result in retrievalResults]
+    kept, stats = rerank_passages(query, passages, top_n)
+    reranked = [{**retrievalResults[i], 'score': score, 'retrieval_score': retrievalResults[i].get('score')} for i, score in kept]
+    return reranked, stats
+
+
+## Rerank LangChain documents
+def rerank_documents(query, docs, top_n):
+    """Apply rerank_passages() to LangChain documents, scored by their 'score' metadata if any."""
+    passages = [(doc.page_content, doc.metadata.get('score')) for doc in docs]
+    kept, stats = rerank_passages(query, passages, top_n)
+    reranked = [docs[i].copy(update={'metadata': {**docs[i].metadata, 'score': score, 'retrieval_score': docs[i].metadata.get('score')}})
+                for i, score in kept]
+    return reranked, stats
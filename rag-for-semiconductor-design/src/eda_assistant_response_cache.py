@@ -0,0 +1,178 @@
+## Response cache for repeated questions
+# Exact matches are keyed by (model ID, normalized prompt, KB ID, generation
+# parameters). An optional semantic tier returns the answer of the most similar
+# cached prompt above an embedding similarity threshold, if both prompts name
+# the same numbers and identifiers: "8-bit counter" and "16-bit counter", or
+# clk_a and CLK_A, embed almost alike but ask for different designs.
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+# Words and numbers of a prompt, for get_exact_tokens()
+token_pattern = re.compile(r"\$?[A-Za-z_][A-Za-z0-9_$]*|\d+(?:\.\d+)?")
+
+
+def normalize_prompt(prompt):
+    """Collapse whitespace and drop trailing punctuation. Case is kept, HDL
+    identifiers are case sensitive."""
+    return re.sub(r"\s+", " ", prompt).strip().rstrip("?.! ")
+
+
+def get_exact_tokens(prompt):
+    """Numbers and identifiers of a prompt: words with digits, underscores,
+    a leading $ or capitals after the first letter (fifo32, clk_a, $display, CLK)."""
+    return {token for token in token_pattern.findall(prompt)
+            if token[0].isdigit() or "_" in token or token[0] == "$" or any(c.isdigit() or c.isupper() for c in token[1:])}
+
+
+class ResponseCache:
+    """SQLite backed response cache with TTL and LRU eviction.
+
+    Args:
+    cache_path: SQLite file holding the cache.
+    ttl: Seconds an entry stays valid.
+    max_entries: Entries kept before the least recently used are evicted.
+    embed_fn: Optional function embedding a prompt, enables the semantic tier.
+    similarity_threshold: Minimum cosine similarity for a semantic hit.
+    kb_version_fn: Optional function returning the sync version of a knowledge
+        base, or None if it cannot be found. Entries cached under an older
+        version are invalidated. While the version is unknown, the knowledge
+        base's entries are neither used, replaced nor invalidated.
+    kb_version_ttl: Seconds a knowledge base version is reused before it is
+        checked again, so long-running processes notice a re-sync.
+    """
+
+    def __init__(self, cache_path, ttl=86400, max_entries=1000, embed_fn=None, similarity_threshold=0.95, kb_version_fn=None, kb_version_ttl=60):
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self.conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.embed_fn = embed_fn
+        self.similarity_threshold = similarity_threshold
+        self.kb_version_fn = kb_version_fn
+        self.kb_version_ttl = kb_version_ttl
+        # kb_id -> (version, time it was checked)
+        self.kb_versions = {}
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0}
+        with self.lock, self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, scope TEXT, kb_id TEXT, kb_version TEXT, prompt TEXT,
+                response TEXT, citations TEXT, embedding BLOB, created REAL, last_access REAL)""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_scope ON responses (scope)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+
+    def get_kb_version(self, kb_id):
+        """Current version of a knowledge base, None if the lookup failed."""
+        if not kb_id or self.kb_version_fn is None:
+            return ""
+        now = time.time()
+        if kb_id not in self.kb_versions or now - self.kb_versions[kb_id][1] >= self.kb_version_ttl:
+            try:
+                version = self.kb_version_fn(kb_id)
+            except Exception as e:
+                print(f"-W- Could not get the version of {kb_id}: {e}")
+                version = None
+            # Failed lookups are also kept for kb_version_ttl, not retried on every query
+            self.kb_versions[kb_id] = (version, now)
+        return self.kb_versions[kb_id][0]
+
+    @staticmethod
+    def get_scope(model_id, kb_id, params):
+        return hashlib.sha256(json.dumps([model_id, kb_id or "", params], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _count(self, name):
+        self.stats[name] += 1
+        with self.conn:
+            self.conn.execute("INSERT INTO stats (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    def get(self, prompt, model_id, kb_id=None, params=None):
+        """Look up a cached response.
+
+        Returns:
+        A dictionary with 'result', 'citations' and 'match' ("exact" or
+        "semantic"), or None on a miss.
+        """
+        scope = self.get_scope(model_id, kb_id, params)
+        normalized_prompt = normalize_prompt(prompt)
+        key = hashlib.sha256((scope + "|" + normalized_prompt).encode("utf-8")).hexdigest()
+        kb_version = self.get_kb_version(kb_id)
+        if kb_version is None:
+            # The entries may be stale, but a failed lookup is no reason to drop them
+            with self.lock:
+                self._count("misses")
+            return None
+        now = time.time()
+
+        rows = []
+        with self.lock:
+            self.conn.execute("DELETE FROM responses WHERE created < ? OR (kb_id = ? AND kb_version != ?)", (now - self.ttl, kb_id or "", kb_version))
+            row = self.conn.execute("SELECT key, response, citations FROM responses WHERE key = ?", (key,)).fetchone()
+            match = "exact"
+            if row is None and self.embed_fn is not None:
+                rows = self.conn.execute("SELECT key, response, citations, embedding, prompt FROM responses WHERE scope = ? AND embedding IS NOT NULL", (scope,)).fetchall()
+
+        if rows:
+            # Embedded outside the lock, other lookups do not wait for the Bedrock call
+            import numpy as np
+            match = "semantic"
+            query_vector = np.asarray(self.embed_fn(normalized_prompt), dtype=np.float32)
+            vectors = np.stack([np.frombuffer(r[3], dtype=np.float32) for r in rows])
+            similarities = vectors @ query_vector / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector) + 1e-12)
+            exact_tokens = get_exact_tokens(normalized_prompt)
+            for i in np.argsort(-similarities):
+                if similarities[i] < self.similarity_threshold:
+                    break
+                if get_exact_tokens(rows[i][4]) == exact_tokens:
+                    row = rows[i][:3]
+                    break
+
+        with self.lock:
+            if row is None:
+                self._count("misses")
+                return None
+
+            with self.conn:
+                self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, row[0]))
+            self._count(match + "_hits")
+            return {"result": row[1], "citations": json.loads(row[2]), "match": match}
+
+    def put(self, prompt, model_id, response, citations=None, kb_id=None, params=None):
+        """Cache a response and evict the least recently used entries beyond max_entries."""
+        scope = self.get_scope(model_id, kb_id, params)
+        normalized_prompt = normalize_prompt(prompt)
+        key = hashlib.sha256((scope + "|" + normalized_prompt).encode("utf-8")).hexdigest()
+        kb_version = self.get_kb_version(kb_id)
+        if kb_version is None:
+            return
+        embedding = None
+        if self.embed_fn is not None:
+            import numpy as np
+            embedding = np.asarray(self.embed_fn(normalized_prompt), dtype=np.float32).tobytes()
+        now = time.time()
+
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              (key, scope, kb_id or "", kb_version, normalized_prompt, response, json.dumps(citations or []), embedding, now, now))
+            self.conn.execute("DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY last_access DESC LIMIT ?)", (self.max_entries,))
+
+    def invalidate(self, kb_id=None):
+        """Drop the entries of a knowledge base, or every entry if kb_id is None."""
+        with self.lock, self.conn:
+            if kb_id is None:
+                self.conn.execute("DELETE FROM responses")
+            else:
+                self.conn.execute("DELETE FROM responses WHERE kb_id = ?", (kb_id,))
+
+    def get_stats(self):
+        """Hit and miss counters of this process and of the cache file overall."""
+        with self.lock:
+            totals = dict(self.conn.execute("SELECT name, value FROM stats").fetchall())
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"session": dict(self.stats), "total": totals, "entries": entries}
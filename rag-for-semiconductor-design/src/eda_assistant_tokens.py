@@ -0,0 +1,89 @@
+## Local token counting and context budgets
+# Anthropic models are counted with the tokenizer file shipped in the
+# anthropic-bedrock package, loaded directly with the tokenizers library
+# instead of creating an AnthropicBedrock client. Other families have no
+# tokenizer available offline and use a characters per token estimate.
+import os
+import math
+import functools
+import importlib.util
+import eda_assistant_model_options
+
+# Characters per token of families without a local tokenizer, on the low side
+# so budgets are not overrun
+chars_per_token = {"mistral": 3.2, "amazon": 3.8, "meta": 3.4, "cohere": 3.8, "default": 3.2}
+# Output tokens kept free in the context window for the response
+max_reserved_output_tokens = 4096
+
+
+class TokenBudgetError(ValueError):
+    """The prompt does not fit the model's context window."""
+
+
+def get_model_family(modelID):
+    if modelID in eda_assistant_model_options.anthropic_models or modelID.startswith("anthropic."):
+        return "anthropic"
+    for family in ("mistral", "amazon", "meta", "cohere"):
+        if modelID.startswith(family + "."):
+            return family
+    return "default"
+
+
+## Load a tokenizer once per family
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(family):
+    """Return a tokenizers.Tokenizer for the family, or None to estimate."""
+    if family != "anthropic":
+        return None
+    try:
+        # Locate the package without importing it, importing it pulls in the HTTP client
+        spec = importlib.util.find_spec("anthropic_bedrock")
+        from tokenizers import Tokenizer
+    except ImportError:
+        return None
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    tokenizer_path = os.path.join(list(spec.submodule_search_locations)[0], "tokenizer.json")
+    if not os.path.exists(tokenizer_path):
+        return None
+    return Tokenizer.from_file(tokenizer_path)
+
+
+## Count the tokens of a text for a model
+def count_tokens(text, modelID):
+    """Count tokens with the model family's tokenizer, or estimate them from
+    the text length if none is available."""
+    if not text:
+        return 0
+    family = get_model_family(modelID)
+    tokenizer = get_tokenizer(family)
+    if tokenizer is not None:
+        return len(tokenizer.encode(text).ids)
+    return math.ceil(len(text) / chars_per_token.get(family, chars_per_token["default"]))
+
+
+def get_context_window(modelID):
+    return eda_assistant_model_options.context_windows.get(modelID, eda_assistant_model_options.default_context_window)
+
+
+## Check a prompt against the context window before sending it
+def check_token_budget(prompt, modelID, maxtokens):
+    """Count the prompt tokens and make sure the prompt leaves room for the response.
+
+    Args:
+    prompt: Full prompt text, including the system prompt.
+    modelID: LLM specific Model identifier
+    maxtokens: Requested maximum output tokens, up to max_reserved_output_tokens
+        of which are kept free.
+
+    Returns:
+    The number of prompt tokens.
+
+    Raises:
+    TokenBudgetError if the prompt does not fit.
+    """
+    prompt_tokens = count_tokens(prompt, modelID)
+    budget = get_context_window(modelID) - min(maxtokens, max_reserved_output_tokens)
+    if prompt_tokens > budget:
+        raise TokenBudgetError(f"Prompt of {prompt_tokens} tokens exceeds the {budget} token input budget of {modelID}")
+    return prompt_tokens
@@ -0,0 +1,183 @@
+## Per-request tracing of query phases
+# A trace holds one span per phase of a query (retrieve, prompt build,
+# generation, citation signing, ...) with its duration and attributes such as
+# token counts, retrieved chunks and cache hits. The current trace is kept in a
+# context variable, so modules add spans with eda_assistant_tracing.span()
+# without passing the trace around, and span() is a no-op outside a trace.
+# Spans are written as JSON lines using OpenTelemetry span field names.
+import json
+import time
+import secrets
+import threading
+import contextlib
+import contextvars
+
+current_trace = contextvars.ContextVar("eda_assistant_trace", default=None)
+current_span = contextvars.ContextVar("eda_assistant_span", default=None)
+trace_file_lock = threading.Lock()
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_span_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent_span_id
+        self.start_time_ns = time.time_ns()
+        self.start_time = time.perf_counter()
+        self.end_time_ns = None
+        self.duration = None
+        self.attributes = dict(attributes or {})
+        self.status = "OK"
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.start_time
+            self.end_time_ns = self.start_time_ns + int(self.duration * 1e9)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "name": self.name,
+            "start_time_unix_nano": self.start_time_ns,
+            "end_time_unix_nano": self.end_time_ns,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "attributes": self.attributes,
+            "status": {"code": self.status},
+        }
+
+
+class Trace:
+    """The spans of one query, written to trace_file as JSON lines when it ends."""
+
+    def __init__(self, name, trace_file=None, **attributes):
+        self.trace_id = secrets.token_hex(16)
+        self.trace_file = trace_file
+        self.root = Span(name, self.trace_id, attributes=attributes)
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def start_span(self, name, **attributes):
+        parent = current_span.get() or self.root
+        span = Span(name, self.trace_id, parent.span_id, attributes)
+        with self.lock:
+            self.spans.append(span)
+        return span
+
+    def end(self):
+        self.root.end()
+        if self.trace_file:
+            with trace_file_lock, open(self.trace_file, "a", encoding="utf-8") as f:
+                for span in [self.root] + self.spans:
+                    f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+    def get_phase_timings(self):
+        """Seconds spent in each phase, summed over spans of the same name."""
+        timings = {}
+        for span in self.spans:
+            timings[span.name] = timings.get(span.name, 0.0) + (span.duration or 0.0)
+        timings["total"] = self.root.duration
+        return timings
+
+    def get_rows(self):
+        """One (phase, milliseconds, attributes) row per span, total last."""
+        rows = [(span.name, (span.duration or 0.0) * 1000, ", ".join(f"{k}={v}" for k, v in span.attributes.items()))
+                for span in self.spans]
+        rows.append(("total", (self.root.duration or 0.0) * 1000, ", ".join(f"{k}={v}" for k, v in self.root.attributes.items())))
+        return rows
+
+    def format_summary(self):
+        rows = self.get_rows()
+        width = max(len(row[0]) for row in rows) + 2
+        lines = [f"{'phase':<{width}}{'ms':>10}  attributes"]
+        for name, milliseconds, attributes in rows:
+            lines.append(f"{name:<{width}}{milliseconds:>10.1f}  {attributes}")
+        return "\n".join(lines)
+
+
+## Trace a query
+@contextlib.contextmanager
+def start_trace(name, trace_file=None, **attributes):
+    """Make a new trace current for the duration of the block."""
+    trace = Trace(name, trace_file, **attributes)
+    trace_token = current_trace.set(trace)
+    span_token = current_span.set(None)
+    try:
+        yield trace
+    except Exception as e:
+        trace.root.status = "ERROR"
+        trace.root.set_attributes(error=str(e))
+        raise
+    finally:
+        current_span.reset(span_token)
+        current_trace.reset(trace_token)
+        trace.end()
+
+
+## Trace the rest of a script
+def begin_trace(name, trace_file=None, **attributes):
+    """Make a new trace current for the rest of the calling context, for
+    scripts where a with block would not fit. End it with trace.end()."""
+    trace = Trace(name, trace_file, **attributes)
+    current_trace.set(trace)
+    current_span.set(None)
+    return trace
+
+
+## Time a phase of the current trace
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Record the block as a span of the current trace, if there is one.
+
+    Yields the span, or None outside a trace.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    phase_span = trace.start_span(name, **attributes)
+    span_token = current_span.set(phase_span)
+    try:
+        yield phase_span
+    except Exception as e:
+        phase_span.status = "ERROR"
+        phase_span.set_attributes(error=str(e))
+        raise
+    finally:
+        current_span.reset(span_token)
+        phase_span.end()
+
+
+def set_attributes(**attributes):
+    """Add attributes to the current span, or to the trace if no span is open."""
+    trace = current_trace.get()
+    if trace is not None:
+        (current_span.get() or trace.root).set_attributes(**attributes)
+
+
+## Time a streamed response
+def trace_stream(text_stream, name="generate", **attributes):
+    """Wrap a generator of text fragments in a span that records the time to
+    first token and ends when the stream is exhausted."""
+    trace = current_trace.get()
+    if trace is None:
+        return text_stream
+    stream_span = trace.start_span(name, stream=True, **attributes)
+
+    def traced_stream():
+        num_chunks = 0
+        try:
+            for text in text_stream:
+                if num_chunks == 0:
+                    stream_span.set_attributes(ttft_ms=round((time.perf_counter() - stream_span.start_time) * 1000, 1))
+                num_chunks += 1
+                yield text
+        finally:
+            stream_span.set_attributes(output_chunks=num_chunks)
+            stream_span.end()
+    return traced_stream()
@@ -1,5 +1,68 @@
 #For general python APIs
+import sys
+import time
+import atexit
+import builtins
 
 def debug_print(message, debug=False):
     if debug:
-        print(f"DEBUG: {message}")
\ No newline at end of file
+        print(f"DEBUG: {message}")
+
+def print_stream(text_stream):
+    """Print text fragments as they arrive.
+
+    Returns:
+    A tuple of the full text and the seconds until the first fragment arrived.
+    """
+    start_time = time.perf_counter()
+    first_token_time = None
+    output_text = ""
+    for text in text_stream:
+        if first_token_time is None:
+            first_token_time = time.perf_counter() - start_time
+        print(text, end="", flush=True)
+        output_text += text
+    print()
+    if first_token_time is None:
+        first_token_time = time.perf_counter() - start_time
+    return output_text, first_token_time
+
+
+class ImportProfiler:
+    """Times every module imported after install(), reporting inclusive time
+    for imports issued directly by this tool (not the ones they pull in)."""
+
+    def __init__(self):
+        self.timings = []
+        self.depth = 0
+        self.start_time = time.perf_counter()
+        self.original_import = builtins.__import__
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if self.depth > 0 or level > 0 or name in sys.modules:
+            self.depth += 1
+            try:
+                return self.original_import(name, globals, locals, fromlist, level)
+            finally:
+                self.depth -= 1
+
+        self.depth += 1
+        start_time = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            self.depth -= 1
+            self.timings.append((name, time.perf_counter() - start_time))
+
+    def install(self):
+        builtins.__import__ = self._import
+        atexit.register(self.report)
+
+    def report(self):
+        builtins.__import__ = self.original_import
+        total_import_time = sum(elapsed for name, elapsed in self.timings)
+        print("\n-I- Startup profile, imports by inclusive time:")
+        for name, elapsed in sorted(self.timings, key=lambda t: t[1], reverse=True):
+            if elapsed >= 0.001:
+                print(f"-I-   {elapsed * 1000:9.1f} ms  {name}")
+        print(f"-I- Total import time: {total_import_time:.3f}s, total run time: {time.perf_counter() - self.start_time:.3f}s")